@@ -1,8 +1,22 @@
+import os
+import time
 import streamlit as st
 from pdf_processor import PDFProcessor
 from retrieval_engine import RetrievalEngine
 from llm_handler import FastHuggingFaceHandler  # Use the fast handler
-from utils import initialize_session_state, add_to_history, format_history_for_download, display_qa_history
+from utils import initialize_session_state, add_to_history, history_count, format_history_for_download, display_qa_history
+from instrumentation import configure_logging, get_logger, metrics
+from shared_corpus import SharedCorpus
+from query_cache import AnswerCache
+
+# Log level comes from STUDYMATE_LOG_LEVEL (default WARNING)
+configure_logging()
+logger = get_logger(__name__)
+
+# Directory to persist the index in, for instant warm starts after a restart
+INDEX_DIR = os.getenv("STUDYMATE_INDEX_DIR")
+# Seconds before an idle session lets go of its documents, and before unused documents are evicted
+EVICT_AFTER = float(os.getenv("STUDYMATE_EVICT_AFTER", "600"))
 
 st.set_page_config(
     page_title="StudyMate - Fast AI Assistant", 
@@ -35,19 +49,46 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def get_shared_corpus() -> SharedCorpus:
+    """The process-wide corpus every session searches; identical uploads are indexed once.
+    
+    Models are loaded once per process by model_registry, on first use. PDFs are
+    indexed on a background thread; each finished batch is searchable right away.
+    """
+    engine = RetrievalEngine(retrieval_mode=os.getenv("STUDYMATE_RETRIEVAL_MODE", "hybrid"))
+    warm_start(engine)
+    processor = PDFProcessor(
+        chunk_size=200, overlap=30,  # Smaller chunks for speed
+        workers=int(os.getenv("STUDYMATE_PDF_WORKERS", os.cpu_count() or 1))
+    )
+    corpus = SharedCorpus(engine, processor, save_path=INDEX_DIR)
+    # Idle sessions and unused documents are released in the background; an eviction may save the index
+    corpus.start_eviction(EVICT_AFTER)
+    return corpus
+
+@st.cache_resource
+def get_answer_cache(model_version: str) -> AnswerCache:
+    """Answers shared by every session using the same QA model, so a class's repeated questions are answered once"""
+    return AnswerCache(model_version)
+
 def main():
     initialize_session_state()
     
     # Initialize components
-    if 'pdf_processor' not in st.session_state:
-        st.session_state.pdf_processor = PDFProcessor(chunk_size=200, overlap=30)  # Smaller chunks for speed
+    corpus = get_shared_corpus()
+    session_id = st.session_state.session_id
+    corpus.touch(session_id)
+    st.session_state.retrieval_engine = corpus.engine
+    st.session_state.ingestion_worker = worker = corpus.worker
     
-    if 'retrieval_engine' not in st.session_state:
-        st.session_state.retrieval_engine = RetrievalEngine()
+    # Only this session's documents count, and only once they have chunks in the index
+    indexed = set(corpus.engine.indexed_sources())
+    st.session_state.processed_files = [name for name in corpus.sources_for(session_id) if name in indexed]
+    st.session_state.chunks_ready = bool(st.session_state.processed_files)
     
     if 'llm_handler' not in st.session_state:
-        with st.spinner("⚡ Loading fast AI model..."):
-            st.session_state.llm_handler = FastHuggingFaceHandler()
+        st.session_state.llm_handler = FastHuggingFaceHandler()
     
     # Header
     st.markdown('<h1 class="main-header">⚡ StudyMate - Fast Edition</h1>', unsafe_allow_html=True)
@@ -74,17 +115,64 @@ def main():
             help="Upload study materials"
         )
         
+        course = st.text_input("Course (optional)", help="Tag new uploads with a course, e.g. CS101")
+        
         if uploaded_files:
             if st.button("⚡ Process PDFs", type="primary"):
-                process_pdfs(uploaded_files)
+                process_pdfs(uploaded_files, course.strip() or None)
+        
+        show_ingestion_progress(worker)
+        
+        # Search mode: lexical skips the embedding model entirely. The engine is shared,
+        # so the choice is kept per session and passed to each search; the dense index is
+        # built at ingestion, and only if STUDYMATE_RETRIEVAL_MODE is not 'lexical'
+        engine = st.session_state.retrieval_engine
+        modes = ["lexical"] if engine.retrieval_mode == 'lexical' else ["hybrid", "dense", "lexical"]
+        current = st.session_state.get('search_mode')
+        st.session_state.search_mode = st.radio(
+            "🔎 Search mode", modes, index=modes.index(current if current in modes else engine.retrieval_mode),
+            help="Hybrid combines keyword (BM25) and semantic search")
+        
+        # Narrow searches to some of this session's documents
+        if len(st.session_state.processed_files) > 1:
+            st.session_state.search_sources = st.multiselect(
+                "📚 Search in", st.session_state.processed_files,
+                help="Leave empty to search all your documents"
+            ) or None
+        else:
+            st.session_state.search_sources = None
         
         # Model info
         if st.session_state.llm_handler:
             st.markdown("---")
             st.markdown("**🤖 AI Model**")
             model_type = getattr(st.session_state.llm_handler, 'model_type', 'Unknown')
-            st.write(f"Type: {model_type.title()}")
-            st.write("Status: Ready ⚡")
+            st.write(f"Type: {model_type.title()} ({st.session_state.llm_handler.precision})")
+            if st.session_state.llm_handler.loaded:
+                st.write("Status: Ready ⚡")
+            else:
+                st.write("Status: Loads on first question")
+        
+        # Per-stage latency over recent operations, cache hit rates and index memory per chunk
+        summary = metrics.summary()
+        stages = summary['stages']
+        if stages or st.session_state.chunks_ready:
+            st.markdown("---")
+            with st.expander("📈 Performance"):
+                for stage, stats in stages.items():
+                    st.write(f"{stage}: p50 {stats['p50_ms']:.0f} ms · p95 {stats['p95_ms']:.0f} ms ({stats['count']}×)")
+                for cache, rate in summary['hit_rates'].items():
+                    st.write(f"{cache} hit rate: {rate:.0%}")
+                if st.session_state.chunks_ready:
+                    memory = st.session_state.retrieval_engine.memory_report()
+                    st.write(f"Memory: {memory['bytes_per_chunk']['total'] / 1024:.1f} KB per chunk, "
+                             f"{memory['bytes']['total'] / 2**20:.1f} MB total ({memory['vector_storage']} index codes)")
+                st.download_button(
+                    label="📥 Export metrics",
+                    data=metrics.export_json(),
+                    file_name="studymate_metrics.json",
+                    mime="application/json"
+                )
     
     # Main interface
     col1, col2 = st.columns([3, 1])
@@ -119,7 +207,11 @@ def main():
             if hasattr(st.session_state, 'current_context'):
                 with st.expander("📖 Sources"):
                     for i, chunk in enumerate(st.session_state.current_context, 1):
-                        st.write(f"**Source {i}:** {chunk['source']}")
+                        page = f" (p. {chunk['page']})" if chunk.get('page') else ""
+                        st.write(f"**Source {i}:** {chunk['source']}{page}")
+                        also_in = sorted({copy['source'] for copy in chunk.get('duplicates', ())} - {chunk['source']})
+                        if also_in:
+                            st.caption(f"Also in: {', '.join(also_in)}")
                         st.caption(f"{chunk['text'][:150]}...")
     
     with col2:
@@ -132,72 +224,138 @@ def main():
             st.metric("Ready", "No 📤")
         
         # Quick stats
-        if st.session_state.qa_history:
-            st.metric("Questions Asked", len(st.session_state.qa_history))
+        questions = history_count()
+        if questions:
+            st.metric("Questions Asked", questions)
             
-            # Download button
+            # Rebuilt only when a question is added, not on every rerun
             st.markdown("---")
-            history_text = format_history_for_download()
             st.download_button(
                 "📥 Download History",
-                history_text,
+                format_history_for_download(questions),
                 "studymate_fast_history.txt"
             )
     
     # Q&A History
     display_qa_history()
+    
+    # Poll while this session's PDFs are being indexed (by its own job or another session's)
+    # so progress and newly searchable files show up
+    if set(corpus.sources_for(session_id)) & set(worker.pending_files()):
+        time.sleep(1)
+        (getattr(st, 'rerun', None) or st.experimental_rerun)()
 
-def process_pdfs(uploaded_files):
-    """Fast PDF processing"""
-    with st.spinner("⚡ Processing PDFs..."):
-        try:
-            chunks = st.session_state.pdf_processor.process_multiple_pdfs(uploaded_files)
-            
-            # 🔍 ADD THIS DEBUG CODE HERE:
-            print(f"📄 DEBUG: PDF processing created {len(chunks) if chunks else 0} chunks")
-            if chunks:
-                print(f"📄 DEBUG: First chunk sample: {chunks[0]['text'][:100]}...")
-                print(f"📄 DEBUG: First chunk source: {chunks[0].get('source', 'Unknown')}")
-            else:
-                print("❌ DEBUG: PDF processing returned no chunks!")
+def warm_start(engine):
+    """Load the saved index from STUDYMATE_INDEX_DIR, if there is one"""
+    if not INDEX_DIR or not os.path.exists(os.path.join(INDEX_DIR, 'manifest.json')):
+        return
+    try:
+        engine.load(INDEX_DIR)
+        logger.info("Loaded saved index from %s (%d files)", INDEX_DIR, len(engine.indexed_sources()))
+    except Exception as e:
+        logger.error("Could not load saved index from %s: %s", INDEX_DIR, e)
+
+def process_pdfs(uploaded_files, course=None):
+    """Claim the uploaded files in the shared corpus, indexing only new content, and let go of files no longer uploaded"""
+    corpus = get_shared_corpus()
+    session_id = st.session_state.session_id
+    
+    try:
+        sources, job = corpus.add(session_id, uploaded_files, course=course)
+        # Drop documents that are no longer uploaded; unused ones are evicted later
+        for name in corpus.sources_for(session_id):
+            if name not in sources:
+                corpus.release(session_id, name)
+                logger.info("Released %s", name)
+        if job is not None:
+            st.session_state.setdefault('session_jobs', set()).add(job.id)
+            logger.info("Queued ingestion job %d with %d files", job.id, len(job.file_names))
+        
+        indexed = set(corpus.engine.indexed_sources())
+        st.session_state.processed_files = [name for name in sources if name in indexed]
+        st.session_state.chunks_ready = bool(st.session_state.processed_files)
+        
+        if job is not None:
+            st.info(f"⚡ Indexing {len(job.file_names)} new files in the background...")
+        elif set(sources) & set(corpus.worker.pending_files()):
+            st.info("Files are still being indexed")
+        elif st.session_state.chunks_ready:
+            st.info("Index is already up to date")
+        else:
+            st.error("No text found in PDFs")
             
-            if chunks:
-                st.session_state.retrieval_engine.build_index(chunks)
-                
-                # 🔍 ADD THIS TOO:
-                print(f"🔍 DEBUG: FAISS index built with {len(chunks)} chunks")
-                
-                st.session_state.chunks_ready = True
-                st.session_state.processed_files = [f.name for f in uploaded_files]
-                st.success(f"⚡ Processed {len(uploaded_files)} files in seconds! ({len(chunks)} chunks)")
-            else:
-                st.error("No text found in PDFs")
-                
-        except Exception as e:
-            print(f"❌ DEBUG: Error in process_pdfs: {str(e)}")
-            st.error(f"Processing error: {str(e)}")
+    except Exception as e:
+        logger.exception("Error in process_pdfs")
+        st.error(f"Processing error: {str(e)}")
+
+def show_ingestion_progress(worker):
+    """Per-file progress and a cancel button for this session's running jobs; a summary once each job ends"""
+    announced = st.session_state.setdefault('announced_jobs', set())
+    mine = st.session_state.setdefault('session_jobs', set())
+    for job in worker.jobs:
+        if job.id in announced or job.id not in mine:
+            continue
+        status = job.snapshot()
+        if not job.finished:
+            st.progress(status['files_done'] / max(1, status['files_total']),
+                        text=f"Indexing {status['files_done']}/{status['files_total']} files ({status['chunks']} chunks)")
+            for name, entry in status['files'].items():
+                pages = f", page {entry['pages']}/{entry['page_count']}" if entry['page_count'] else ""
+                st.caption(f"{name}: {entry['stage']}{pages}")
+            if st.button("✖ Cancel", key=f"cancel_job_{job.id}"):
+                job.cancel()
+            continue
+        
+        announced.add(job.id)
+        for error in status['errors']:
+            pages = f" (pages {error['pages'][0]}-{error['pages'][1]})" if error['pages'] else ""
+            st.warning(f"Skipped part of {error['file']}{pages}: {error['error']}")
+        indexed = sum(entry['stage'] == 'indexed' for entry in status['files'].values())
+        if status['state'] == 'done' and indexed:
+            st.success(f"⚡ Processed {indexed} files in {status['elapsed']:.1f}s! ({status['chunks']} chunks)")
+        elif status['state'] == 'cancelled':
+            st.info(f"Indexing cancelled; {indexed} files were kept")
+        elif status['state'] == 'failed':
+            st.error("Indexing failed; see the log for details")
+        else:
+            st.error("No text found in PDFs")
 
 
 def get_fast_answer(question):
     """Get fast answer"""
-    with st.spinner("⚡ Generating answer..."):
+    with st.spinner("⚡ Generating answer..."), metrics.timer('answer_total'):
         try:
-            # Fast retrieval
-            chunks = st.session_state.retrieval_engine.retrieve_relevant_chunks(question, k=3)
+            corpus = get_shared_corpus()
+            engine = corpus.engine
+            handler = st.session_state.llm_handler
+            cache = get_answer_cache(handler.model_version)
+            mode = st.session_state.get('search_mode')
+            chunk_filter = corpus.session_filter(st.session_state.session_id, sources=st.session_state.get('search_sources'))
+            scope = (mode, 3, chunk_filter.key())
             
-            # 🔍 ADD THIS DEBUG CODE HERE:
-            print(f"🔍 DEBUG: Retrieved chunks: {len(chunks)}")
-            for i, chunk in enumerate(chunks):
-                print(f"🔍 DEBUG: Chunk {i}: {chunk['text'][:50]}...")
-                print(f"🔍 DEBUG: Chunk source: {chunk.get('source', 'Unknown')}")
+            # A question asked before (or a close rephrasing) is answered from the cache without searching;
+            # the search needs the embedding anyway, so it is computed once and handed to both
+            vector = engine.embed_query(question, mode)
+            cached = cache.lookup(engine, question, scope, vector=vector)
+            if cached is None:
+                # Fast retrieval
+                version = engine.corpus_version
+                chunks = engine.retrieve_relevant_chunks(question, k=3, mode=mode, chunk_filter=chunk_filter,
+                                                         query_embedding=vector)
+                logger.debug("Retrieved %d chunks from %s", len(chunks), [chunk.get('source', 'Unknown') for chunk in chunks])
+                cached = cache.lookup(engine, question, scope, chunks, vector=vector) if chunks else None
             
-            if chunks:
+            if cached is not None:
+                answer, chunks = cached
+                logger.debug("Answer served from cache: %r", answer)
+            elif chunks:
                 # Fast answer generation
-                answer = st.session_state.llm_handler.generate_answer(question, chunks)
-                
-                # 🔍 ADD THIS DEBUG TOO:
-                print(f"🤖 DEBUG: Generated answer: {answer}")
+                answer = handler.generate_answer(question, chunks)
+                cache.store(engine, question, scope, chunks, answer, version, vector=vector)
                 
+                logger.debug("Generated answer: %r", answer)
+            
+            if chunks:
                 # Store results
                 st.session_state.current_answer = answer
                 st.session_state.current_context = chunks
@@ -206,12 +364,11 @@ def get_fast_answer(question):
                 add_to_history(question, answer, chunks)
                 st.balloons()  # Celebration for speed!
             else:
-                # 🔍 AND THIS:
-                print("❌ DEBUG: No chunks retrieved!")
+                logger.debug("No chunks retrieved for %r", question)
                 st.warning("No relevant content found")
                 
         except Exception as e:
-            print(f"❌ DEBUG: Error in get_fast_answer: {str(e)}")
+            logger.exception("Error in get_fast_answer")
             st.error(f"Error: {str(e)}")
 
 if __name__ == "__main__":
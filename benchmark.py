@@ -0,0 +1,458 @@
+"""End-to-end benchmark over synthetic PDF corpora.
+
+Generates multi-page PDFs of configurable size, then times PDF processing,
+index building, retrieval and answering, recording memory high-water marks
+along the way. Results are written as JSON so runs on different commits can
+be compared:
+    
+    python benchmark.py --docs 20 --pages 30 --stand-in --output base.json
+    python benchmark.py --docs 20 --pages 30 --stand-in --compare base.json
+
+--stand-in registers lightweight embedding and QA models in the model
+registry, so the run needs no downloads and measures the pipeline rather
+than the networks. --parity (with real models) compares int8-quantized
+retrieval and answers against fp32.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from instrumentation import metrics, percentile
+from model_registry import PRECISIONS, configure_torch_threads, embedding_model_key, pipeline_key, register_model
+from pdf_processor import PDFProcessor
+from retrieval_engine import RetrievalEngine
+from index_backends import VECTOR_STORAGES
+from llm_handler import FastHuggingFaceHandler, QA_CONTEXT_MODES, QA_TASK, QA_MODEL, QA_PIPELINE_KWARGS
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+RESULTS_VERSION = 1
+
+TOPICS = ['photosynthesis', 'thermodynamics', 'mitochondria', 'entropy', 'algorithms',
+          'recursion', 'electrolysis', 'osmosis', 'inflation', 'feudalism', 'tectonics',
+          'enzymes', 'vectors', 'semiconductors', 'metabolism', 'probability']
+PROPERTIES = ['rate', 'cause', 'purpose', 'structure', 'effect', 'origin', 'limit', 'role']
+
+class SyntheticPDF(io.BytesIO):
+    """In-memory PDF with a name, like a Streamlit upload"""
+    
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+def _pdf_string(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def make_pdf(pages: List[str], line_chars: int = 90) -> bytes:
+    """Minimal PDF 1.4 writer: one Helvetica text stream per page"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b"", b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = [text[i:i + line_chars] for i in range(0, len(text), line_chars)]
+        ops = "BT /F1 9 Tf 36 806 Td 11 TL " + " ".join(f"({_pdf_string(line)}) '" for line in lines) + " ET"
+        stream = ops.encode('latin-1', errors='replace')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+    
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+def synthetic_corpus(docs: int, pages: int, words_per_page: int, seed: int = 0,
+                     duplicates: int = 0) -> Tuple[List[SyntheticPDF], List[str]]:
+    """Build docs PDFs of pages pages each; returns (files, questions answerable from them).
+    
+    duplicates extra files re-upload earlier documents under new names.
+    """
+    rng = random.Random(seed)
+    filler = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+              for _ in range(2000)]
+    facts = set()
+    files = []
+    for doc in range(docs):
+        page_texts = []
+        for _ in range(pages):
+            words = []
+            while len(words) < words_per_page:
+                if rng.random() < 0.2:
+                    topic, prop = rng.choice(TOPICS), rng.choice(PROPERTIES)
+                    facts.add((topic, prop))
+                    words += f"The {prop} of {topic} is {rng.choice(filler)} {rng.choice(filler)}.".split()
+                else:
+                    words += (" ".join(rng.choice(filler) for _ in range(rng.randint(6, 14))) + ".").split()
+            page_texts.append(" ".join(words[:words_per_page]))
+        files.append(SyntheticPDF(f"synthetic_{doc:03d}.pdf", make_pdf(page_texts)))
+    for copy in range(duplicates):
+        original = files[copy % docs]
+        files.append(SyntheticPDF(f"copy_{copy:03d}_{original.name}", original.getvalue()))
+    questions = [f"What is the {prop} of {topic}?" for topic, prop in sorted(facts)]
+    rng.shuffle(questions)
+    return files, questions
+
+class HashingEmbedder:
+    """Stand-in for SentenceTransformer: hashed bag of words, same output shape as the real model"""
+    
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+    
+    def encode(self, texts, batch_size: int = 32, **kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                bucket = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+                vectors[row, bucket % self.dimension] += 1.0
+        return vectors
+
+class OverlapQA:
+    """Stand-in for an extractive QA pipeline: returns the context sentence sharing most words with the question"""
+    
+    def _answer(self, question: str, context: str) -> Dict:
+        terms = set(question.lower().split())
+        best, best_overlap, start = "", 0, 0
+        for sentence in context.split('.'):
+            overlap = len(terms & set(sentence.lower().split()))
+            if overlap > best_overlap:
+                best, best_overlap = sentence.strip(), overlap
+                start = context.find(sentence)
+        return {'answer': best, 'score': best_overlap / max(1, len(terms)), 'start': start, 'end': start + len(best)}
+    
+    def __call__(self, inputs=None, question: Optional[str] = None, context: Optional[str] = None, **kwargs):
+        if inputs is None:
+            return self._answer(question, context)
+        results = [self._answer(item['question'], item['context']) for item in inputs]
+        return results[0] if len(results) == 1 else results
+
+def install_stand_in_models(model_name: str):
+    for precision in PRECISIONS:  # stand-ins are not torch modules, so every precision gets the same one
+        register_model(embedding_model_key(model_name, precision), HashingEmbedder())
+        register_model(pipeline_key(QA_TASK, QA_MODEL, precision, **QA_PIPELINE_KWARGS), OverlapQA())
+
+def model_size_mb(model) -> Optional[float]:
+    """Serialized state_dict size of a torch module (quantized weights included), else None"""
+    try:
+        import torch
+    except ImportError:
+        return None
+    if not isinstance(model, torch.nn.Module):
+        return None
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+def peak_rss_mb() -> Optional[float]:
+    """Process resident-set high-water mark so far"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def latency_stats(seconds: List[float]) -> Dict:
+    values = sorted(seconds)
+    return {
+        'count': len(values),
+        'mean_ms': 1000 * sum(values) / max(1, len(values)),
+        'p50_ms': 1000 * percentile(values, 0.50),
+        'p95_ms': 1000 * percentile(values, 0.95),
+        'max_ms': 1000 * values[-1] if values else 0.0,
+    }
+
+class StageRecorder:
+    """Times named stages and records the memory high-water mark reached in each"""
+    
+    def __init__(self, trace_python: bool):
+        self.trace_python = trace_python
+        self.stages = {}
+    
+    def run(self, name: str, func, *args, **kwargs):
+        if self.trace_python:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        stage = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+        if self.trace_python:
+            stage['python_peak_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        self.stages[name] = stage
+        return result
+
+def run_benchmark(docs: int = 10, pages: int = 20, words_per_page: int = 400, queries: int = 50,
+                  answers: int = 20, k: int = 3, chunk_size: int = 200, overlap: int = 30,
+                  workers: int = 1, index_backend: str = 'auto', retrieval_mode: str = 'dense',
+                  stand_in: bool = False, model_name: str = 'all-MiniLM-L6-v2',
+                  qa_context: str = 'joined', precision: str = 'fp32', torch_threads: Optional[int] = None, parity: bool = False,
+                  trace_python: bool = False, seed: int = 0, duplicates: int = 0,
+                  dedup_threshold: Optional[float] = None, vector_storage: str = 'float32') -> Dict:
+    """Run every stage once over a fresh synthetic corpus and return the results dict"""
+    config = {key: value for key, value in locals().items()}
+    if stand_in:
+        install_stand_in_models(model_name)
+    configure_torch_threads(torch_threads)
+    metrics.reset()
+    if trace_python:
+        tracemalloc.start()
+    
+    files, questions = synthetic_corpus(docs, pages, words_per_page, seed, duplicates)
+    questions = (questions * (queries // max(1, len(questions)) + 1))[:queries]
+    recorder = StageRecorder(trace_python)
+    
+    processor = PDFProcessor(chunk_size=chunk_size, overlap=overlap, workers=workers)
+    chunks = recorder.run('process_pdfs', processor.process_multiple_pdfs, files)
+    
+    # No embedding or query cache, so every run (and every stage) pays for encoding
+    engine = RetrievalEngine(model_name=model_name, cache_dir=None, index_backend=index_backend,
+                             retrieval_mode=retrieval_mode, precision=precision, dedup_threshold=dedup_threshold,
+                             vector_storage=vector_storage, query_cache_size=0)
+    if engine.uses_dense():
+        engine.model  # load outside the timed stage
+    recorder.run('build_index', engine.build_index, chunks)
+    
+    retrieval_latencies = []
+    contexts = []
+    def retrieve_all():
+        for question in questions:
+            start = time.perf_counter()
+            contexts.append(engine.retrieve_relevant_chunks(question, k=k))
+            retrieval_latencies.append(time.perf_counter() - start)
+    recorder.run('retrieve', retrieve_all)
+    recorder.run('retrieve_batch', engine.retrieve_batch, questions, k)
+    
+    handler = FastHuggingFaceHandler(lazy=False, precision=precision, qa_context=qa_context)
+    answer_latencies = []
+    def answer_all():
+        for question, context in list(zip(questions, contexts))[:answers]:
+            start = time.perf_counter()
+            handler.generate_answer(question, context)
+            answer_latencies.append(time.perf_counter() - start)
+    recorder.run('answer', answer_all)
+    
+    if trace_python:
+        tracemalloc.stop()
+    
+    stages = recorder.stages
+    memory = engine.memory_report()
+    total_pages = len(files) * pages
+    stages['process_pdfs'].update(pages=total_pages, chunks=len(chunks),
+                                  pages_per_second=total_pages / stages['process_pdfs']['seconds'])
+    stages['build_index'].update(backend=engine.index.name if engine.index is not None else None,
+                                 chunks_per_second=len(chunks) / stages['build_index']['seconds'],
+                                 indexed_chunks=engine.chunks.live_count,
+                                 duplicates_merged=len(chunks) - engine.chunks.live_count,
+                                 bytes_per_chunk=memory['bytes_per_chunk']['total'])
+    stages['retrieve'].update(latency_stats(retrieval_latencies))
+    stages['retrieve_batch'].update(queries_per_second=len(questions) / stages['retrieve_batch']['seconds'])
+    stages['answer'].update(latency_stats(answer_latencies), model_type=handler.model_type)
+    if engine.uses_dense():
+        stages['build_index']['model_size_mb'] = model_size_mb(engine.model)
+    stages['answer']['model_size_mb'] = model_size_mb(getattr(handler.qa_pipeline, 'model', None))
+    results = {
+        'version': RESULTS_VERSION,
+        'timestamp': time.time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'stages': stages,
+        'peak_rss_mb': peak_rss_mb(),
+        'memory': memory,
+        'metrics': metrics.summary(),
+    }
+    if parity:
+        results['parity'] = precision_parity(chunks, questions[:answers], k, model_name)
+    return results
+
+def precision_parity(chunks: List[Dict], questions: List[str], k: int = 3,
+                     model_name: str = 'all-MiniLM-L6-v2', precision: str = 'int8') -> Dict:
+    """Compare retrieval and answers at precision against fp32 over the same corpus and questions.
+    
+    Reports mean cosine between the two encoders' chunk embeddings, top-k
+    overlap of retrieved chunks, exact answer agreement, and the latency and
+    model size of each side.
+    """
+    runs = {}
+    for side in ('fp32', precision):
+        engine = RetrievalEngine(model_name=model_name, cache_dir=None, index_backend='flat', precision=side,
+                                 query_cache_size=0)
+        start = time.perf_counter()
+        engine.build_index(chunks)
+        encode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        retrieved = engine.retrieve_batch(questions, k)
+        retrieve_seconds = time.perf_counter() - start
+        
+        handler = FastHuggingFaceHandler(lazy=False, precision=side)
+        start = time.perf_counter()
+        answers = handler.generate_answers(questions, retrieved)
+        answer_seconds = time.perf_counter() - start
+        runs[side] = {
+            'embeddings': np.asarray(engine.embeddings),
+            'retrieved': [[chunk['text'] for chunk in row] for row in retrieved],
+            'answers': answers,
+            'stats': {
+                'encode_seconds': encode_seconds,
+                'retrieve_seconds': retrieve_seconds,
+                'answer_seconds': answer_seconds,
+                'encoder_size_mb': model_size_mb(engine.model),
+                'qa_model_size_mb': model_size_mb(getattr(handler.qa_pipeline, 'model', None)),
+            },
+        }
+    
+    base, other = runs['fp32'], runs[precision]
+    overlaps = [len(set(a) & set(b)) / max(1, len(a)) for a, b in zip(base['retrieved'], other['retrieved'])]
+    agree = [a == b for a, b in zip(base['answers'], other['answers'])]
+    return {
+        'precision': precision,
+        'embedding_cosine_mean': float((base['embeddings'] * other['embeddings']).sum(axis=1).mean()),
+        'retrieval_overlap_at_k': sum(overlaps) / max(1, len(overlaps)),
+        'answer_agreement': sum(agree) / max(1, len(agree)),
+        'fp32': base['stats'],
+        precision: other['stats'],
+    }
+
+# Numbers compared across runs, with whether a larger value is better
+COMPARED = [
+    ('process_pdfs', 'seconds', False),
+    ('process_pdfs', 'peak_rss_mb', False),
+    ('build_index', 'seconds', False),
+    ('build_index', 'peak_rss_mb', False),
+    ('build_index', 'bytes_per_chunk', False),
+    ('retrieve', 'p50_ms', False),
+    ('retrieve', 'p95_ms', False),
+    ('retrieve_batch', 'queries_per_second', True),
+    ('answer', 'p50_ms', False),
+    ('answer', 'p95_ms', False),
+]
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 0.10) -> Tuple[List[Dict], bool]:
+    """Relative change of the headline numbers; regressed is True if any got worse by more than threshold"""
+    rows, regressed = [], False
+    for stage, field, higher_is_better in COMPARED:
+        old = baseline.get('stages', {}).get(stage, {}).get(field)
+        new = current.get('stages', {}).get(stage, {}).get(field)
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        rows.append({'metric': f"{stage}.{field}", 'baseline': old, 'current': new,
+                     'change': change, 'regression': worse > threshold})
+        regressed = regressed or worse > threshold
+    return rows, regressed
+
+def print_results(results: Dict):
+    print(f"Commit {results['commit'] or 'unknown'}, {results['config']['docs']} docs x "
+          f"{results['config']['pages']} pages, {'stand-in' if results['config']['stand_in'] else 'real'} models")
+    for name, stage in results['stages'].items():
+        details = ", ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+                            for key, value in stage.items() if key != 'seconds')
+        print(f"  {name:<15} {stage['seconds']:8.3f} s  {details}")
+    if results['peak_rss_mb'] is not None:
+        print(f"  peak RSS {results['peak_rss_mb']:.1f} MB")
+    memory = results.get('memory')
+    if memory:
+        parts = ", ".join(f"{name} {value:.0f}" for name, value in memory['bytes_per_chunk'].items() if name != 'total')
+        print(f"  index memory {memory['bytes_per_chunk']['total']:.0f} B/chunk ({memory['vector_storage']} codes: {parts})")
+    parity = results.get('parity')
+    if parity:
+        precision = parity['precision']
+        print(f"  {precision} vs fp32: embedding cosine {parity['embedding_cosine_mean']:.4f}, "
+              f"top-k overlap {parity['retrieval_overlap_at_k']:.1%}, answer agreement {parity['answer_agreement']:.1%}")
+        for key in ('encode_seconds', 'retrieve_seconds', 'answer_seconds'):
+            ratio = parity['fp32'][key] / max(parity[precision][key], 1e-9)
+            print(f"    {key:<17} {parity['fp32'][key]:8.3f} -> {parity[precision][key]:8.3f} s ({ratio:.2f}x)")
+
+def print_comparison(rows: List[Dict], baseline: Dict):
+    print(f"Against {baseline.get('commit') or 'baseline'}:")
+    for row in rows:
+        flag = "  REGRESSION" if row['regression'] else ""
+        print(f"  {row['metric']:<28} {row['baseline']:10.2f} -> {row['current']:10.2f} ({row['change']:+.1%}){flag}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark StudyMate on synthetic PDFs")
+    parser.add_argument('--docs', type=int, default=10)
+    parser.add_argument('--pages', type=int, default=20, help="pages per document")
+    parser.add_argument('--words-per-page', type=int, default=400)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--answers', type=int, default=20, help="how many of the queries to answer")
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--overlap', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--index-backend', default='auto')
+    parser.add_argument('--retrieval-mode', default='dense', choices=['dense', 'lexical', 'hybrid'])
+    parser.add_argument('--model-name', default='all-MiniLM-L6-v2')
+    parser.add_argument('--stand-in', action='store_true', help="use offline stand-in models")
+    parser.add_argument('--qa-context', default='joined', choices=list(QA_CONTEXT_MODES),
+                        help="how retrieved chunks are fed to the QA model")
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS))
+    parser.add_argument('--torch-threads', type=int, help="torch intra-op threads")
+    parser.add_argument('--parity', action='store_true', help="compare int8 against fp32 retrieval and answers")
+    parser.add_argument('--trace-python', action='store_true',
+                        help="also record Python allocation peaks per stage (slows the run)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--vector-storage', default='float32', choices=list(VECTOR_STORAGES),
+                        help="how the vector index codes embeddings")
+    parser.add_argument('--duplicates', type=int, default=0, help="extra files that re-upload earlier documents")
+    parser.add_argument('--dedup-threshold', type=float,
+                        help="near-duplicate Jaccard threshold, 0 disables (default: STUDYMATE_DEDUP_THRESHOLD)")
+    parser.add_argument('--output', help="write results JSON here")
+    parser.add_argument('--compare', help="results JSON from an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="relative slowdown counted as a regression (exit status 1)")
+    args = parser.parse_args(argv)
+    
+    results = run_benchmark(
+        docs=args.docs, pages=args.pages, words_per_page=args.words_per_page, queries=args.queries,
+        answers=args.answers, k=args.k, chunk_size=args.chunk_size, overlap=args.overlap,
+        workers=args.workers, index_backend=args.index_backend, retrieval_mode=args.retrieval_mode,
+        stand_in=args.stand_in, model_name=args.model_name, qa_context=args.qa_context, precision=args.precision,
+        torch_threads=args.torch_threads, parity=args.parity, trace_python=args.trace_python, seed=args.seed,
+        duplicates=args.duplicates, dedup_threshold=args.dedup_threshold, vector_storage=args.vector_storage
+    )
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows, regressed = compare_results(baseline, results, args.threshold)
+        print_comparison(rows, baseline)
+        return 1 if regressed else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
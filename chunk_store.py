@@ -0,0 +1,461 @@
+import json
+import os
+import numpy as np
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Per-chunk integer columns; -1 marks a field the chunk does not have
+ROW_DTYPE = np.dtype([
+    ('source', np.int32),  # index into ChunkStore.sources
+    ('chunk_id', np.int32),
+    ('page', np.int32),
+    ('page_end', np.int32),
+    ('char_start', np.int64),
+    ('char_end', np.int64),
+    ('alive', np.bool_),
+])
+INT_FIELDS = ('chunk_id', 'page', 'page_end', 'char_start', 'char_end')
+MISSING = -1
+
+class ChunkView(Mapping):
+    """Read-only, dict-like view of one chunk in a ChunkStore.
+    
+    Holds only the store and a row number; the text is decoded from the
+    store's buffer on access. Fields a chunk lacks are absent, so
+    ``chunk.get('page')`` behaves as it did for plain dicts. A chunk that
+    near-duplicates were folded into also has 'duplicates': the source, page
+    and chunk id of every merged copy. Chunks of a document with metadata
+    (course, upload hash, ...) have it under 'metadata'.
+    """
+    __slots__ = ('store', 'row', 'similarity_score')
+    
+    def __init__(self, store: 'ChunkStore', row: int, similarity_score: Optional[float] = None):
+        self.store = store
+        self.row = row
+        self.similarity_score = similarity_score
+    
+    def _keys(self) -> List[str]:
+        values = self.store._rows[self.row]
+        keys = ['text', 'source'] + [name for name in INT_FIELDS if values[name] != MISSING]
+        if self.row in self.store.duplicates:
+            keys.append('duplicates')
+        if self.store.source(self.row) in self.store.metadata:
+            keys.append('metadata')
+        if self.similarity_score is not None:
+            keys.append('similarity_score')
+        return keys
+    
+    def __getitem__(self, key: str):
+        if key == 'text':
+            return self.store.text(self.row)
+        if key == 'source':
+            return self.store.source(self.row)
+        if key == 'similarity_score' and self.similarity_score is not None:
+            return self.similarity_score
+        if key == 'duplicates' and self.row in self.store.duplicates:
+            return [dict(entry) for entry in self.store.duplicates[self.row]]
+        if key == 'metadata' and self.store.source(self.row) in self.store.metadata:
+            return dict(self.store.metadata[self.store.source(self.row)])
+        if key in INT_FIELDS:
+            value = int(self.store._rows[key][self.row])
+            if value != MISSING:
+                return value
+        raise KeyError(key)
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys())
+    
+    def __len__(self) -> int:
+        return len(self._keys())
+    
+    def text_bytes(self) -> memoryview:
+        """The UTF-8 text without decoding or copying"""
+        return self.store.text_bytes(self.row)
+    
+    def to_dict(self) -> Dict:
+        return dict(self.items())
+    
+    def __repr__(self) -> str:
+        return f"ChunkView({self.to_dict()!r})"
+
+class ChunkStore:
+    """Columnar chunk storage.
+    
+    Texts are packed back to back in one UTF-8 buffer, with chunk i at
+    text_buffer[text_offsets[i]:text_offsets[i + 1]]. Source names are
+    interned once and referenced by integer code; page, chunk id and character
+    spans live in one structured array. Row numbers are stable: removal only
+    clears the row's alive flag, and compaction returns a new store, so views
+    handed out earlier keep pointing at the chunk they were created for.
+    Provenance of near-duplicates merged into a row is kept sparsely in
+    ``duplicates`` (row -> list of source/page/chunk id dicts), and
+    per-document metadata in ``metadata`` (source -> dict).
+    """
+    
+    def __init__(self):
+        self.sources: List[str] = []
+        self._source_codes: Dict[str, int] = {}
+        self._rows = np.zeros(0, dtype=ROW_DTYPE)
+        self._text_buffer = np.zeros(0, dtype=np.uint8)
+        self._text_offsets = np.zeros(1, dtype=np.int64)
+        self._size = 0
+        self.removed_count = 0
+        self.duplicates: Dict[int, List[Dict]] = {}
+        self.metadata: Dict[str, Dict] = {}
+        self.read_only = False  # True while the columns are memory-mapped from disk
+    
+    def __len__(self) -> int:
+        """Number of rows, including removed ones"""
+        return self._size
+    
+    @property
+    def live_count(self) -> int:
+        return self._size - self.removed_count
+    
+    @property
+    def nbytes(self) -> int:
+        """Bytes used by the text buffer, offsets and row columns"""
+        return int(self._text_offsets[self._size]) + 8 * (self._size + 1) + ROW_DTYPE.itemsize * self._size
+    
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[Mapping]) -> 'ChunkStore':
+        """Build a store from chunk dicts (or views) with at least 'text' and 'source'"""
+        store = cls()
+        for chunk in chunks:
+            store.append(chunk)
+        store.trim()
+        return store
+    
+    def _reserve(self, rows: int, text_bytes: int):
+        """Grow the columns (doubling) to hold rows more chunks and text_bytes more text"""
+        self.make_writable()
+        needed = self._size + rows
+        if needed > len(self._rows):
+            capacity = max(needed, 2 * len(self._rows), 16)
+            grown = np.zeros(capacity, dtype=ROW_DTYPE)
+            grown[:self._size] = self._rows[:self._size]
+            self._rows = grown
+            offsets = np.zeros(capacity + 1, dtype=np.int64)
+            offsets[:self._size + 1] = self._text_offsets[:self._size + 1]
+            self._text_offsets = offsets
+        used = int(self._text_offsets[self._size])
+        if used + text_bytes > len(self._text_buffer):
+            grown = np.zeros(max(used + text_bytes, 2 * len(self._text_buffer), 4096), dtype=np.uint8)
+            grown[:used] = self._text_buffer[:used]
+            self._text_buffer = grown
+    
+    def trim(self):
+        """Release the spare capacity left by doubling growth"""
+        if self.read_only:
+            return
+        used = int(self._text_offsets[self._size])
+        self._rows = self._rows[:self._size].copy()
+        self._text_offsets = self._text_offsets[:self._size + 1].copy()
+        self._text_buffer = self._text_buffer[:used].copy()
+    
+    def _source_code(self, source: str) -> int:
+        code = self._source_codes.get(source)
+        if code is None:
+            code = self._source_codes[source] = len(self.sources)
+            self.sources.append(source)
+        return code
+    
+    def append(self, chunk: Mapping) -> int:
+        """Add one chunk; returns its row number"""
+        encoded = chunk['text'].encode('utf-8')
+        self._reserve(1, len(encoded))
+        row = self._size
+        start = int(self._text_offsets[row])
+        self._text_buffer[start:start + len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+        self._text_offsets[row + 1] = start + len(encoded)
+        values = self._rows[row]
+        values['source'] = self._source_code(chunk['source'])
+        for name in INT_FIELDS:
+            value = chunk.get(name)
+            values[name] = MISSING if value is None else value
+        values['alive'] = True
+        self._size += 1
+        if chunk.get('duplicates'):
+            self.duplicates[row] = [dict(entry) for entry in chunk['duplicates']]
+        return row
+    
+    def extend(self, other: 'ChunkStore', rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Append rows of another store (default: its live rows) in bulk; returns the new row numbers"""
+        rows = other.live_ids() if rows is None else np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return np.zeros(0, dtype=np.int64)
+        starts, ends = other._text_offsets[rows], other._text_offsets[rows + 1]
+        lengths = ends - starts
+        self._reserve(len(rows), int(lengths.sum()))
+        
+        first = self._size
+        base = int(self._text_offsets[first])
+        self._text_offsets[first + 1:first + len(rows) + 1] = base + np.cumsum(lengths)
+        if np.array_equal(ends[:-1], starts[1:]):  # no gaps: the text is already contiguous
+            self._text_buffer[base:base + int(lengths.sum())] = other._text_buffer[starts[0]:ends[-1]]
+        else:
+            for start, end, offset in zip(starts.tolist(), ends.tolist(), self._text_offsets[first:first + len(rows)].tolist()):
+                self._text_buffer[offset:offset + end - start] = other._text_buffer[start:end]
+        
+        new_rows = other._rows[rows]  # fancy indexing copies
+        codes = np.full(len(other.sources), MISSING, dtype=np.int32)
+        for code in np.unique(new_rows['source']).tolist():
+            codes[code] = self._source_code(other.sources[code])
+            if other.sources[code] in other.metadata:
+                self.metadata.setdefault(other.sources[code], dict(other.metadata[other.sources[code]]))
+        new_rows['source'] = codes[new_rows['source']]
+        new_rows['alive'] = True
+        self._rows[first:first + len(rows)] = new_rows
+        self._size += len(rows)
+        if other.duplicates:
+            for new_row, old_row in enumerate(rows.tolist(), first):
+                if old_row in other.duplicates:
+                    self.duplicates[new_row] = [dict(entry) for entry in other.duplicates[old_row]]
+                    for entry in other.duplicates[old_row]:
+                        if entry['source'] in other.metadata:
+                            self.metadata.setdefault(entry['source'], dict(other.metadata[entry['source']]))
+        return np.arange(first, first + len(rows), dtype=np.int64)
+    
+    def select(self, rows: np.ndarray) -> 'ChunkStore':
+        """New store holding the given live rows, renumbered 0..len(rows)-1"""
+        subset = ChunkStore()
+        subset.extend(self, rows)
+        return subset
+    
+    def make_writable(self):
+        """Copy memory-mapped columns into private memory before the first modification"""
+        if not self.read_only:
+            return
+        self._rows = np.array(self._rows)
+        self._text_buffer = np.array(self._text_buffer)
+        self._text_offsets = np.array(self._text_offsets)
+        self.read_only = False
+    
+    def text_bytes(self, row: int) -> memoryview:
+        start, end = self._text_offsets[row], self._text_offsets[row + 1]
+        return memoryview(self._text_buffer[start:end])
+    
+    def text(self, row: int) -> str:
+        start, end = self._text_offsets[row], self._text_offsets[row + 1]
+        return self._text_buffer[start:end].tobytes().decode('utf-8')
+    
+    def texts(self, rows: Iterable[int]) -> List[str]:
+        return [self.text(row) for row in rows]
+    
+    def source(self, row: int) -> str:
+        return self.sources[self._rows['source'][row]]
+    
+    def is_alive(self, row: int) -> bool:
+        return 0 <= row < self._size and bool(self._rows['alive'][row])
+    
+    def view(self, row: int, similarity_score: Optional[float] = None) -> ChunkView:
+        return ChunkView(self, row, similarity_score)
+    
+    def __getitem__(self, row: int) -> ChunkView:
+        if not 0 <= row < self._size:
+            raise IndexError(row)
+        return ChunkView(self, row)
+    
+    def __iter__(self) -> Iterator[ChunkView]:
+        """Views of the live chunks in row order"""
+        return (ChunkView(self, row) for row in self.live_ids().tolist())
+    
+    def live_ids(self) -> np.ndarray:
+        return np.flatnonzero(self._rows['alive'][:self._size]).astype(np.int64)
+    
+    def live_mask(self) -> np.ndarray:
+        """Boolean mask over rows, True for live chunks"""
+        return self._rows['alive'][:self._size].copy()
+    
+    def ids_for_source(self, source: str) -> np.ndarray:
+        """Live rows of one source document"""
+        code = self._source_codes.get(source)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        rows = self._rows[:self._size]
+        return np.flatnonzero((rows['source'] == code) & rows['alive']).astype(np.int64)
+    
+    def live_sources(self) -> List[str]:
+        """Sources with at least one live chunk, in order of first appearance.
+        
+        A source whose chunks were all merged into other documents' chunks still counts.
+        """
+        rows = self._rows[:self._size]
+        codes, first = np.unique(rows['source'][rows['alive']], return_index=True)
+        sources = [self.sources[code] for code in codes[np.argsort(first)]]
+        seen = set(sources)
+        for row in sorted(self.duplicates):
+            for entry in self.duplicates[row]:
+                if entry['source'] not in seen:
+                    seen.add(entry['source'])
+                    sources.append(entry['source'])
+        return sources
+    
+    def has_source(self, source: str) -> bool:
+        if len(self.ids_for_source(source)) > 0:
+            return True
+        return any(entry['source'] == source for entries in self.duplicates.values() for entry in entries)
+    
+    def add_duplicate(self, row: int, chunk: Mapping):
+        """Record chunk as a near-duplicate folded into row"""
+        entry = {'source': chunk['source']}
+        for name in INT_FIELDS:
+            if chunk.get(name) is not None:
+                entry[name] = int(chunk[name])
+        entries = self.duplicates.setdefault(row, [])
+        entries.append(entry)
+        entries.extend(dict(e) for e in chunk.get('duplicates', ()))
+    
+    def orphaned_rows(self, sources: Iterable[str]) -> List[int]:
+        """Rows that removing every one of sources would delete, i.e. with no copy from another source"""
+        sources = set(sources)
+        orphaned = []
+        for source in sources:
+            for row in self.ids_for_source(source).tolist():
+                if all(entry['source'] in sources for entry in self.duplicates.get(row, ())):
+                    orphaned.append(row)
+        return orphaned
+    
+    def release_source(self, source: str) -> Tuple[np.ndarray, int]:
+        """Detach a source before it is removed.
+        
+        Drops its entries from merged provenance, and hands each row it owns
+        that has other copies to the first of them. Returns the rows left with
+        no source (to be removed) and the number of the source's chunks detached.
+        """
+        detached = 0
+        for row in list(self.duplicates):
+            entries = [entry for entry in self.duplicates[row] if entry['source'] != source]
+            detached += len(self.duplicates[row]) - len(entries)
+            if entries:
+                self.duplicates[row] = entries
+            else:
+                del self.duplicates[row]
+        
+        orphaned = []
+        for row in self.ids_for_source(source).tolist():
+            entries = self.duplicates.pop(row, None)
+            detached += 1
+            if not entries:
+                orphaned.append(row)
+                continue
+            self.make_writable()
+            heir, rest = entries[0], entries[1:]
+            values = self._rows[row]
+            values['source'] = self._source_code(heir['source'])
+            for name in INT_FIELDS:
+                values[name] = heir.get(name, MISSING)
+            if rest:
+                self.duplicates[row] = rest
+        return np.asarray(orphaned, dtype=np.int64), detached
+    
+    def remove(self, rows: np.ndarray) -> int:
+        """Mark rows as removed; returns how many were live"""
+        self.make_writable()
+        rows = np.asarray(rows, dtype=np.int64)
+        removed = int(self._rows['alive'][rows].sum())
+        self._rows['alive'][rows] = False
+        self.removed_count += removed
+        if self.duplicates:
+            for row in rows.tolist():
+                self.duplicates.pop(row, None)
+        return removed
+    
+    def save(self, path: str):
+        """Write texts.bin, text_offsets.npy, chunk_rows.npy, sources.json, duplicates.json and metadata.json into path.
+        
+        Existing files are truncated and rewritten, so path must not hold a store anyone has loaded
+        with mmap=True; RetrievalEngine.save always writes a fresh snapshot directory.
+        """
+        used = int(self._text_offsets[self._size])
+        self._text_buffer[:used].tofile(os.path.join(path, 'texts.bin'))
+        np.save(os.path.join(path, 'text_offsets.npy'), self._text_offsets[:self._size + 1])
+        np.save(os.path.join(path, 'chunk_rows.npy'), self._rows[:self._size])
+        with open(os.path.join(path, 'sources.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.sources, f)
+        with open(os.path.join(path, 'duplicates.json'), 'w', encoding='utf-8') as f:
+            json.dump({str(row): entries for row, entries in self.duplicates.items()}, f)
+        with open(os.path.join(path, 'metadata.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.metadata, f)
+    
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'ChunkStore':
+        """Load a store written by save; with mmap=True the columns are mapped read-only"""
+        store = cls()
+        mmap_mode = 'r' if mmap else None
+        store._text_offsets = np.load(os.path.join(path, 'text_offsets.npy'), mmap_mode=mmap_mode)
+        store._rows = np.load(os.path.join(path, 'chunk_rows.npy'), mmap_mode=mmap_mode)
+        if store._text_offsets[-1] > 0:
+            store._text_buffer = np.memmap(os.path.join(path, 'texts.bin'), dtype=np.uint8, mode='r') if mmap \
+                else np.fromfile(os.path.join(path, 'texts.bin'), dtype=np.uint8)
+        with open(os.path.join(path, 'sources.json'), 'r', encoding='utf-8') as f:
+            store.sources = json.load(f)
+        store._source_codes = {source: code for code, source in enumerate(store.sources)}
+        duplicates_path = os.path.join(path, 'duplicates.json')
+        if os.path.exists(duplicates_path):  # absent in format version 2
+            with open(duplicates_path, 'r', encoding='utf-8') as f:
+                store.duplicates = {int(row): entries for row, entries in json.load(f).items()}
+        metadata_path = os.path.join(path, 'metadata.json')
+        if os.path.exists(metadata_path):  # absent before format version 4
+            with open(metadata_path, 'r', encoding='utf-8') as f:
+                store.metadata = json.load(f)
+        store._size = len(store._rows)
+        store.removed_count = int(store._size - store._rows['alive'].sum())
+        store.read_only = mmap
+        return store
+
+class ChunkFilter:
+    """Restricts a search to some documents and pages.
+    
+    sources: document names to search; course: a course (or list of courses)
+    matched against each document's metadata['course']; metadata: other
+    metadata fields that must match exactly; pages: inclusive (first, last)
+    page range a chunk must overlap. Unset fields do not restrict. A merged
+    near-duplicate counts for every document it appears in.
+    """
+    
+    def __init__(self, sources: Optional[Iterable[str]] = None, course: Union[str, Sequence[str], None] = None,
+                 pages: Optional[Tuple[int, int]] = None, metadata: Optional[Dict] = None):
+        self.sources = None if sources is None else frozenset(sources)
+        self.courses = None if course is None else frozenset([course] if isinstance(course, str) else course)
+        self.pages = None if pages is None else (int(pages[0]), int(pages[1]))
+        self.metadata = dict(metadata or {})
+    
+    def key(self) -> Tuple:
+        """Hashable identity, so equal filters can share one batched search"""
+        return (self.sources, self.courses, self.pages, tuple(sorted(self.metadata.items())))
+    
+    def accepts_source(self, source: str, metadata: Optional[Dict]) -> bool:
+        if self.sources is not None and source not in self.sources:
+            return False
+        metadata = metadata or {}
+        if self.courses is not None and metadata.get('course') not in self.courses:
+            return False
+        return all(metadata.get(name) == value for name, value in self.metadata.items())
+    
+    def _accepts_pages(self, page: int, page_end: int) -> bool:
+        if self.pages is None:
+            return True
+        if page == MISSING:
+            return False
+        return page <= self.pages[1] and (page_end if page_end != MISSING else page) >= self.pages[0]
+    
+    def mask(self, store: ChunkStore) -> np.ndarray:
+        """Boolean mask over the store's rows: live and accepted"""
+        rows = store._rows[:len(store)]
+        codes = [code for code, source in enumerate(store.sources)
+                 if self.accepts_source(source, store.metadata.get(source))]
+        allowed = rows['alive'] & np.isin(rows['source'], np.asarray(codes, dtype=np.int32))
+        if self.pages is not None:
+            page_end = np.where(rows['page_end'] != MISSING, rows['page_end'], rows['page'])
+            allowed &= (rows['page'] != MISSING) & (rows['page'] <= self.pages[1]) & (page_end >= self.pages[0])
+        
+        # Rows owned by another document may hold a merged copy of an accepted one
+        for row, entries in store.duplicates.items():
+            if allowed[row] or not rows['alive'][row]:
+                continue
+            if any(self.accepts_source(entry['source'], store.metadata.get(entry['source']))
+                   and self._accepts_pages(entry.get('page', MISSING), entry.get('page_end', MISSING))
+                   for entry in entries):
+                allowed[row] = True
+        return allowed
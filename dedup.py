@@ -0,0 +1,179 @@
+import os
+import zlib
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+from chunk_store import ChunkStore
+from lexical_index import tokenize
+
+# Modulus of the MinHash permutations; shingle hashes are 32-bit, so a * h + b fits in uint64
+MERSENNE_PRIME = (1 << 31) - 1
+# Separates the key spaces of different bands
+BAND_SALT = np.uint64(0x9E3779B97F4A7C15)
+
+def default_dedup_threshold() -> float:
+    """STUDYMATE_DEDUP_THRESHOLD, default 0.85; 0 disables near-duplicate removal"""
+    return float(os.getenv("STUDYMATE_DEDUP_THRESHOLD", "0.85"))
+
+def shingle_hashes(text: str, size: int = 3) -> np.ndarray:
+    """Sorted unique CRC32 hashes of the text's word n-grams"""
+    tokens = tokenize(text)
+    if len(tokens) < size:
+        shingles = [' '.join(tokens)] if tokens else []
+    else:
+        shingles = [' '.join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)]
+    return np.unique(np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles), dtype=np.uint64, count=len(shingles)))
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """Exact Jaccard similarity of two sorted unique hash arrays"""
+    if not len(a) and not len(b):
+        return 1.0
+    shared = len(np.intersect1d(a, b, assume_unique=True))
+    return shared / (len(a) + len(b) - shared)
+
+class DedupPlan:
+    """Which rows of an incoming batch to index and which to fold into an existing chunk"""
+    
+    def __init__(self, keys: np.ndarray, keep: List[int], corpus_merges: Dict[int, int],
+                 batch_merges: Dict[int, int], generation: int):
+        self.keys = keys  # band keys for every batch row
+        self.keep = keep  # batch rows to embed and index, in order
+        self.corpus_merges = corpus_merges  # batch row -> live corpus row it duplicates
+        self.batch_merges = batch_merges  # batch row -> earlier kept batch row it duplicates
+        self.generation = generation  # corpus generation the corpus rows refer to
+    
+    @property
+    def merged_count(self) -> int:
+        return len(self.corpus_merges) + len(self.batch_merges)
+
+class NearDuplicateIndex:
+    """MinHash/LSH index over a chunk store, used to skip near-duplicate chunks before they are embedded.
+    
+    Each chunk is reduced to a MinHash signature of its word shingles and the
+    signature to ``bands`` band keys; keys[i] belongs to store row i. Chunks
+    sharing a band key are candidates, and a candidate counts as a duplicate
+    when the exact shingle Jaccard similarity reaches ``threshold``. With the
+    defaults (64 permutations in 16 bands of 4) pairs at 0.85 similarity are
+    found with near certainty while pairs below 0.5 rarely need checking.
+    """
+    
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.uint64)
+        self._band_multipliers = (rng.randint(1, 1 << 31, size=num_perm // bands).astype(np.uint64) << np.uint64(32)) | np.uint64(1)
+        self._keys = np.zeros((0, bands), dtype=np.uint64)  # growable; rows [0, _size) are in use
+        self._size = 0
+        self._buckets: Dict[int, List[int]] = {}  # band key -> rows having it, extended as rows are appended
+    
+    def params(self) -> Dict:
+        return {'num_perm': self.num_perm, 'bands': self.bands, 'shingle_size': self.shingle_size, 'seed': self.seed}
+    
+    def __len__(self) -> int:
+        return self._size
+    
+    @property
+    def keys(self) -> np.ndarray:
+        """Band keys [rows, bands]; keys[i] belongs to store row i"""
+        return self._keys[:self._size]
+    
+    def signature(self, shingles: np.ndarray) -> np.ndarray:
+        if not len(shingles):
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        return ((np.outer(self._a, shingles) + self._b[:, None]) % MERSENNE_PRIME).min(axis=1)
+    
+    def band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """Hash each band of each signature to one uint64 key"""
+        rows = self.num_perm // self.bands
+        banded = signatures.reshape(len(signatures), self.bands, rows)
+        with np.errstate(over='ignore'):
+            keys = (banded * self._band_multipliers).sum(axis=2, dtype=np.uint64)
+            keys ^= np.arange(self.bands, dtype=np.uint64) * BAND_SALT
+        return keys
+    
+    def hash_texts(self, texts: Sequence[str]):
+        """Shingle sets and band keys [len(texts), bands] for texts"""
+        shingles = [shingle_hashes(text, self.shingle_size) for text in texts]
+        signatures = np.stack([self.signature(s) for s in shingles]) if shingles \
+            else np.zeros((0, self.num_perm), dtype=np.uint64)
+        return shingles, self.band_keys(signatures)
+    
+    def append(self, keys: np.ndarray):
+        """Keys of rows appended to the store, in row order; costs O(len(keys)), not O(len(self))"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        needed = self._size + len(keys)
+        if needed > len(self._keys):
+            buffer = np.zeros((max(needed, 2 * len(self._keys)), self.bands), dtype=np.uint64)
+            buffer[:self._size] = self._keys[:self._size]
+            self._keys = buffer
+        self._keys[self._size:needed] = keys
+        for row, row_keys in enumerate(keys.tolist(), self._size):
+            for key in row_keys:
+                self._buckets.setdefault(key, []).append(row)
+        self._size = needed
+    
+    def reset(self):
+        self._keys = np.zeros((0, self.bands), dtype=np.uint64)
+        self._size = 0
+        self._buckets = {}
+    
+    def rebuild(self, store: ChunkStore):
+        """Recompute the keys of every row of a store (removed rows included, to keep rows aligned)"""
+        _, keys = self.hash_texts(store.texts(range(len(store))))
+        self.reset()
+        self.append(keys)
+    
+    def candidates(self, keys: np.ndarray) -> np.ndarray:
+        """Rows sharing at least one band key with one chunk's keys, in row order"""
+        rows = {row for key in keys.tolist() for row in self._buckets.get(key, ())}
+        return np.array(sorted(rows), dtype=np.int64)
+    
+    def plan(self, batch: ChunkStore, corpus: ChunkStore, generation: int,
+             exclude_rows: Optional[Sequence[int]] = None) -> DedupPlan:
+        """Match each live batch row against live corpus rows and earlier batch rows.
+        
+        Corpus rows in exclude_rows (about to be removed) are not matched against.
+        """
+        rows = batch.live_ids().tolist()
+        shingles, keys = self.hash_texts(batch.texts(rows))
+        excluded = set(exclude_rows or ())
+        keep, corpus_merges, batch_merges = [], {}, {}
+        buckets: Dict[int, List[int]] = {}  # band key -> kept batch positions
+        corpus_size = min(len(corpus), len(self.keys))
+        
+        for pos, row in enumerate(rows):
+            match = None
+            if corpus_size:
+                for candidate in self.candidates(keys[pos]).tolist():
+                    if candidate >= corpus_size or not corpus.is_alive(candidate) or candidate in excluded:
+                        continue
+                    if jaccard(shingles[pos], shingle_hashes(corpus.text(candidate), self.shingle_size)) >= self.threshold:
+                        match = candidate
+                        break
+            if match is not None:
+                corpus_merges[row] = match
+                continue
+            
+            seen = {p for key in keys[pos].tolist() for p in buckets.get(key, ())}
+            for earlier in sorted(seen):
+                if jaccard(shingles[pos], shingles[earlier]) >= self.threshold:
+                    match = earlier
+                    break
+            if match is not None:
+                batch_merges[row] = rows[match]
+                continue
+            
+            keep.append(row)
+            for key in keys[pos].tolist():
+                buckets.setdefault(key, []).append(pos)
+        
+        all_keys = np.zeros((len(batch), self.bands), dtype=np.uint64)
+        all_keys[rows] = keys
+        return DedupPlan(all_keys, keep, corpus_merges, batch_merges, generation)
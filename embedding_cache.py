@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from typing import List, Dict, Optional
+from instrumentation import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are coordinated
+    fcntl = None
+
+logger = get_logger(__name__)
+
+# Slots per hash bucket; a key can only live in the ways of its bucket
+WAYS = 8
+# Bytes of the sha256 digest stored with each slot
+KEY_BYTES = 32
+# Files of the earlier layout, which kept a JSON slot index per instance
+LEGACY_FILES = ('index.json', 'vectors.f32')
+
+class EmbeddingCache:
+    """On-disk, content-addressed cache of chunk embeddings, shareable between instances and processes.
+
+    The cache is a set-associative table of fixed capacity (``max_bytes`` of
+    vectors): sha256(model name, chunk text) picks a bucket of WAYS slots,
+    and each slot stores its key digest next to its vector, so no separate
+    index has to be loaded, merged or flushed. Readers check the digest
+    before and after copying a vector and treat a mismatch as a miss;
+    writers take an exclusive file lock, clear the digest, write the vector
+    and then set the digest. When a bucket is full its least recently used
+    slot is recycled. The files are created sparse, so disk use grows with
+    the entries actually written.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, max_bytes: int = 512 * 1024 * 1024):
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        safe_name = re.sub(r'[^\w\-\.]', '_', model_name)
+        self.cache_dir = os.path.join(cache_dir, safe_name)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.meta_path = os.path.join(self.cache_dir, 'table.json')
+        self.vectors_path = os.path.join(self.cache_dir, 'table_vectors.f32')
+        self.keys_path = os.path.join(self.cache_dir, 'table_keys.bin')
+        self.ticks_path = os.path.join(self.cache_dir, 'table_ticks.i64')
+        self.lock_path = os.path.join(self.cache_dir, 'table.lock')
+
+        self.dim = None
+        self.capacity = 0
+        self.vectors = None  # [capacity, dim] float32
+        self.slot_keys = None  # [capacity, KEY_BYTES] uint8 digests, all zero for a free slot
+        self.slot_ticks = None  # [capacity] int64 last use, ns since the epoch
+        self._thread_lock = threading.Lock()
+        self._open()
+
+    def key(self, text: str) -> str:
+        """Content address for a chunk under this cache's model"""
+        digest = hashlib.sha256()
+        digest.update(self.model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access for writers, across threads and (where fcntl exists) processes"""
+        with self._thread_lock, open(self.lock_path, 'a+b') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _open(self):
+        """Map the table if another instance (or an earlier run) created it"""
+        if self.vectors is not None or not os.path.exists(self.meta_path):
+            return
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            dim, capacity = int(meta['dim']), int(meta['capacity'])
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+            self.slot_keys = np.memmap(self.keys_path, dtype=np.uint8, mode='r+', shape=(capacity, KEY_BYTES))
+            self.slot_ticks = np.memmap(self.ticks_path, dtype=np.int64, mode='r+', shape=(capacity,))
+            self.dim, self.capacity = dim, capacity
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Embedding cache unreadable, caching disabled for this instance: %s", e)
+            self.vectors = self.slot_keys = self.slot_ticks = None
+
+    def _create(self, dim: int):
+        """Create the table files (called with the lock held); the metadata file is written last"""
+        self._open()
+        if self.vectors is not None:
+            return
+        capacity = max(WAYS, self.max_bytes // (dim * 4) // WAYS * WAYS)
+        for path, size in ((self.vectors_path, capacity * dim * 4), (self.keys_path, capacity * KEY_BYTES),
+                           (self.ticks_path, capacity * 8)):
+            with open(path, 'wb') as f:
+                f.truncate(size)  # sparse
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': dim, 'capacity': capacity}, f)
+        os.replace(tmp_path, self.meta_path)
+        for name in LEGACY_FILES:
+            if os.path.exists(os.path.join(self.cache_dir, name)):
+                os.remove(os.path.join(self.cache_dir, name))
+        self._open()
+
+    def _bucket(self, digest: bytes) -> int:
+        """First slot of the bucket a digest belongs to"""
+        return int.from_bytes(digest[:8], 'little') % (self.capacity // WAYS) * WAYS
+
+    def _find(self, digest: np.ndarray, start: int) -> Optional[int]:
+        match = np.flatnonzero((self.slot_keys[start:start + WAYS] == digest).all(axis=1))
+        return start + int(match[0]) if len(match) else None
+
+    def get_many(self, keys: List[str]) -> Dict[int, np.ndarray]:
+        """Return {position in keys: vector} for every cached key"""
+        found = {}
+        self._open()
+        if self.vectors is None:
+            return found
+        now = time.time_ns()
+        for pos, key in enumerate(keys):
+            raw = bytes.fromhex(key)
+            digest = np.frombuffer(raw, dtype=np.uint8)
+            slot = self._find(digest, self._bucket(raw))
+            if slot is None:
+                continue
+            vector = np.array(self.vectors[slot])
+            if (self.slot_keys[slot] == digest).all():  # not recycled while it was copied
+                self.slot_ticks[slot] = now
+                found[pos] = vector
+        return found
+
+    def put_many(self, keys: List[str], vectors: np.ndarray):
+        """Store vectors for keys, recycling the least recently used slot of a full bucket"""
+        if len(keys) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._locked():
+            if self.vectors is None:
+                self._create(int(vectors.shape[1]))
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match cache dimension {self.dim}")
+
+            now = time.time_ns()
+            for key, vector in zip(keys, vectors):
+                raw = bytes.fromhex(key)
+                digest = np.frombuffer(raw, dtype=np.uint8)
+                start = self._bucket(raw)
+                slot = self._find(digest, start)
+                if slot is None:
+                    free = np.flatnonzero(~self.slot_keys[start:start + WAYS].any(axis=1))
+                    slot = start + int(free[0] if len(free) else np.argmin(self.slot_ticks[start:start + WAYS]))
+                # Readers verify the digest around their copy, so clear it while the vector changes
+                self.slot_keys[slot] = 0
+                self.vectors[slot] = vector
+                self.slot_keys[slot] = digest
+                self.slot_ticks[slot] = now
+
+    def flush(self):
+        """Write dirty pages to disk; other instances see writes through the page cache without this"""
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.slot_keys.flush()
+            self.slot_ticks.flush()
+
+    def __len__(self) -> int:
+        self._open()
+        if self.slot_keys is None:
+            return 0
+        return int(self.slot_keys.any(axis=1).sum())
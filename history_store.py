@@ -0,0 +1,139 @@
+"""Append-only Q&A history in SQLite.
+
+Each answer is one row in ``entries``; the chunks it was based on are kept
+as references (source, chunk id, page, score) in ``entry_chunks`` rather
+than copies of their text. Pages of entries are read on demand and exports
+stream from a cursor, so a long session costs neither memory nor rerun time.
+"""
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from itertools import groupby
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, TextIO
+
+from instrumentation import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_session ON entries (session_id, id);
+CREATE TABLE IF NOT EXISTS entry_chunks (
+    entry_id INTEGER NOT NULL REFERENCES entries (id),
+    position INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    chunk_id INTEGER,
+    page INTEGER,
+    similarity_score REAL,
+    PRIMARY KEY (entry_id, position)
+);
+"""
+
+def default_history_path() -> str:
+    """STUDYMATE_HISTORY_PATH, default studymate_history.sqlite3 in the working directory"""
+    return os.getenv("STUDYMATE_HISTORY_PATH", "studymate_history.sqlite3")
+
+class HistoryStore:
+    """Q&A entries of every session in one SQLite file; safe to share between threads"""
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or default_history_path()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+        logger.info("Q&A history stored in %s", self.path)
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL lets exports read while answers are appended; NORMAL sync is durable across app crashes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def append(self, session_id: str, question: str, answer: str, chunks: Sequence[Mapping] = ()) -> int:
+        """Record one answer and references to its context chunks; returns the entry id"""
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        refs = [(position, chunk['source'], chunk.get('chunk_id'), chunk.get('page'), chunk.get('similarity_score'))
+                for position, chunk in enumerate(chunks)]
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO entries (session_id, timestamp, question, answer) VALUES (?, ?, ?, ?)",
+                (session_id, timestamp, question, answer))
+            entry_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO entry_chunks (entry_id, position, source, chunk_id, page, similarity_score) "
+                "VALUES (?, ?, ?, ?, ?, ?)", [(entry_id,) + ref for ref in refs])
+        return entry_id
+    
+    def count(self, session_id: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries WHERE session_id = ?", (session_id,)).fetchone()[0]
+    
+    def page(self, session_id: str, page: int = 0, page_size: int = 10) -> List[Dict]:
+        """Entries of one page, newest first; each has 'number' (1 = first question) and 'chunks' references"""
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM entries WHERE session_id = ?", (session_id,)).fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT id, timestamp, question, answer FROM entries WHERE session_id = ? "
+                "ORDER BY id DESC LIMIT ? OFFSET ?", (session_id, page_size, page * page_size)).fetchall()
+            refs = self._chunk_refs([row[0] for row in rows])
+        return [_entry(row, total - page * page_size - i, refs.get(row[0], [])) for i, row in enumerate(rows)]
+    
+    def _chunk_refs(self, entry_ids: List[int]) -> Dict[int, List[Dict]]:
+        if not entry_ids:
+            return {}
+        rows = self._conn.execute(
+            f"SELECT entry_id, source, chunk_id, page, similarity_score FROM entry_chunks "
+            f"WHERE entry_id IN ({', '.join('?' * len(entry_ids))}) ORDER BY entry_id, position", entry_ids)
+        return {entry_id: [_chunk_ref(ref) for ref in group] for entry_id, group in groupby(rows, key=lambda ref: ref[0])}
+    
+    def iter_entries(self, session_id: str) -> Iterator[Dict]:
+        """Every entry of a session, oldest first, read incrementally on a connection of its own"""
+        conn = self._connect()
+        try:
+            entries = conn.execute(
+                "SELECT id, timestamp, question, answer FROM entries WHERE session_id = ? ORDER BY id", (session_id,))
+            for number, row in enumerate(entries, 1):
+                yield _entry(row, number, None)
+        finally:
+            conn.close()
+    
+    def export_text(self, session_id: str, out: TextIO) -> int:
+        """Write the session's history as plain text to out; returns the number of entries"""
+        out.write("StudyMate Q&A Session History\n")
+        out.write("=" * 50 + "\n\n")
+        count = 0
+        for entry in self.iter_entries(session_id):
+            out.write(f"Q{entry['number']}: {entry['question']}\n")
+            out.write(f"Time: {entry['timestamp']}\n")
+            out.write(f"Answer: {entry['answer']}\n")
+            out.write("-" * 30 + "\n\n")
+            count += 1
+        if not count:
+            out.write("No Q&A history available.\n")
+        return count
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def _entry(row, number: int, chunks: Optional[List[Dict]]) -> Dict:
+    entry = {'id': row[0], 'number': number, 'timestamp': row[1], 'question': row[2], 'answer': row[3]}
+    if chunks is not None:
+        entry['chunks'] = chunks
+    return entry
+
+def _chunk_ref(ref) -> Dict:
+    """A stored chunk reference as a dict, without the fields the chunk did not have"""
+    names = ('source', 'chunk_id', 'page', 'similarity_score')
+    return {name: value for name, value in zip(names, ref[1:]) if value is not None}
@@ -0,0 +1,360 @@
+import time
+import numpy as np
+from typing import List, Dict, Optional, Tuple
+from model_registry import lazy_import
+
+faiss = lazy_import('faiss')  # imported on first index operation
+
+# Corpus sizes (live chunks) at which 'auto' moves to the next backend
+AUTO_THRESHOLDS = [
+    (20_000, 'flat'),
+    (200_000, 'hnsw'),
+    (2_000_000, 'ivf_flat'),
+]
+
+# How vectors are coded inside the index: full float32 copies, or scalar-quantized codes
+# (2 or 1 bytes per dimension) that the engine re-ranks against its float32 working copy
+VECTOR_STORAGES = ('float32', 'float16', 'int8')
+SQ_TYPES = {'float16': 'QT_fp16', 'int8': 'QT_8bit'}
+# Approximate per-entry cost of IndexIDMap2's id vector and reverse hash map
+ID_MAP_ENTRY_BYTES = 48
+
+def scalar_quantizer(storage: str):
+    """FAISS ScalarQuantizer type for a compressed storage, None for float32"""
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"Unknown vector storage '{storage}'. Choose from: {', '.join(VECTOR_STORAGES)}")
+    return getattr(faiss.ScalarQuantizer, SQ_TYPES[storage]) if storage in SQ_TYPES else None
+
+def bitmap_selector(mask: np.ndarray):
+    """FAISS selector admitting the ids where mask is True.
+    
+    Returns (selector, bits); FAISS only borrows bits, so keep it referenced while searching.
+    """
+    bits = np.packbits(np.asarray(mask, dtype=bool), bitorder='little')
+    return faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bits)), bits
+
+def select_backend(n_vectors: int) -> str:
+    """Pick an index backend for a corpus of n_vectors chunks"""
+    for limit, name in AUTO_THRESHOLDS:
+        if n_vectors < limit:
+            return name
+    return 'ivf_pq'
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Return a contiguous float32 copy scaled to unit length, so inner product is cosine"""
+    vectors = np.array(vectors, dtype=np.float32, order='C', copy=True)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+class IndexBackend:
+    """Cosine-similarity vector index keyed by int64 chunk ids.
+    
+    Subclasses wrap one FAISS index type. Vectors passed in must already be
+    L2-normalized; scores returned by search are inner products (cosine).
+    The ``storage`` param picks float32 vectors or float16/int8 scalar-quantized
+    codes; int8 codes learn per-dimension ranges from the training vectors.
+    """
+    name = 'base'
+    retrain_growth = 8
+    
+    def __init__(self, dimension: int, storage: str = 'float32', **params):
+        self.dimension = dimension
+        self.params = dict(params, storage=storage)
+        self.index = None
+        self.trained_on = 0
+    
+    @property
+    def storage(self) -> str:
+        return self.params.get('storage', 'float32')
+    
+    @property
+    def compressed(self) -> bool:
+        """Whether search scores come from lossy codes rather than the vectors themselves"""
+        return self.storage != 'float32'
+    
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal if self.index is not None else 0
+    
+    def is_trained(self) -> bool:
+        return self.index is not None and self.index.is_trained
+    
+    def train(self, vectors: np.ndarray):
+        """Fit any coarse quantizer / codebooks; flat and graph indexes only fit int8 code ranges"""
+        if not self.index.is_trained:
+            self.index.train(vectors)
+            self.trained_on = len(vectors)
+    
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        self.index.add_with_ids(vectors, ids.astype(np.int64))
+    
+    def remove(self, ids: np.ndarray):
+        self.index.remove_ids(ids.astype(np.int64))
+    
+    def needs_rebuild(self, n_vectors: int) -> bool:
+        """Whether the index should be rebuilt (e.g. retrained) for a corpus of this size"""
+        return self.trained_on > 0 and n_vectors > self.retrain_growth * self.trained_on
+    
+    def set_params(self, **params):
+        """Update search-time tuning knobs"""
+        self.params.update(params)
+    
+    def state(self) -> Dict:
+        """Extra Python-side state that must be saved alongside the FAISS index"""
+        return {'trained_on': self.trained_on}
+    
+    def restore_state(self, state: Dict):
+        self.trained_on = state.get('trained_on', 0)
+    
+    def memory_bytes(self) -> int:
+        """Approximate memory held by the FAISS index: codes, id maps, graph links and centroids"""
+        index = faiss.downcast_index(self.index)
+        total = 0
+        if isinstance(index, faiss.IndexIDMap2):
+            total += index.ntotal * ID_MAP_ENTRY_BYTES
+            index = faiss.downcast_index(index.index)
+        if isinstance(index, faiss.IndexHNSW):
+            total += 4 * index.hnsw.neighbors.size() + 12 * index.ntotal  # links, levels, offsets
+            index = faiss.downcast_index(index.storage)
+        if isinstance(index, faiss.IndexIVF):
+            total += 8 * index.ntotal + 4 * index.nlist * self.dimension  # list ids, centroids
+        return total + index.ntotal * index.code_size
+    
+    def search_parameters(self, selector=None):
+        """Build FAISS search parameters; returns (params, objects to keep alive)"""
+        if selector is None:
+            return None, []
+        return faiss.SearchParameters(sel=selector), [selector]
+    
+    def search(self, queries: np.ndarray, k: int, selector=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (scores, ids) arrays of shape (n_queries, k); missing hits have id -1"""
+        # FAISS only borrows selectors, so keep them referenced for the duration of the call
+        params, keep_alive = self.search_parameters(selector)
+        if params is None:
+            return self.index.search(queries, k)
+        return self.index.search(queries, k, params=params)
+
+class FlatBackend(IndexBackend):
+    """Exact search; cost is linear in corpus size"""
+    name = 'flat'
+    
+    def __init__(self, dimension: int, **params):
+        super().__init__(dimension, **params)
+        qtype = scalar_quantizer(self.storage)
+        if qtype is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_INNER_PRODUCT))
+
+class HNSWBackend(IndexBackend):
+    """Graph index; knobs: M (build), ef_construction (build), ef_search (query).
+    
+    HNSW cannot delete vectors, so removed ids are masked out at search time
+    until the owning engine compacts and rebuilds the index.
+    """
+    name = 'hnsw'
+    
+    def __init__(self, dimension: int, M: int = 32, ef_construction: int = 80, ef_search: int = 64, **params):
+        super().__init__(dimension, M=M, ef_construction=ef_construction, ef_search=ef_search, **params)
+        qtype = scalar_quantizer(self.storage)
+        if qtype is None:
+            hnsw = faiss.IndexHNSWFlat(dimension, M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            hnsw = faiss.IndexHNSWSQ(dimension, qtype, M, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = ef_construction
+        self.index = faiss.IndexIDMap2(hnsw)
+        self.removed = set()
+    
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal - len(self.removed)
+    
+    def remove(self, ids: np.ndarray):
+        self.removed.update(int(i) for i in ids)
+    
+    def state(self) -> Dict:
+        return dict(super().state(), removed=sorted(self.removed))
+    
+    def restore_state(self, state: Dict):
+        super().restore_state(state)
+        self.removed = set(state.get('removed', []))
+    
+    def search_parameters(self, selector=None):
+        keep_alive = []
+        if self.removed:
+            removed = faiss.IDSelectorBatch(np.fromiter(self.removed, dtype=np.int64))
+            not_removed = faiss.IDSelectorNot(removed)
+            keep_alive += [removed, not_removed]
+            selector = not_removed if selector is None else faiss.IDSelectorAnd(selector, not_removed)
+        params = faiss.SearchParametersHNSW(efSearch=self.params['ef_search'])
+        if selector is not None:
+            params.sel = selector
+            keep_alive.append(selector)
+        return params, keep_alive
+
+class IVFBackend(IndexBackend):
+    """Inverted-file index; knobs: nlist (build), nprobe (query).
+    
+    nlist defaults to about 4 * sqrt(n) of the training set. Once the corpus
+    grows well past what the quantizer was trained on, needs_rebuild asks the
+    engine to retrain.
+    """
+    name = 'ivf_flat'
+    
+    def __init__(self, dimension: int, nlist: Optional[int] = None, nprobe: int = 16, **params):
+        super().__init__(dimension, nlist=nlist, nprobe=nprobe, **params)
+    
+    def _make_index(self, quantizer, nlist: int):
+        qtype = scalar_quantizer(self.storage)
+        if qtype is None:
+            return faiss.IndexIVFFlat(quantizer, self.dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexIVFScalarQuantizer(quantizer, self.dimension, nlist, qtype, faiss.METRIC_INNER_PRODUCT)
+    
+    def min_training_size(self) -> int:
+        return 1
+    
+    def train(self, vectors: np.ndarray):
+        n = len(vectors)
+        nlist = self.params['nlist'] or int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n // 39 or 1))  # FAISS wants ~39 points per centroid
+        self.quantizer = faiss.IndexFlatIP(self.dimension)
+        self.index = self._make_index(self.quantizer, nlist)
+        self.index.train(vectors)
+        self.trained_on = n
+    
+    def needs_rebuild(self, n_vectors: int) -> bool:
+        return n_vectors > self.retrain_growth * max(self.trained_on, self.min_training_size())
+    
+    def search_parameters(self, selector=None):
+        params = faiss.SearchParametersIVF(nprobe=self.params['nprobe'])
+        if selector is not None:
+            params.sel = selector
+        return params, [selector]
+
+class IVFPQBackend(IVFBackend):
+    """IVF with product-quantized codes; knobs as IVF plus m (sub-quantizers) and nbits.
+    
+    Always compressed, whatever the storage param says.
+    """
+    name = 'ivf_pq'
+    
+    @property
+    def compressed(self) -> bool:
+        return True
+    
+    def __init__(self, dimension: int, nlist: Optional[int] = None, nprobe: int = 16,
+                 m: Optional[int] = None, nbits: int = 8, **params):
+        super().__init__(dimension, nlist=nlist, nprobe=nprobe, **params)
+        if m is None:
+            # Largest divisor of the dimension giving sub-vectors of at least 8 dims
+            m = max(d for d in range(1, dimension // 8 + 1) if dimension % d == 0) if dimension >= 8 else 1
+        self.params.update(m=m, nbits=nbits)
+    
+    def min_training_size(self) -> int:
+        return 2 ** self.params['nbits'] * 39
+    
+    def train(self, vectors: np.ndarray):
+        # PQ needs at least one training point per codeword
+        while self.params['nbits'] > 1 and len(vectors) < 2 ** self.params['nbits']:
+            self.params['nbits'] -= 1
+        super().train(vectors)
+    
+    def _make_index(self, quantizer, nlist: int):
+        return faiss.IndexIVFPQ(quantizer, self.dimension, nlist, self.params['m'],
+                                self.params['nbits'], faiss.METRIC_INNER_PRODUCT)
+
+BACKENDS = {
+    'flat': FlatBackend,
+    'hnsw': HNSWBackend,
+    'ivf_flat': IVFBackend,
+    'ivf_pq': IVFPQBackend,
+}
+
+def create_backend(name: str, dimension: int, **params) -> IndexBackend:
+    """Instantiate a backend by name ('flat', 'hnsw', 'ivf_flat', 'ivf_pq')"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown index backend '{name}'. Choose from: {', '.join(BACKENDS)}")
+    return BACKENDS[name](dimension, **params)
+
+def build_backend(name: str, vectors: np.ndarray, ids: np.ndarray, **params) -> IndexBackend:
+    """Create, train and fill a backend in one go"""
+    backend = create_backend(name, vectors.shape[1], **params)
+    backend.train(vectors)
+    backend.add(vectors, ids)
+    return backend
+
+def save_backend(backend: IndexBackend, path: str) -> Dict:
+    """Write the FAISS index to path; returns the metadata needed to load it back"""
+    faiss.write_index(backend.index, path)
+    return {
+        'name': backend.name,
+        'dimension': backend.dimension,
+        'params': backend.params,
+        'state': backend.state(),
+    }
+
+def load_backend(meta: Dict, path: str, mmap: bool = True) -> IndexBackend:
+    """Load a backend written by save_backend.
+    
+    With mmap=True the index data is mapped read-only from disk instead of
+    copied into memory, so processes loading the same file share its pages.
+    Such an index cannot be modified.
+    """
+    flags = 0
+    if mmap:
+        flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+    index = faiss.read_index(path, flags)
+    
+    cls = BACKENDS[meta['name']]
+    backend = cls.__new__(cls)
+    IndexBackend.__init__(backend, meta['dimension'], **meta['params'])
+    backend.index = index
+    backend.restore_state(meta['state'])
+    return backend
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                  configs: Optional[List[Tuple[str, Dict]]] = None) -> List[Dict]:
+    """Measure recall@k and per-query latency of ANN backends against exact search.
+    
+    ``vectors`` and ``queries`` must be normalized. ``configs`` is a list of
+    (backend name, params) pairs; by default it sweeps the main search knob of
+    each approximate backend.
+    """
+    if configs is None:
+        configs = [('flat', {})]
+        configs += [('flat', {'storage': storage}) for storage in ('float16', 'int8')]
+        configs += [('hnsw', {'ef_search': ef}) for ef in (16, 32, 64, 128)]
+        configs += [('ivf_flat', {'nprobe': p}) for p in (1, 4, 16, 64)]
+        configs += [('ivf_pq', {'nprobe': p}) for p in (1, 4, 16, 64)]
+        configs += [('hnsw', {'storage': 'int8', 'ef_search': ef}) for ef in (32, 128)]
+    
+    ids = np.arange(len(vectors), dtype=np.int64)
+    exact = FlatBackend(vectors.shape[1])
+    exact.add(vectors, ids)
+    _, truth = exact.search(queries, k)
+    
+    report = []
+    built = {}
+    for name, params in configs:
+        # Reuse a built index across search-only knob changes
+        build_params = {key: value for key, value in params.items() if key not in ('ef_search', 'nprobe')}
+        cache_key = (name, tuple(sorted(build_params.items())))
+        if cache_key not in built:
+            start = time.perf_counter()
+            built[cache_key] = (build_backend(name, vectors, ids, **build_params), time.perf_counter() - start)
+        backend, build_seconds = built[cache_key]
+        backend.set_params(**params)
+        
+        start = time.perf_counter()
+        _, found = backend.search(queries, k)
+        elapsed = time.perf_counter() - start
+        
+        hits = sum(len(set(found[i][found[i] >= 0]) & set(truth[i])) for i in range(len(queries)))
+        report.append({
+            'backend': name,
+            'params': params,
+            'recall_at_k': hits / float(k * len(queries)),
+            'latency_ms_per_query': 1000 * elapsed / max(1, len(queries)),
+            'build_seconds': build_seconds,
+        })
+    return report
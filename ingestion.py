@@ -0,0 +1,250 @@
+"""Background PDF ingestion.
+
+An IngestionWorker owns one daemon thread that takes jobs from a queue and
+indexes their files one at a time: extract and chunk, then encode and add in
+batches of the engine's encode_batch_size. Each batch is searchable as soon
+as it is added, so the first document can be queried while later ones are
+still processing. Jobs report per-file and per-stage progress through
+snapshot() and can be cancelled between batches; files already indexed when
+a job is cancelled stay in the index, the interrupted file is rolled back.
+Finished jobs drop their file bytes, and only the most recent ones are kept.
+"""
+import io
+import itertools
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+import PyPDF2
+
+from chunk_store import ChunkStore
+from instrumentation import get_logger, metrics
+
+logger = get_logger(__name__)
+
+# Job states; a job ends in one of the last three
+JOB_STATES = ('queued', 'running', 'done', 'cancelled', 'failed')
+# Per-file stages, in order
+FILE_STAGES = ('queued', 'extracting', 'embedding', 'indexed', 'empty', 'cancelled', 'failed')
+# Finished jobs an IngestionWorker keeps for snapshot() by default
+KEEP_FINISHED_JOBS = 100
+
+class UploadedPDF(io.BytesIO):
+    """In-memory copy of an upload, so the job does not depend on the caller's file object"""
+    
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+class IngestionJob:
+    """One batch of files submitted together"""
+    _ids = itertools.count(1)
+    
+    def __init__(self, files: List[UploadedPDF], encode_batch_size: int, metadata: Optional[Dict[str, Dict]] = None):
+        self.id = next(self._ids)
+        self.files = files  # emptied once the job finishes, so the uploads can be freed
+        self.file_names = [f.name for f in files]
+        self.encode_batch_size = encode_batch_size
+        self.metadata = metadata or {}  # file name -> document metadata
+        self.state = 'queued'
+        self.progress = {f.name: {'stage': 'queued', 'pages': 0, 'page_count': None, 'chunks': 0} for f in files}
+        self.errors: List[Dict] = []
+        self.submitted_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+    
+    def cancel(self):
+        """Ask the worker to stop after the current batch"""
+        self._cancel.set()
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+    
+    @property
+    def finished(self) -> bool:
+        return self.state in ('done', 'cancelled', 'failed')
+    
+    def _update(self, name: str, **fields):
+        with self._lock:
+            self.progress[name].update(fields)
+    
+    def _release_files(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+    
+    def _add_errors(self, errors: List[Dict]):
+        with self._lock:
+            self.errors.extend(errors)
+    
+    def snapshot(self) -> Dict:
+        """Consistent copy of the job's state for display"""
+        with self._lock:
+            files = {name: dict(entry) for name, entry in self.progress.items()}
+            errors = list(self.errors)
+        done = sum(entry['stage'] in ('indexed', 'empty', 'cancelled', 'failed') for entry in files.values())
+        return {
+            'id': self.id,
+            'state': self.state,
+            'files': files,
+            'errors': errors,
+            'files_done': done,
+            'files_total': len(files),
+            'chunks': sum(entry['chunks'] for entry in files.values()),
+            'elapsed': (self.finished_at or time.time()) - self.submitted_at,
+        }
+
+class IngestionWorker:
+    """Runs ingestion jobs for one engine on a background thread, in submission order"""
+    
+    def __init__(self, engine, processor, save_path: Optional[str] = None, keep_finished: int = KEEP_FINISHED_JOBS):
+        self.engine = engine
+        self.processor = processor
+        self.save_path = save_path  # where to save the index after each job, if anywhere
+        self.keep_finished = keep_finished  # finished jobs kept for snapshot(); older ones are forgotten
+        self.jobs: List[IngestionJob] = []  # replaced, never mutated, so readers can iterate without a lock
+        self._jobs_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+    
+    def submit(self, files, encode_batch_size: Optional[int] = None,
+               metadata: Optional[Dict[str, Dict]] = None) -> IngestionJob:
+        """Queue files (objects with .name and .read()) for ingestion; returns the job.
+        
+        metadata maps file names to document metadata (e.g. {'course': 'CS101'}) searches can filter on.
+        """
+        copies = []
+        for f in files:
+            f.seek(0)
+            copies.append(UploadedPDF(f.name, f.read()))
+        job = IngestionJob(copies, encode_batch_size or self.engine.encode_batch_size, metadata)
+        with self._jobs_lock:
+            self.jobs = self.jobs + [job]
+        self._queue.put(job)
+        self._ensure_thread()
+        return job
+    
+    def cancel(self, job_id: Optional[int] = None):
+        """Cancel one job, or every unfinished job"""
+        for job in self.jobs:
+            if job_id is None or job.id == job_id:
+                job.cancel()
+    
+    def active_jobs(self) -> List[IngestionJob]:
+        return [job for job in self.jobs if not job.finished]
+    
+    def pending_files(self) -> List[str]:
+        """Names of files in unfinished jobs"""
+        return [name for job in self.active_jobs() for name in job.file_names]
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until every submitted job has finished; False on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.active_jobs():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+    
+    def _ensure_thread(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="studymate-ingestion", daemon=True)
+                self._thread.start()
+    
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run_job(job)
+            except Exception as e:
+                logger.exception("Ingestion job %d failed", job.id)
+                job._add_errors([{'file': None, 'pages': None, 'error': str(e)}])
+                job.state = 'failed'
+            finally:
+                job._release_files()
+                job.finished_at = time.time()
+                self._prune_jobs()
+                self._queue.task_done()
+    
+    def _prune_jobs(self):
+        """Forget the oldest finished jobs beyond keep_finished"""
+        with self._jobs_lock:
+            finished = [job for job in self.jobs if job.finished]
+            if len(finished) > self.keep_finished:
+                dropped = set(id(job) for job in finished[:len(finished) - self.keep_finished])
+                self.jobs = [job for job in self.jobs if id(job) not in dropped]
+    
+    def _run_job(self, job: IngestionJob):
+        if job.cancelled:
+            for f in job.files:
+                job._update(f.name, stage='cancelled')
+            job.state = 'cancelled'
+            return
+        
+        job.state = 'running'
+        with metrics.timer('ingest_total'):
+            for f in job.files:
+                if job.cancelled:
+                    job._update(f.name, stage='cancelled')
+                    continue
+                self._ingest_file(job, f)
+        
+        with self.engine.lock:
+            self.engine.chunks.trim()
+        if self.save_path and self.engine.chunks.live_count:
+            self.engine.save(self.save_path)
+        job.state = 'cancelled' if job.cancelled else 'done'
+        logger.info("Ingestion job %d %s in %.1fs", job.id, job.state, time.time() - job.submitted_at)
+    
+    def _ingest_file(self, job: IngestionJob, pdf_file: UploadedPDF):
+        name = pdf_file.name
+        try:
+            page_count = len(PyPDF2.PdfReader(pdf_file).pages)
+        except Exception:
+            page_count = None  # the processor reports the error
+        job._update(name, stage='extracting', page_count=page_count)
+        # A re-uploaded file replaces its previous version
+        self.engine.remove_document(name)
+        if name in job.metadata:
+            self.engine.set_document_metadata(name, job.metadata[name])
+        
+        added = 0
+        batch = ChunkStore()
+        try:
+            for chunk in self.processor.iter_pdf_chunks([pdf_file]):
+                batch.append(chunk)
+                job._update(name, pages=chunk.get('page_end') or chunk.get('page') or 0)
+                if len(batch) >= job.encode_batch_size:
+                    added += self._add_batch(job, name, batch)
+                    batch = ChunkStore()
+                    if job.cancelled:
+                        break
+            if len(batch) and not job.cancelled:
+                added += self._add_batch(job, name, batch)
+        except Exception as e:
+            logger.exception("Error ingesting %s", name)
+            self.engine.remove_document(name)
+            job._add_errors([{'file': name, 'pages': None, 'error': str(e)}])
+            job._update(name, stage='failed', chunks=0)
+            return
+        job._add_errors(self.processor.errors)
+        
+        if job.cancelled:
+            # Roll back the partly indexed file; earlier files stay searchable
+            self.engine.remove_document(name)
+            job._update(name, stage='cancelled', chunks=0)
+        else:
+            job._update(name, stage='indexed' if added else 'empty')
+    
+    def _add_batch(self, job: IngestionJob, name: str, batch: ChunkStore) -> int:
+        job._update(name, stage='embedding')
+        self.engine.add_documents(batch, replace=False)
+        with job._lock:
+            job.progress[name]['chunks'] += len(batch)
+            job.progress[name]['stage'] = 'extracting'
+        return len(batch)
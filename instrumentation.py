@@ -0,0 +1,129 @@
+"""Leveled logging and per-stage latency metrics.
+
+Modules log through get_logger(__name__) with lazy %-formatting, so a
+disabled level costs one integer comparison. Stage timings and counters go
+to the process-wide ``metrics`` object, which keeps a bounded window of
+recent samples per stage and reports p50/p95 for the in-app panel and for
+machine-readable export.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Stage names used across the pipeline, in pipeline order
+STAGES = (
+    'extraction', 'cleaning', 'chunking', 'embedding', 'index_build',
+    'queue_wait', 'search', 'qa_inference', 'ingest_total', 'answer_total',
+)
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"studymate.{name}")
+
+def configure_logging(level: Optional[str] = None):
+    """Set the studymate log level (default from STUDYMATE_LOG_LEVEL, else WARNING)"""
+    level = (level or os.getenv("STUDYMATE_LOG_LEVEL", "WARNING")).upper()
+    root = logging.getLogger("studymate")
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        root.addHandler(handler)
+        root.propagate = False
+    root.setLevel(level)
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def hit_rates(counters: Dict[str, int]) -> Dict[str, float]:
+    """hits / (hits + misses) for every '<cache>_hits' counter with a '<cache>_misses' partner"""
+    rates = {}
+    for name, hits in counters.items():
+        if name.endswith('_hits') and name[:-len('_hits')] + '_misses' in counters:
+            cache = name[:-len('_hits')]
+            lookups = hits + counters[cache + '_misses']
+            rates[cache] = hits / lookups if lookups else 0.0
+    return rates
+
+class Metrics:
+    """Thread-safe stage timings (seconds) and counters"""
+    
+    def __init__(self, window: int = 2000):
+        self.window = window
+        self.enabled = os.getenv("STUDYMATE_METRICS", "1") != "0"
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = {}
+        self._totals: Counter = Counter()
+        self._counts: Counter = Counter()
+        self.counters: Counter = Counter()
+    
+    def record(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            self._totals[stage] += seconds
+            self._counts[stage] += 1
+    
+    def incr(self, name: str, amount: int = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += amount
+    
+    @contextmanager
+    def timer(self, stage: str):
+        """Time the enclosed block as one sample of stage"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+    
+    def summary(self) -> Dict:
+        """Per-stage count / mean / p50 / p95 / max (ms, over the recent window), counters and cache hit rates"""
+        with self._lock:
+            samples = {stage: sorted(values) for stage, values in self._samples.items()}
+            totals, counts, counters = dict(self._totals), dict(self._counts), dict(self.counters)
+        
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        stages = {}
+        for stage in sorted(samples, key=lambda name: (order.get(name, len(order)), name)):
+            values = samples[stage]
+            stages[stage] = {
+                'count': counts[stage],
+                'total_ms': 1000 * totals[stage],
+                'mean_ms': 1000 * sum(values) / len(values),
+                'p50_ms': 1000 * percentile(values, 0.50),
+                'p95_ms': 1000 * percentile(values, 0.95),
+                'max_ms': 1000 * values[-1],
+            }
+        return {'stages': stages, 'counters': counters, 'hit_rates': hit_rates(counters)}
+    
+    def export_json(self) -> str:
+        data = self.summary()
+        data['timestamp'] = time.time()
+        return json.dumps(data, indent=2)
+    
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._totals.clear()
+            self._counts.clear()
+            self.counters.clear()
+
+metrics = Metrics()
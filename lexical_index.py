@@ -0,0 +1,141 @@
+import re
+import numpy as np
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; keeps codes like 'cs101' and 'h2so4' intact"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+class BM25Index:
+    """Inverted index with BM25 scoring over compact array-backed postings.
+    
+    Postings are stored CSR-style in segments: in a segment, the documents
+    containing term t are posting_docs[term_offsets[t]:term_offsets[t + 1]],
+    with matching term frequencies in posting_tfs. add() tokenizes only the
+    new documents into a segment of their own, then merges trailing segments
+    while the newest is at least as large as the one before it, which keeps
+    O(log n) segments at an amortized O(log n) merges per posting. Document
+    frequencies and the average length are kept over all segments.
+    Document ids are the caller's ids (the retrieval engine's chunk ids), so
+    results line up with dense search.
+    """
+    
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: Dict[str, int] = {}
+        self.segments: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []  # (term_offsets, posting_docs, posting_tfs)
+        self.segment_sizes: List[int] = []  # documents per segment
+        self.df = np.zeros(0, dtype=np.int64)
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self.avg_doc_length = 0.0
+    
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+    
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the posting and per-document arrays (the vocabulary dict is not counted)"""
+        postings = sum(array.nbytes for segment in self.segments for array in segment)
+        return postings + sum(array.nbytes for array in (self.df, self.idf, self.doc_ids, self.doc_lengths))
+    
+    def build(self, texts: Sequence[str], doc_ids: Sequence[int]):
+        """Index texts from scratch; doc_ids[i] is the id reported for texts[i]"""
+        self.vocabulary = {}
+        self.segments, self.segment_sizes = [], []
+        self.df = np.zeros(0, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        self.doc_lengths = np.zeros(0, dtype=np.float32)
+        self.add(texts, doc_ids)
+    
+    def add(self, texts: Sequence[str], doc_ids: Sequence[int]):
+        """Index more texts; only they are tokenized"""
+        if not len(texts):
+            return
+        base = len(self.doc_ids)
+        term_ids, rows, tfs = [], [], []
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_lengths[row] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                rows.append(base + row)
+                tfs.append(tf)
+        
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind='stable')  # keeps each posting list in row order
+        df = np.bincount(term_ids, minlength=len(self.vocabulary))
+        self.segments.append((np.concatenate([[0], np.cumsum(df)]).astype(np.int64),
+                              np.asarray(rows, dtype=np.int32)[order], np.asarray(tfs, dtype=np.float32)[order]))
+        self.segment_sizes.append(len(texts))
+        while len(self.segments) > 1 and self.segment_sizes[-1] >= self.segment_sizes[-2]:
+            self._merge_last_segments()
+        
+        self.df = np.concatenate([self.df, np.zeros(len(df) - len(self.df), dtype=np.int64)]) + df
+        self.doc_ids = np.concatenate([self.doc_ids, np.asarray(doc_ids, dtype=np.int64)])
+        self.doc_lengths = np.concatenate([self.doc_lengths, doc_lengths])
+        n_docs = len(self.doc_ids)
+        self.idf = np.log1p((n_docs - self.df + 0.5) / (self.df + 0.5)).astype(np.float32)
+        self.avg_doc_length = float(self.doc_lengths.mean())
+    
+    def _merge_last_segments(self):
+        """Replace the last two segments with one"""
+        merged_terms, merged_docs, merged_tfs = [], [], []
+        for term_offsets, posting_docs, posting_tfs in self.segments[-2:]:
+            merged_terms.append(np.repeat(np.arange(len(term_offsets) - 1), np.diff(term_offsets)))
+            merged_docs.append(posting_docs)
+            merged_tfs.append(posting_tfs)
+        terms = np.concatenate(merged_terms)
+        order = np.argsort(terms, kind='stable')  # the older segment's rows come first, so lists stay in row order
+        counts = np.bincount(terms, minlength=len(self.segments[-1][0]) - 1)
+        merged = (np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                  np.concatenate(merged_docs)[order], np.concatenate(merged_tfs)[order])
+        self.segments[-2:] = [merged]
+        self.segment_sizes[-2:] = [sum(self.segment_sizes[-2:])]
+    
+    def score(self, query: str) -> np.ndarray:
+        """BM25 score of every indexed document for query (0 where no term matches)"""
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        if not len(self.doc_ids):
+            return scores
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(self.avg_doc_length, 1e-9))
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            for term_offsets, posting_docs, posting_tfs in self.segments:
+                if term_id + 1 >= len(term_offsets):
+                    continue  # term first seen in a later segment
+                start, end = term_offsets[term_id], term_offsets[term_id + 1]
+                rows = posting_docs[start:end]
+                tf = posting_tfs[start:end]
+                scores[rows] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + length_norm[rows])
+        return scores
+    
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (scores, doc_ids) of the top-k matching documents, best first.
+        
+        allowed is an optional boolean mask indexed by doc id; other documents never match.
+        """
+        scores = self.score(query)
+        if allowed is not None:
+            scores[~allowed[self.doc_ids]] = 0
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind='stable')]
+        return scores[matched], self.doc_ids[matched]
+
+def reciprocal_rank_fusion(rankings: List[Sequence[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fuse several best-first id lists: score(id) = sum over lists of 1 / (k + rank)"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[int(doc_id)] = fused.get(int(doc_id), 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])
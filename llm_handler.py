@@ -1,64 +1,97 @@
-from transformers import pipeline, AutoTokenizer, AutoModelForQuestionAnswering
-from transformers import T5ForConditionalGeneration, T5Tokenizer
-import torch
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import os
+import numpy as np
 from dotenv import load_dotenv
+from model_registry import default_precision, get_pipeline, resolve_precision
+from instrumentation import get_logger, metrics
 
 load_dotenv()
 
+logger = get_logger(__name__)
+
+# Registry coordinates of the default extractive model (see model_registry.pipeline_key)
+QA_TASK = "question-answering"
+QA_MODEL = "distilbert-base-cased-distilled-squad"
+QA_PIPELINE_KWARGS = {'device': -1}
+
+# 'joined' truncates and concatenates chunks and lets the pipeline window them;
+# 'packed' tokenizes each chunk once and packs whole chunks into model-sized windows
+QA_CONTEXT_MODES = ('joined', 'packed')
+QA_MAX_SEQ_LEN = 384  # tokens per window, as the transformers QA pipeline uses
+QA_DOC_STRIDE = 128  # overlap when a single chunk is longer than a window
+QA_MAX_ANSWER_TOKENS = 15
+
 class FastHuggingFaceHandler:
-    def __init__(self):
-        """Initialize with a fast, lightweight model"""
+    def __init__(self, lazy: bool = True, precision: Optional[str] = None, qa_context: Optional[str] = None):
+        """Initialize with a fast, lightweight model.
+        
+        The pipeline comes from the process-wide model registry, so every
+        session shares one copy. With lazy=True (default) it is only loaded
+        on the first question. precision is 'fp32' or 'int8' (dynamic
+        quantization); None reads STUDYMATE_PRECISION. qa_context is one of
+        QA_CONTEXT_MODES; None reads STUDYMATE_QA_CONTEXT (default 'joined').
+        """
+        self.precision = resolve_precision(precision) if precision else default_precision()
+        self.qa_context = (qa_context or os.getenv("STUDYMATE_QA_CONTEXT", "joined")).lower()
+        if self.qa_context not in QA_CONTEXT_MODES:
+            raise ValueError(f"Unknown QA context mode '{self.qa_context}'. Choose from: {', '.join(QA_CONTEXT_MODES)}")
         self.model_type = "qa"
-        self.setup_qa_model()
+        self._qa_pipeline = None
+        self.loaded = False
+        if not lazy:
+            self.setup_qa_model()
+    
+    @property
+    def model_version(self) -> str:
+        """Identifies what produces the answers, so cached answers of another model or setting are not reused"""
+        return f"{QA_MODEL}@{self.precision}/{self.qa_context}/{self.model_type}"
+    
+    @property
+    def qa_pipeline(self):
+        """The shared pipeline, loading it on first access"""
+        if not self.loaded:
+            self.setup_qa_model()
+        return self._qa_pipeline
     
     def setup_qa_model(self):
         """Setup extractive Q&A model (fastest option)"""
         try:
-            print("Loading fast Q&A model...")
-            self.qa_pipeline = pipeline(
-                "question-answering",
-                model="distilbert-base-cased-distilled-squad",
-                device=-1
-            )
+            logger.info("Loading fast Q&A model...")
+            self._qa_pipeline = get_pipeline(QA_TASK, QA_MODEL, self.precision, **QA_PIPELINE_KWARGS)
             self.model_type = "qa"
-            print("✅ Fast Q&A model loaded successfully!")
+            self.loaded = True
+            logger.info("Fast Q&A model loaded")
         except Exception as e:
-            print(f"❌ Q&A model failed: {e}")
+            logger.error("Q&A model failed: %s", e)
             self.setup_simple_fallback()
     
     def setup_simple_fallback(self):
         """Simple text generation fallback"""
         try:
-            print("Loading fallback model...")
-            self.qa_pipeline = pipeline(
+            logger.info("Loading fallback model...")
+            self._qa_pipeline = get_pipeline(
                 "text2text-generation",
-                model="google/flan-t5-small",
+                "google/flan-t5-small",
+                self.precision,
                 device=-1,
                 max_length=200
             )
             self.model_type = "fallback"
-            print("✅ Fallback model loaded!")
+            logger.info("Fallback model loaded")
         except Exception as e:
-            print(f"❌ All models failed: {e}")
-            self.qa_pipeline = None
+            logger.error("All models failed: %s", e)
+            self._qa_pipeline = None
             self.model_type = "none"
+        self.loaded = True
     
     def generate_answer(self, query: str, context_chunks: List[Dict]) -> str:
         """Generate answer using the loaded model"""
-        print(f"🤖 DEBUG: LLM generate_answer called")
-        print(f"🤖 DEBUG: Query: {query}")
-        print(f"🤖 DEBUG: Number of context chunks: {len(context_chunks)}")
+        logger.debug("generate_answer: query=%r, %d context chunks", query, len(context_chunks))
         
         if not context_chunks:
-            print("❌ DEBUG: No context chunks provided to LLM!")
+            logger.warning("No context chunks provided to LLM")
             return "No relevant context found in documents. Please check if PDFs were processed correctly."
         
-        # Print context for debugging
-        for i, chunk in enumerate(context_chunks):
-            print(f"🤖 DEBUG: Chunk {i}: {chunk['text'][:100]}...")
-        
         if not hasattr(self, 'qa_pipeline') or not self.qa_pipeline:
             return "❌ Model not available. Please restart the application."
         
@@ -69,68 +102,302 @@ class FastHuggingFaceHandler:
                 return self.fallback_answer(query, context_chunks)
         except Exception as e:
             error_msg = f"Error generating answer: {str(e)}"
-            print(f"❌ DEBUG: {error_msg}")
+            logger.error(error_msg)
             return error_msg
     
+    def generate_answers(self, queries: List[str], contexts: List[List[Dict]], batch_size: int = 16) -> List[str]:
+        """Answer many questions with batched model calls; answers follow the input order"""
+        if len(queries) != len(contexts):
+            raise ValueError("generate_answers needs one context list per query")
+        
+        answers = [None] * len(queries)
+        if not hasattr(self, 'qa_pipeline') or not self.qa_pipeline:
+            return ["❌ Model not available. Please restart the application."] * len(queries)
+        
+        if self.model_type == "qa" and self._uses_packing():
+            try:
+                results = self.packed_qa_results(queries, contexts, batch_size)
+            except Exception as e:
+                error_msg = f"Error generating answer: {str(e)}"
+                logger.error(error_msg)
+                return [error_msg] * len(queries)
+            for i, (result, context_chunks) in enumerate(zip(results, contexts)):
+                if result:
+                    answers[i] = self._format_qa_answer(result)
+                elif not context_chunks:
+                    answers[i] = "No relevant context found in documents. Please check if PDFs were processed correctly."
+                else:
+                    answers[i] = "No valid text found in the documents."
+            return answers
+        
+        # Questions without usable context are answered without touching the model
+        pending = []
+        for i, (query, context_chunks) in enumerate(zip(queries, contexts)):
+            if not context_chunks:
+                answers[i] = "No relevant context found in documents. Please check if PDFs were processed correctly."
+                continue
+            if self.model_type == "qa":
+                context = self._build_qa_context(context_chunks)
+                if context is None:
+                    answers[i] = "No valid text found in the documents."
+                    continue
+                pending.append((i, {'question': query, 'context': context}))
+            else:
+                pending.append((i, self._build_fallback_prompt(query, context_chunks)))
+        
+        if not pending:
+            return answers
+        
+        inputs = [item for _, item in pending]
+        try:
+            if self.model_type == "qa":
+                with metrics.timer('qa_inference'):
+                    results = self.qa_pipeline(inputs, batch_size=batch_size)
+                if isinstance(results, dict):  # a single input comes back unwrapped
+                    results = [results]
+                for (i, _), result in zip(pending, results):
+                    answers[i] = self._format_qa_answer(result)
+            else:
+                with metrics.timer('qa_inference'):
+                    results = self.qa_pipeline(inputs, batch_size=batch_size, max_length=150, temperature=0.7)
+                for (i, prompt), result in zip(pending, results):
+                    # List inputs come back as one dict per prompt rather than one list
+                    answers[i] = self._format_fallback_answer([result] if isinstance(result, dict) else result, prompt)
+        except Exception as e:
+            error_msg = f"Error generating answer: {str(e)}"
+            logger.error(error_msg)
+            for i, _ in pending:
+                answers[i] = error_msg
+        
+        return answers
+    
+    def _build_qa_context(self, context_chunks: List[Dict]) -> Optional[str]:
+        """Combine retrieved chunks into one QA context, or None if nothing usable"""
+        # Combine context more effectively
+        contexts = []
+        for chunk in context_chunks:
+            chunk_text = chunk['text'].strip()
+            if chunk_text and len(chunk_text) > 10:  # Only meaningful chunks
+                contexts.append(chunk_text[:400])  # Increased chunk size
+        
+        if not contexts:
+            return None
+        
+        # Better context combination
+        context = " ... ".join(contexts)
+        
+        # Increased context limit
+        if len(context) > 3000:  # Much higher limit
+            context = context[:3000] + "..."
+        return context
+    
+    def _format_qa_answer(self, result: Dict) -> str:
+        """Turn a QA pipeline result into the displayed answer"""
+        answer = result['answer'].strip()
+        confidence = result['score']
+        
+        logger.debug("Raw answer: %r, confidence %.4f", answer, confidence)
+        
+        # Much more lenient confidence threshold
+        if answer and len(answer) > 1 and confidence > 0.001:  # Very low threshold
+            # Clean up the answer
+            if len(answer) > 200:
+                answer = answer[:200] + "..."
+            return answer
+        else:
+            # Try to extract any relevant information
+            return f"Based on available text: {answer} (Low confidence - please verify)"
+    
     def qa_answer(self, query: str, context_chunks: List[Dict]) -> str:
         """Use extractive Q&A model with improved context handling"""
         try:
-            # Combine context more effectively
-            contexts = []
-            for chunk in context_chunks:
-                chunk_text = chunk['text'].strip()
-                if chunk_text and len(chunk_text) > 10:  # Only meaningful chunks
-                    contexts.append(chunk_text[:400])  # Increased chunk size
+            if self._uses_packing():
+                result = self.packed_qa_results([query], [context_chunks])[0]
+                return self._format_qa_answer(result) if result else "No valid text found in the documents."
             
-            if not contexts:
+            context = self._build_qa_context(context_chunks)
+            if context is None:
                 return "No valid text found in the documents."
             
-            # Better context combination
-            context = " ... ".join(contexts)
-            
-            # Increased context limit
-            if len(context) > 3000:  # Much higher limit
-                context = context[:3000] + "..."
-            
-            print(f"🤖 DEBUG: Final context ({len(context)} chars): {context[:200]}...")
-            
-            result = self.qa_pipeline(question=query, context=context)
-            answer = result['answer'].strip()
-            confidence = result['score']
+            logger.debug("Final context: %d chars", len(context))
             
-            print(f"🤖 DEBUG: Raw answer: '{answer}'")
-            print(f"🤖 DEBUG: Confidence: {confidence}")
-            
-            # Much more lenient confidence threshold
-            if answer and len(answer) > 1 and confidence > 0.001:  # Very low threshold
-                # Clean up the answer
-                if len(answer) > 200:
-                    answer = answer[:200] + "..."
-                return answer
-            else:
-                # Try to extract any relevant information
-                return f"Based on available text: {answer} (Low confidence - please verify)"
+            with metrics.timer('qa_inference'):
+                result = self.qa_pipeline(question=query, context=context)
+            return self._format_qa_answer(result)
                 
         except Exception as e:
-            print(f"❌ QA Error: {e}")
+            logger.error("QA Error: %s", e)
             return f"Error processing question: {str(e)}"
     
+    def _uses_packing(self) -> bool:
+        """Packed mode needs the pipeline's fast tokenizer (for offsets) and model"""
+        if self.qa_context != 'packed':
+            return False
+        tokenizer = getattr(self.qa_pipeline, 'tokenizer', None)
+        return getattr(tokenizer, 'is_fast', False) and hasattr(self.qa_pipeline, 'model')
+    
+    def _pack_windows(self, query: str, context_chunks: List[Dict]) -> List[Dict]:
+        """Tokenize each chunk once and pack whole chunks into windows of at most QA_MAX_SEQ_LEN tokens.
+        
+        Each window records its segments as (chunk index, first token, end
+        token, position in input_ids) so spans can be kept inside one chunk
+        and mapped back to characters through the offset mapping.
+        """
+        tokenizer = self.qa_pipeline.tokenizer
+        texts = [chunk['text'] for chunk in context_chunks if len(chunk['text'].strip()) > 10]
+        if not texts:
+            return []
+        
+        max_length = min(QA_MAX_SEQ_LEN, tokenizer.model_max_length)
+        # Where the context starts after the special tokens, whatever the model's layout
+        probe = tokenizer.build_inputs_with_special_tokens([-1], [-2])
+        question_ids = tokenizer(query, add_special_tokens=False)['input_ids'][:max_length // 2]
+        context_start = probe.index(-2) + len(question_ids) - 1
+        budget = max_length - (len(probe) - 2) - len(question_ids)
+        overlap = min(QA_DOC_STRIDE, budget // 2)
+        
+        encoded = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True)
+        pieces = []
+        for chunk_idx, ids in enumerate(encoded['input_ids']):
+            start = 0
+            while True:
+                end = min(start + budget, len(ids))
+                pieces.append((chunk_idx, start, end))
+                if end == len(ids):
+                    break
+                start = end - overlap
+        
+        groups, current, used = [], [], 0
+        for piece in pieces:
+            size = piece[2] - piece[1]
+            if current and used + size > budget:
+                groups.append(current)
+                current, used = [], 0
+            current.append(piece)
+            used += size
+        groups.append(current)
+        
+        use_token_types = 'token_type_ids' in tokenizer.model_input_names
+        windows = []
+        for group in groups:
+            context_ids, segments = [], []
+            for chunk_idx, start, end in group:
+                segments.append((chunk_idx, start, end, context_start + len(context_ids)))
+                context_ids += encoded['input_ids'][chunk_idx][start:end]
+            window = {
+                'input_ids': tokenizer.build_inputs_with_special_tokens(question_ids, context_ids),
+                'segments': segments,
+                'texts': texts,
+                'offsets': encoded['offset_mapping'],
+            }
+            if use_token_types:
+                window['token_type_ids'] = tokenizer.create_token_type_ids_from_sequences(question_ids, context_ids)
+            windows.append(window)
+        return windows
+    
+    def _run_qa_model(self, windows: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+        """One forward pass over padded windows; returns (start_logits, end_logits) of shape [n, max_len]"""
+        import torch
+        tokenizer, model = self.qa_pipeline.tokenizer, self.qa_pipeline.model
+        length = max(len(window['input_ids']) for window in windows)
+        input_ids = np.full((len(windows), length), tokenizer.pad_token_id or 0, dtype=np.int64)
+        attention_mask = np.zeros((len(windows), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(windows), length), dtype=np.int64)
+        for row, window in enumerate(windows):
+            n = len(window['input_ids'])
+            input_ids[row, :n] = window['input_ids']
+            attention_mask[row, :n] = 1
+            if 'token_type_ids' in window:
+                token_type_ids[row, :n] = window['token_type_ids']
+        
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in windows[0]:
+            inputs['token_type_ids'] = token_type_ids
+        with torch.inference_mode():
+            output = model(**{name: torch.from_numpy(value).to(model.device) for name, value in inputs.items()})
+        return output.start_logits.float().cpu().numpy(), output.end_logits.float().cpu().numpy()
+    
+    def _best_span(self, window: Dict, start_logits: np.ndarray, end_logits: np.ndarray) -> Dict:
+        """Highest-probability span inside a single chunk of the window.
+        
+        Start and end logits are softmaxed over the window's context tokens,
+        so scores are comparable across windows and with the pipeline's own
+        'score' (which _format_qa_answer thresholds).
+        """
+        length = len(window['input_ids'])
+        segment = np.full(length, -1)
+        for k, (_, start, end, position) in enumerate(window['segments']):
+            segment[position:position + end - start] = k
+        context = segment >= 0
+        
+        def softmax(logits):
+            logits = np.where(context, logits[:length], -1e4)
+            exp = np.exp(logits - logits.max())
+            return exp / exp.sum()
+        
+        scores = np.outer(softmax(start_logits), softmax(end_logits))
+        scores = np.tril(np.triu(scores), QA_MAX_ANSWER_TOKENS - 1)
+        scores *= (segment[:, None] == segment[None, :]) & context[:, None]
+        first, last = np.unravel_index(int(np.argmax(scores)), scores.shape)
+        
+        chunk_idx, token_start, _, position = window['segments'][segment[first]]
+        offsets = window['offsets'][chunk_idx]
+        char_start = offsets[token_start + first - position][0]
+        char_end = offsets[token_start + last - position][1]
+        return {
+            'answer': window['texts'][chunk_idx][char_start:char_end],
+            'score': float(scores[first, last]),
+            'start': int(char_start),
+            'end': int(char_end),
+        }
+    
+    def packed_qa_results(self, queries: List[str], contexts: List[List[Dict]], batch_size: int = 16) -> List[Optional[Dict]]:
+        """Answer spans for many questions from packed windows, best span across chunks per question.
+        
+        All windows of all questions go through the model in batches of
+        batch_size. Returns a pipeline-style result dict per question, or
+        None when a question has no usable context.
+        """
+        windows, owners = [], []
+        for query_idx, (query, context_chunks) in enumerate(zip(queries, contexts)):
+            for window in self._pack_windows(query, context_chunks):
+                windows.append(window)
+                owners.append(query_idx)
+        
+        best: List[Optional[Dict]] = [None] * len(queries)
+        for batch_start in range(0, len(windows), batch_size):
+            batch = windows[batch_start:batch_start + batch_size]
+            with metrics.timer('qa_inference'):
+                start_logits, end_logits = self._run_qa_model(batch)
+            for row, window in enumerate(batch):
+                query_idx = owners[batch_start + row]
+                span = self._best_span(window, start_logits[row], end_logits[row])
+                if best[query_idx] is None or span['score'] > best[query_idx]['score']:
+                    best[query_idx] = span
+        return best
+    
+    def _build_fallback_prompt(self, query: str, context_chunks: List[Dict]) -> str:
+        context = " ".join([chunk['text'][:200] for chunk in context_chunks if chunk['text'].strip()])
+        return f"Based on this text, answer the question: {query}\n\nText: {context}\n\nAnswer:"
+    
+    def _format_fallback_answer(self, result, prompt: str) -> str:
+        """Turn a text2text pipeline result into the displayed answer"""
+        if result and len(result) > 0:
+            answer = result[0]['generated_text'].strip()
+            # Remove the prompt from answer if it's included
+            if prompt in answer:
+                answer = answer.replace(prompt, "").strip()
+            return answer if len(answer) > 10 else "Could not generate a clear answer."
+        else:
+            return "Could not generate answer from the provided text."
+    
     def fallback_answer(self, query: str, context_chunks: List[Dict]) -> str:
         """Fallback method using generative model"""
         try:
-            context = " ".join([chunk['text'][:200] for chunk in context_chunks if chunk['text'].strip()])
-            prompt = f"Based on this text, answer the question: {query}\n\nText: {context}\n\nAnswer:"
-            
-            result = self.qa_pipeline(prompt, max_length=150, temperature=0.7)
-            
-            if result and len(result) > 0:
-                answer = result[0]['generated_text'].strip()
-                # Remove the prompt from answer if it's included
-                if prompt in answer:
-                    answer = answer.replace(prompt, "").strip()
-                return answer if len(answer) > 10 else "Could not generate a clear answer."
-            else:
-                return "Could not generate answer from the provided text."
+            prompt = self._build_fallback_prompt(query, context_chunks)
+            with metrics.timer('qa_inference'):
+                result = self.qa_pipeline(prompt, max_length=150, temperature=0.7)
+            return self._format_fallback_answer(result, prompt)
                 
         except Exception as e:
             return f"Fallback error: {str(e)}"
\ No newline at end of file
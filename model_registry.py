@@ -0,0 +1,120 @@
+"""Process-wide registry of loaded models.
+
+Every Streamlit session runs in the same Python process, so models are
+loaded once here and handed out as shared, read-only instances. Loading is
+lazy and thread-safe: the first caller for a key builds the model while
+concurrent callers for the same key wait, and other keys are not blocked.
+
+Models run in fp32 by default. With precision 'int8' (or STUDYMATE_PRECISION=int8)
+the Linear layers of torch models are dynamically quantized after loading,
+which on CPU roughly halves their memory and cuts inference latency at a
+small accuracy cost; benchmark.py --parity measures that cost.
+"""
+import importlib
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+from instrumentation import get_logger
+
+logger = get_logger(__name__)
+
+_models: Dict[Hashable, Any] = {}
+_key_locks: Dict[Hashable, threading.Lock] = {}
+_registry_lock = threading.Lock()
+_torch_configured = False
+
+PRECISIONS = ('fp32', 'int8')
+
+class LazyModule:
+    """Stand-in for a heavy module that is only imported on first attribute access"""
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+def lazy_import(name: str) -> LazyModule:
+    return LazyModule(name)
+
+def get_or_load(key: Hashable, loader: Callable[[], Any]) -> Any:
+    """Return the model stored under key, calling loader() exactly once to create it"""
+    model = _models.get(key)
+    if model is not None:
+        return model
+    
+    with _registry_lock:
+        lock = _key_locks.setdefault(key, threading.Lock())
+    with lock:
+        model = _models.get(key)
+        if model is None:
+            model = loader()
+            _models[key] = model
+    return model
+
+def register_model(key: Hashable, model: Any):
+    """Install a ready-made model (e.g. a stand-in for offline runs) under key"""
+    _models[key] = model
+
+def default_precision() -> str:
+    """Precision from STUDYMATE_PRECISION ('fp32' or 'int8'), fp32 if unset"""
+    return resolve_precision(os.getenv("STUDYMATE_PRECISION"))
+
+def resolve_precision(precision: Optional[str]) -> str:
+    precision = (precision or 'fp32').lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}'. Choose from: {', '.join(PRECISIONS)}")
+    return precision
+
+def configure_torch_threads(threads: Optional[int] = None):
+    """Set torch intra-op threads (default from STUDYMATE_TORCH_THREADS; unset leaves torch's choice)"""
+    global _torch_configured
+    if threads is None:
+        if _torch_configured:
+            return
+        threads = int(os.getenv("STUDYMATE_TORCH_THREADS", "0")) or None
+    _torch_configured = True
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+        logger.info("torch intra-op threads set to %d", threads)
+
+def quantize_dynamic_int8(model):
+    """Quantize the Linear layers of a torch module to int8 in place; other objects are returned unchanged"""
+    import torch
+    if not isinstance(model, torch.nn.Module):
+        logger.warning("%s is not a torch module; leaving it unquantized", type(model).__name__)
+        return model
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def embedding_model_key(model_name: str, precision: str = 'fp32') -> Hashable:
+    return ('embedding', model_name, precision)
+
+def get_embedding_model(model_name: str, precision: str = 'fp32'):
+    """Shared SentenceTransformer for model_name at the given precision"""
+    def load():
+        from sentence_transformers import SentenceTransformer
+        configure_torch_threads()
+        logger.info("Loading embedding model %s (%s)...", model_name, precision)
+        if precision == 'int8':
+            # Quantized kernels are CPU-only
+            return quantize_dynamic_int8(SentenceTransformer(model_name, device='cpu'))
+        return SentenceTransformer(model_name)
+    return get_or_load(embedding_model_key(model_name, precision), load)
+
+def pipeline_key(task: str, model_name: str, precision: str = 'fp32', **kwargs) -> Hashable:
+    return ('pipeline', task, model_name, precision, tuple(sorted(kwargs.items())))
+
+def get_pipeline(task: str, model_name: str, precision: str = 'fp32', **kwargs):
+    """Shared transformers pipeline for (task, model_name, precision, kwargs)"""
+    def load():
+        from transformers import pipeline
+        configure_torch_threads()
+        pipe = pipeline(task, model=model_name, **kwargs)
+        if precision == 'int8':
+            pipe.model = quantize_dynamic_int8(pipe.model)
+        return pipe
+    return get_or_load(pipeline_key(task, model_name, precision, **kwargs), load)
@@ -1,39 +1,137 @@
 import PyPDF2
 import re
-from typing import List, Dict
+import os
+import shutil
+import tempfile
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
+from collections import deque
 import io
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from chunk_store import ChunkStore
+from instrumentation import get_logger, metrics
+
+logger = get_logger(__name__)
+
+# The PDF a pool worker parsed last, as ((path, mtime, size), reader), so its later ranges skip parsing
+_worker_pdf: Tuple[Optional[Tuple[str, int, int]], Optional[PyPDF2.PdfReader]] = (None, None)
+
+def _open_pdf(path: str) -> PyPDF2.PdfReader:
+    """Parse the PDF at path, or reuse this worker's reader if it is the one parsed last"""
+    global _worker_pdf
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if _worker_pdf[0] != key:
+        _worker_pdf = (None, None)  # release the previous file before reading the next
+        with open(path, 'rb') as f:
+            _worker_pdf = (key, PyPDF2.PdfReader(io.BytesIO(f.read())))
+    return _worker_pdf[1]
+
+def count_pdf_pages(path: str) -> int:
+    """Number of pages of the PDF at path; runs inside pool workers"""
+    return len(_open_pdf(path).pages)
+
+def extract_page_range(path: str, start: int, end: int) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]], float]:
+    """Extract pages [start, end) of the PDF at path.
+    
+    Runs inside pool workers, so it only takes and returns picklable values;
+    the file is read from disk rather than sent with every range. Returns
+    (pages, errors, seconds) with pages and errors as lists of (page_num, text)
+    and (page_num, message); a page that fails to extract is reported without
+    affecting its neighbours.
+    """
+    started = time.perf_counter()
+    pdf_reader = _open_pdf(path)
+    pages, errors = [], []
+    for page_num in range(start, end):
+        try:
+            pages.append((page_num, pdf_reader.pages[page_num].extract_text() or ""))
+        except Exception as e:
+            errors.append((page_num, str(e)))
+    return pages, errors, time.perf_counter() - started
+
+def _remove_file(path: Optional[str]):
+    if path is not None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 class PDFProcessor:
-    def __init__(self, chunk_size: int = 400, overlap: int = 100):  # Larger chunks
+    def __init__(self, chunk_size: int = 400, overlap: int = 100,  # Larger chunks
+                 workers: int = 1, pages_per_task: int = 20):
         self.chunk_size = chunk_size
         self.overlap = overlap
+        # workers > 1 extracts files and page ranges in a process pool; None uses every core
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.pages_per_task = max(1, pages_per_task)
+        self.errors = []  # failures from the last process_multiple_pdfs call
+        self._executor: Optional[ProcessPoolExecutor] = None  # created on first parallel use, kept until close()
+        self._executor_lock = threading.Lock()
+    
+    def _pool(self) -> ProcessPoolExecutor:
+        """The long-lived extraction pool.
+        
+        Workers are started by forkserver (spawn where that is unavailable) rather
+        than forked, since callers such as the ingestion thread run in a threaded
+        process.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context(method))
+            return self._executor
+    
+    def close(self):
+        """Shut down the extraction pool, if one was started"""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
     
     def extract_text_from_pdf(self, pdf_file) -> str:
         """Extract text from uploaded PDF file using PyPDF2"""
         try:
-            pdf_file.seek(0)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
-            text = ""
-            
-            print(f"📄 DEBUG: PDF has {len(pdf_reader.pages)} pages")
-            
-            for page_num, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                print(f"📄 DEBUG: Page {page_num+1} extracted {len(page_text)} characters")
-                if page_text.strip():  # Only add if page has content
-                    text += page_text + " "
-            
-            print(f"📄 DEBUG: Total extracted text: {len(text)} characters")
-            print(f"📄 DEBUG: Text sample: {text[:200]}...")
-            
-            cleaned_text = self.clean_text(text)
-            print(f"📄 DEBUG: After cleaning: {len(cleaned_text)} characters")
-            
-            return cleaned_text
+            text = " ".join(page_text for _, page_text in self.iter_pages(pdf_file))
+            logger.debug("After cleaning: %d characters", len(text))
+            return text
         except Exception as e:
-            print(f"❌ PDF extraction error: {str(e)}")
+            logger.error("PDF extraction error: %s", e)
             raise Exception(f"Error extracting text from PDF: {str(e)}")
     
+    def iter_pages(self, pdf_file) -> Iterator[Tuple[int, str]]:
+        """Yield (page_number, cleaned_text) for each non-empty page, one page at a time"""
+        started = time.perf_counter()
+        pdf_file.seek(0)
+        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        logger.debug("PDF has %d pages", len(pdf_reader.pages))
+        extract_seconds = time.perf_counter() - started
+        clean_seconds = 0.0
+        
+        for page_num, page in enumerate(pdf_reader.pages, 1):
+            try:
+                started = time.perf_counter()
+                raw_text = page.extract_text() or ""
+                extracted = time.perf_counter()
+                page_text = self.clean_text(raw_text)
+                extract_seconds += extracted - started
+                clean_seconds += time.perf_counter() - extracted
+            except Exception as e:
+                # A broken page only costs that page
+                logger.warning("Error extracting %s page %d: %s", getattr(pdf_file, 'name', 'PDF'), page_num, e)
+                self.errors.append({'file': getattr(pdf_file, 'name', None), 'pages': (page_num, page_num), 'error': str(e)})
+                continue
+            metrics.incr('pages_extracted')
+            if page_text:  # Only yield pages with content
+                yield page_num, page_text
+        
+        metrics.record('extraction', extract_seconds)
+        metrics.record('cleaning', clean_seconds)
+    
     def clean_text(self, text: str) -> str:
         """Clean and normalize extracted text - less aggressive cleaning"""
         # Remove excessive whitespace but preserve structure
@@ -42,54 +140,229 @@ class PDFProcessor:
         text = re.sub(r'[^\w\s\.\,\!\?\;\:\-\(\)\'\"\%\$\@\#]', ' ', text)
         return text.strip()
     
-    def create_chunks(self, text: str, filename: str) -> List[Dict]:
+    def create_chunks(self, text: str, filename: str) -> ChunkStore:
         """Split text into overlapping chunks"""
         if not text or len(text.strip()) < 20:
-            print(f"❌ DEBUG: Text too short for chunking: {len(text)} chars")
-            return []
-            
-        words = text.split()
-        chunks = []
+            logger.debug("Text too short for chunking: %d chars", len(text))
+            return ChunkStore()
+        
+        chunks = ChunkStore.from_chunks(self.iter_chunks([(1, text)], filename))
+        logger.debug("Created %d total chunks", len(chunks))
+        return chunks
+    
+    def iter_chunks(self, pages: Iterable[Tuple[int, str]], filename: str,
+                    min_document_chars: int = 0) -> Iterator[Dict]:
+        """Turn a stream of (page_number, cleaned_text) into overlapping chunks.
         
-        print(f"📝 DEBUG: Creating chunks from {len(words)} words")
+        Produces the same windows as splitting the whole document into words,
+        but only keeps about one chunk of words in memory. Each chunk records the
+        pages it spans and its character span in the document formed by joining
+        the pages with single spaces. Chunks are held back until the document has
+        more than ``min_document_chars`` characters, so near-empty files yield nothing.
+        """
+        step = max(1, self.chunk_size - self.overlap)
+        window = deque()  # (word, page, char_start, char_end)
+        pending = []
+        doc_chars = 0
+        chunk_id = 0
+        chunk_seconds = 0.0  # time spent here, excluding the upstream page generator
         
-        for i in range(0, len(words), max(1, self.chunk_size - self.overlap)):
-            chunk_words = words[i:i + self.chunk_size]
-            chunk_text = ' '.join(chunk_words)
-            
-            if len(chunk_text.strip()) > 50:  # Only keep substantial chunks
-                chunks.append({
-                    'text': chunk_text,
-                    'source': filename,
-                    'chunk_id': len(chunks)
-                })
-                print(f"📝 DEBUG: Created chunk {len(chunks)}: {chunk_text[:100]}...")
+        def make_chunk(words):
+            nonlocal chunk_id
+            chunk_text = ' '.join(w[0] for w in words)
+            if len(chunk_text.strip()) <= 50:  # Only keep substantial chunks
+                return None
+            chunk = {
+                'text': chunk_text,
+                'source': filename,
+                'chunk_id': chunk_id,
+                'page': words[0][1],
+                'page_end': words[-1][1],
+                'char_start': words[0][2],
+                'char_end': words[-1][3]
+            }
+            chunk_id += 1
+            return chunk
+        
+        for page_num, page_text in pages:
+            started = time.perf_counter()
+            base = doc_chars + 1 if doc_chars else 0  # pages are joined by one space
+            for match in re.finditer(r'\S+', page_text):
+                window.append((match.group(), page_num, base + match.start(), base + match.end()))
+                # A full window is only final once a later word proves the text goes on
+                if len(window) > self.chunk_size:
+                    chunk = make_chunk([window[i] for i in range(self.chunk_size)])
+                    if chunk:
+                        pending.append(chunk)
+                    for _ in range(min(step, len(window))):
+                        window.popleft()
+            doc_chars = base + len(page_text)
+            chunk_seconds += time.perf_counter() - started
             
-            if i + self.chunk_size >= len(words):
-                break
+            if doc_chars > min_document_chars:
+                yield from pending
+                pending = []
         
-        print(f"📝 DEBUG: Created {len(chunks)} total chunks")
-        return chunks
+        if window:
+            chunk = make_chunk(list(window)[:self.chunk_size])
+            if chunk:
+                pending.append(chunk)
+        metrics.record('chunking', chunk_seconds)
+        metrics.incr('chunks_created', chunk_id)
+        if doc_chars > min_document_chars:
+            yield from pending
+    
+    def iter_document_chunks(self, pdf_file) -> Iterator[Dict]:
+        """Stream chunks straight from a PDF without materialising the whole text"""
+        return self.iter_chunks(self.iter_pages(pdf_file), pdf_file.name, min_document_chars=100)
+    
+    def process_multiple_pdfs(self, pdf_files) -> ChunkStore:
+        """Process multiple PDF files and return combined chunks in one columnar store"""
+        all_chunks = ChunkStore.from_chunks(self.iter_pdf_chunks(pdf_files))
+        logger.info("Total chunks created: %d", len(all_chunks))
+        return all_chunks
     
-    def process_multiple_pdfs(self, pdf_files) -> List[Dict]:
-        """Process multiple PDF files and return combined chunks"""
-        all_chunks = []
+    def iter_pdf_chunks(self, pdf_files) -> Iterator[Dict]:
+        """Yield chunks file by file as they are produced, recording failures in self.errors"""
+        self.errors = []
+        if self.workers > 1:
+            yield from self.iter_pdf_chunks_parallel(pdf_files)
+            return
         
         for pdf_file in pdf_files:
             try:
-                print(f"🔄 Processing {pdf_file.name}...")
-                text = self.extract_text_from_pdf(pdf_file)
-                
-                if text and len(text.strip()) > 100:  # Ensure meaningful content
-                    chunks = self.create_chunks(text, pdf_file.name)
-                    all_chunks.extend(chunks)
-                    print(f"✅ Processed {pdf_file.name}: {len(chunks)} chunks")
+                logger.info("Processing %s", pdf_file.name)
+                count = 0
+                for chunk in self.iter_document_chunks(pdf_file):
+                    count += 1
+                    yield chunk
+                if count:
+                    logger.info("Processed %s: %d chunks", pdf_file.name, count)
                 else:
-                    print(f"⚠️ {pdf_file.name}: Insufficient text extracted")
-                    
+                    logger.warning("%s: Insufficient text extracted", pdf_file.name)
             except Exception as e:
-                print(f"❌ Error processing {pdf_file.name}: {str(e)}")
+                logger.error("Error processing %s: %s", pdf_file.name, e)
+                self.errors.append({'file': pdf_file.name, 'pages': None, 'error': str(e)})
                 continue
+    
+    def iter_pdf_chunks_parallel(self, pdf_files) -> Iterator[Dict]:
+        """Extract page ranges in a process pool and yield each file's chunks in page order as its ranges finish.
+        
+        Each file is copied to a temporary file once, and workers are sent its
+        path and a page range; a worker keeps the last file it parsed, so its
+        following ranges of that file are not parsed again. At most 2 * workers
+        page ranges are in flight, and a file's copy is deleted once its ranges
+        are consumed.
+        """
+        executor = self._pool()
+        tasks = self._page_range_tasks(pdf_files, executor)
+        in_flight = deque()  # (doc index, name, start, end, future) in file and page order
+        paths: Dict[int, str] = {}  # doc index -> temporary copy, for files with ranges in flight
+        
+        def fill():
+            while len(in_flight) < 2 * self.workers:
+                task = next(tasks, None)
+                if task is None:
+                    return
+                doc_idx, name, path, start, end = task
+                paths[doc_idx] = path
+                in_flight.append((doc_idx, name, start, end, executor.submit(extract_page_range, path, start, end)))
         
-        print(f"🎯 Total chunks created: {len(all_chunks)}")
-        return all_chunks
\ No newline at end of file
+        def iter_document_pages(doc_idx: int, counts: Dict[str, int]) -> Iterator[Tuple[int, str]]:
+            # Ranges are consumed in submission order; later ones finish meanwhile and wait in their futures
+            while in_flight and in_flight[0][0] == doc_idx:
+                _, name, start, end, future = in_flight.popleft()
+                fill()
+                try:
+                    pages, errors, seconds = future.result()
+                except BrokenProcessPool:
+                    raise  # not this range's fault; the pool is replaced below
+                except Exception as e:
+                    logger.error("Error extracting %s pages %d-%d: %s", name, start + 1, end, e)
+                    self.errors.append({'file': name, 'pages': (start + 1, end), 'error': str(e)})
+                    continue
+                metrics.record('extraction', seconds)
+                metrics.incr('pages_extracted', len(pages))
+                counts['pages'] += len(pages)
+                counts['total'] = end
+                for page_num, message in errors:
+                    logger.warning("Error extracting %s page %d: %s", name, page_num + 1, message)
+                    self.errors.append({'file': name, 'pages': (page_num + 1, page_num + 1), 'error': message})
+                for page_num, raw_text in pages:
+                    started = time.perf_counter()
+                    page_text = self.clean_text(raw_text)
+                    counts['clean_seconds'] += time.perf_counter() - started
+                    if page_text:
+                        yield page_num + 1, page_text
+        
+        try:
+            fill()
+            while in_flight:
+                doc_idx, name = in_flight[0][:2]
+                counts = {'pages': 0, 'total': 0, 'clean_seconds': 0.0}
+                chunk_count = 0
+                for chunk in self.iter_chunks(iter_document_pages(doc_idx, counts), name, min_document_chars=100):
+                    chunk_count += 1
+                    yield chunk
+                _remove_file(paths.pop(doc_idx))
+                metrics.record('cleaning', counts['clean_seconds'])
+                if chunk_count:
+                    logger.info("Processed %s: %d/%d pages, %d chunks", name, counts['pages'], counts['total'], chunk_count)
+                else:
+                    logger.warning("%s: Insufficient text extracted", name)
+        except BrokenProcessPool:
+            self._discard_pool(executor)
+            raise
+        finally:
+            # Also reached when the consumer stops early (e.g. a cancelled ingestion job): drop
+            # the queued ranges; ranges already running finish in the pool and are discarded
+            for *_, future in in_flight:
+                future.cancel()
+            tasks.close()
+            for path in paths.values():
+                _remove_file(path)
+    
+    def _discard_pool(self, executor: ProcessPoolExecutor):
+        """Forget a pool whose worker died, so the next call starts a fresh one"""
+        with self._executor_lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _page_range_tasks(self, pdf_files, executor: ProcessPoolExecutor) -> Iterator[Tuple[int, str, str, int, int]]:
+        """(doc index, name, temporary copy, start, end) for every page range, copying each file only when it is reached.
+        
+        The page count comes from a worker, which then holds the parsed file for
+        the ranges that follow. A file with no ranges has its copy deleted here;
+        otherwise the caller deletes it.
+        """
+        for doc_idx, pdf_file in enumerate(pdf_files):
+            path = None
+            try:
+                path = self._spill(pdf_file)
+                page_count = executor.submit(count_pdf_pages, path).result()
+            except BrokenProcessPool:
+                _remove_file(path)
+                raise
+            except Exception as e:
+                _remove_file(path)
+                logger.error("Error opening %s: %s", pdf_file.name, e)
+                self.errors.append({'file': pdf_file.name, 'pages': None, 'error': str(e)})
+                continue
+            if not page_count:
+                _remove_file(path)
+            for start in range(0, page_count, self.pages_per_task):
+                yield doc_idx, pdf_file.name, path, start, min(start + self.pages_per_task, page_count)
+    
+    @staticmethod
+    def _spill(pdf_file) -> str:
+        """Copy an uploaded file to a temporary file the pool workers can open; returns its path"""
+        fd, path = tempfile.mkstemp(prefix='studymate-', suffix='.pdf')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pdf_file.seek(0)
+                shutil.copyfileobj(pdf_file, f)
+        except BaseException:
+            _remove_file(path)
+            raise
+        return path
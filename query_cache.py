@@ -0,0 +1,215 @@
+"""Caches for repeated questions.
+
+Students in one class ask the same questions again and again. Two levels
+avoid repeating the work:
+
+- QueryEmbeddingCache: an LRU of unit-length query embeddings keyed by the
+  normalized query text, so a repeated question skips model.encode.
+- AnswerCache: answers keyed by (normalized query, retrieved chunk ids,
+  model version), which skips the QA forward pass. A rephrasing whose
+  embedding is within ``similarity_threshold`` of a cached question in the
+  same search scope is also served. The app embeds the question before
+  looking up and hands the vector to the search, so such a rephrasing
+  skips the search too; the service encodes questions in micro-batched
+  searches and matches rephrasings afterwards, skipping only the QA pass.
+
+Exact entries stay valid while the row numbers they reference do (the
+engine's generation); similarity hits need the corpus to be exactly as it
+was (the engine's corpus_version), since a new document could change what a
+search would find. Both levels evict least recently used entries beyond
+their size, and answers also expire after ``ttl_seconds``.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from instrumentation import get_logger, metrics
+
+logger = get_logger(__name__)
+
+def default_query_cache_size() -> int:
+    """STUDYMATE_QUERY_CACHE_SIZE, default 1024 query embeddings; 0 disables"""
+    return int(os.getenv("STUDYMATE_QUERY_CACHE_SIZE", "1024"))
+
+def default_answer_cache_size() -> int:
+    """STUDYMATE_ANSWER_CACHE_SIZE, default 512 answers; 0 disables"""
+    return int(os.getenv("STUDYMATE_ANSWER_CACHE_SIZE", "512"))
+
+def default_answer_ttl() -> float:
+    """STUDYMATE_ANSWER_CACHE_TTL, default 3600 seconds"""
+    return float(os.getenv("STUDYMATE_ANSWER_CACHE_TTL", "3600"))
+
+def default_similarity_threshold() -> float:
+    """STUDYMATE_SEMANTIC_THRESHOLD, default 0.95 cosine similarity; 0 serves exact repeats only"""
+    return float(os.getenv("STUDYMATE_SEMANTIC_THRESHOLD", "0.95"))
+
+def normalize_query(query: str) -> str:
+    """Case-folded, whitespace-collapsed query without surrounding punctuation"""
+    return ' '.join(query.casefold().split()).strip(' ?!.')
+
+class QueryEmbeddingCache:
+    """Thread-safe LRU of query embeddings keyed by normalized query text"""
+    
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def get_many(self, keys: Sequence[str]) -> Dict[int, np.ndarray]:
+        """Cached vectors by position in keys; counts hits and misses"""
+        found = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    found[i] = vector
+        metrics.incr('query_cache_hits', len(found))
+        metrics.incr('query_cache_misses', len(keys) - len(found))
+        return found
+    
+    def peek(self, key: str) -> Optional[np.ndarray]:
+        """The cached vector, if any, without counting a lookup"""
+        with self._lock:
+            return self._entries.get(key)
+    
+    def put_many(self, keys: Sequence[str], vectors: np.ndarray):
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                self._entries[key] = vector
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class CachedAnswer:
+    """One cached answer and the search it came from"""
+    __slots__ = ('answer', 'rows', 'scores', 'vector', 'scope', 'corpus_version', 'generation', 'created')
+    
+    def __init__(self, answer: str, rows: Tuple[int, ...], scores: Tuple[float, ...], vector: Optional[np.ndarray],
+                 scope: Hashable, corpus_version: int, generation: int):
+        self.answer = answer
+        self.rows = rows  # chunk rows the answer was generated from
+        self.scores = scores  # their similarity scores
+        self.vector = vector  # query embedding, None if the query was never embedded (lexical search)
+        self.scope = scope  # search settings the rows came from (mode, k, filter)
+        self.corpus_version = corpus_version
+        self.generation = generation
+        self.created = time.time()
+
+class AnswerCache:
+    """Answers of one QA model version, looked up by exact question and retrieved chunks or by similar question.
+    
+    Callers look up before searching (similar questions only), again after
+    searching (exact key first, then similar questions), and store the
+    answer they generated otherwise. vector is the question's embedding where
+    the caller has it; without it the engine's query cache is consulted:
+    
+        vector = engine.embed_query(question, mode)
+        hit = cache.lookup(engine, question, scope, vector=vector)
+        if hit is None:
+            version = engine.corpus_version
+            chunks = engine.retrieve_relevant_chunks(question, ..., query_embedding=vector)
+            hit = cache.lookup(engine, question, scope, chunks, vector=vector)
+            ...
+            cache.store(engine, question, scope, chunks, answer, version, vector=vector)
+    
+    scope identifies the search settings (mode, k, filter key) so a similar
+    question is only served answers found the same way.
+    """
+    
+    def __init__(self, model_version: str, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None,
+                 similarity_threshold: Optional[float] = None):
+        self.model_version = model_version
+        self.max_entries = default_answer_cache_size() if max_entries is None else max_entries
+        self.ttl_seconds = default_answer_ttl() if ttl_seconds is None else ttl_seconds
+        self.similarity_threshold = default_similarity_threshold() if similarity_threshold is None else similarity_threshold
+        self._entries: OrderedDict = OrderedDict()  # (normalized query, rows, generation) -> CachedAnswer
+        self._lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def lookup(self, engine, question: str, scope: Hashable, chunks: Optional[Sequence] = None,
+               vector: Optional[np.ndarray] = None) -> Optional[Tuple[str, List]]:
+        """(answer, chunk views) from the cache, or None.
+        
+        Without chunks only similar questions are considered. Similarity uses
+        vector, the question's unit-length embedding, or else the embedding in
+        the engine's query cache; without either only exact repeats can hit.
+        """
+        if not self.max_entries:
+            return None
+        query = normalize_query(question)
+        if vector is None:
+            vector = engine.cached_query_embedding(question)
+        now = time.time()
+        with self._lock:
+            entry = None
+            if chunks is not None:
+                entry = self._live(self._entries.get((query, tuple(chunk.row for chunk in chunks), engine.generation)), now)
+                if entry is not None:
+                    self._entries.move_to_end((query, entry.rows, entry.generation))
+                    metrics.incr('answer_cache_hits')
+                    return entry.answer, list(chunks)
+            if vector is not None and self.similarity_threshold > 0:
+                entry = self._most_similar(vector, scope, engine.corpus_version, now)
+        if entry is not None and all(engine.chunks.is_alive(row) for row in entry.rows):
+            metrics.incr('answer_cache_hits')
+            metrics.incr('answer_cache_semantic_hits')
+            return entry.answer, [engine.chunks.view(row, score) for row, score in zip(entry.rows, entry.scores)]
+        if chunks is not None:
+            metrics.incr('answer_cache_misses')
+        return None
+    
+    def _live(self, entry: Optional[CachedAnswer], now: float) -> Optional[CachedAnswer]:
+        if entry is None or now - entry.created > self.ttl_seconds:
+            return None
+        return entry
+    
+    def _most_similar(self, vector: np.ndarray, scope: Hashable, corpus_version: int, now: float) -> Optional[CachedAnswer]:
+        candidates = [entry for entry in self._entries.values()
+                      if entry.scope == scope and entry.corpus_version == corpus_version
+                      and entry.vector is not None and self._live(entry, now) is not None]
+        if not candidates:
+            return None
+        similarities = np.stack([entry.vector for entry in candidates]) @ vector
+        best = int(np.argmax(similarities))
+        return candidates[best] if similarities[best] >= self.similarity_threshold else None
+    
+    def store(self, engine, question: str, scope: Hashable, chunks: Sequence, answer: str, corpus_version: int,
+              vector: Optional[np.ndarray] = None):
+        """Cache an answer generated from chunks; corpus_version is engine.corpus_version from before the search"""
+        if not self.max_entries or not chunks:
+            return
+        rows = tuple(chunk.row for chunk in chunks)
+        scores = tuple(chunk.get('similarity_score', 0.0) for chunk in chunks)
+        if vector is None:
+            vector = engine.cached_query_embedding(question)
+        entry = CachedAnswer(answer, rows, scores, vector, scope, corpus_version, engine.generation)
+        now = time.time()
+        with self._lock:
+            key = (normalize_query(question), rows, entry.generation)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            # Entries of an older generation point at rows that have since been renumbered
+            stale = [old for old, cached in self._entries.items()
+                     if cached.generation != entry.generation or now - cached.created > self.ttl_seconds]
+            for old in stale:
+                del self._entries[old]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
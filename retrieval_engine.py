@@ -1,47 +1,820 @@
-from sentence_transformers import SentenceTransformer
-import faiss
+import functools
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Iterable, Mapping, Optional, Tuple, Union
+from chunk_store import ChunkFilter, ChunkStore, ChunkView
+from dedup import DedupPlan, NearDuplicateIndex, default_dedup_threshold
+from embedding_cache import EmbeddingCache
+from index_backends import (VECTOR_STORAGES, IndexBackend, bitmap_selector, build_backend, load_backend, normalize,
+                            recall_report, save_backend, select_backend)
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from model_registry import default_precision, get_embedding_model, resolve_precision
+from query_cache import QueryEmbeddingCache, default_query_cache_size, normalize_query
+from instrumentation import get_logger, metrics
+
+logger = get_logger(__name__)
+
+# Bump when the on-disk layout written by RetrievalEngine.save changes
+INDEX_FORMAT_VERSION = 5
+# Older layouts load() still reads
+READABLE_FORMAT_VERSIONS = (1, 2, 3, 4, 5)
+# Files versions 1-4 wrote directly into the index directory; version 5 keeps them in a snapshot subdirectory
+LEGACY_INDEX_FILES = ('embeddings.npy', 'index.faiss', 'chunks.jsonl', 'minhash_bands.npy', 'texts.bin',
+                      'text_offsets.npy', 'chunk_rows.npy', 'sources.json', 'duplicates.json', 'metadata.json')
+
+RETRIEVAL_MODES = ('dense', 'lexical', 'hybrid')
+# Filtered searches admitting at most this many chunks scan them exactly instead of using the index
+EXACT_FILTER_LIMIT = 4096
+# Share of removed chunks in the BM25 index at which it is rebuilt in the background
+LEXICAL_REBUILD_FRACTION = 0.25
+
+def default_vector_storage() -> str:
+    return os.getenv("STUDYMATE_VECTOR_STORAGE", "float32")
+
+def default_encode_batch_size() -> int:
+    return int(os.getenv("STUDYMATE_ENCODE_BATCH_SIZE", "64"))
+
+def synchronized(method):
+    """Run the method while holding the engine's lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 class RetrievalEngine:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', cache_dir: Optional[str] = '.studymate_cache',
+                 index_backend: str = 'auto', backend_params: Optional[Dict] = None,
+                 retrieval_mode: str = 'dense', rrf_k: int = 60, precision: Optional[str] = None,
+                 encode_batch_size: Optional[int] = None, dedup_threshold: Optional[float] = None,
+                 vector_storage: Optional[str] = None, rerank_factor: int = 4,
+                 query_cache_size: Optional[int] = None):
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{retrieval_mode}'. Choose from: {', '.join(RETRIEVAL_MODES)}")
+        vector_storage = vector_storage or default_vector_storage()
+        if vector_storage not in VECTOR_STORAGES:
+            raise ValueError(f"Unknown vector storage '{vector_storage}'. Choose from: {', '.join(VECTOR_STORAGES)}")
+        self.model_name = model_name
+        # 'fp32' or 'int8' (dynamically quantized encoder); None reads STUDYMATE_PRECISION
+        self.precision = resolve_precision(precision) if precision else default_precision()
+        # 'dense' (embeddings), 'lexical' (BM25 only, never loads the embedding model) or 'hybrid'
+        self.retrieval_mode = retrieval_mode
+        self.rrf_k = rrf_k
+        # 'auto' picks flat / hnsw / ivf_flat / ivf_pq from the corpus size
+        self.index_backend = index_backend
+        self.backend_params = dict(backend_params or {})
+        # How the index codes vectors: 'float32' keeps a full copy in the index; 'float16' / 'int8'
+        # keep scalar-quantized codes only, and the top rerank_factor * k candidates are re-scored
+        # exactly against self.embeddings, so each float32 vector is held once.
+        # None reads STUDYMATE_VECTOR_STORAGE (default float32)
+        self.vector_storage = vector_storage
+        self.rerank_factor = max(1, rerank_factor)
+        self.index: Optional[IndexBackend] = None
+        self.chunks = ChunkStore()  # row == FAISS id; removed chunks keep their row until compaction
+        self.embeddings = None  # unit-length rows; view of the first len(self.chunks) rows of _embedding_buffer
+        self._embedding_buffer = None
+        self.read_only = False  # True while embeddings and index are memory-mapped from a saved index
+        # BM25 over every live chunk (and chunks removed since it was built, which searches mask). Built
+        # on the first lexical search, extended as chunks are added, rebuilt in the background once
+        # removed chunks make up LEXICAL_REBUILD_FRACTION of it
+        self.lexical_index: Optional[BM25Index] = None
+        self._lexical_build_lock = threading.Lock()  # one BM25 build at a time
+        # On-disk embedding cache; pass cache_dir=None to always re-encode
+        self.embedding_cache = EmbeddingCache(cache_dir, self._encoder_id()) if cache_dir else None
+        # Chunks per encode call when ingesting; None reads STUDYMATE_ENCODE_BATCH_SIZE (default 64)
+        self.encode_batch_size = encode_batch_size or default_encode_batch_size()
+        # Guards the index and chunk store so a background ingestion can run while searches are served
+        self.lock = threading.RLock()
+        # Near-duplicate chunks are folded into the chunk they copy instead of being embedded;
+        # None reads STUDYMATE_DEDUP_THRESHOLD (default 0.85), 0 disables
+        threshold = default_dedup_threshold() if dedup_threshold is None else dedup_threshold
+        self.deduplicator = NearDuplicateIndex(threshold) if threshold > 0 else None
+        self._generation = 0  # bumped whenever row numbers are reassigned (reset, compaction)
+        self.corpus_version = 0  # bumped on every change to the searchable corpus; answer caches key on it
+        # LRU of query embeddings by normalized text; None reads STUDYMATE_QUERY_CACHE_SIZE (default 1024), 0 disables
+        query_cache_size = default_query_cache_size() if query_cache_size is None else query_cache_size
+        self.query_cache = QueryEmbeddingCache(query_cache_size) if query_cache_size > 0 else None
+    
+    @property
+    def model(self):
+        """Shared embedding model, loaded on first use"""
+        return get_embedding_model(self.model_name, self.precision)
+    
+    def _encoder_id(self) -> str:
+        """Identifies the encoder for the embedding cache; quantized vectors are cached separately"""
+        return self.model_name if self.precision == 'fp32' else f"{self.model_name}@{self.precision}"
+    
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Encode texts, looking up previously seen chunks in the embedding cache"""
+        if self.embedding_cache is None or not texts:
+            with metrics.timer('embedding'):
+                return np.asarray(self.model.encode(texts, batch_size=self.encode_batch_size), dtype=np.float32)
+        
+        keys = [self.embedding_cache.key(text) for text in texts]
+        cached = self.embedding_cache.get_many(keys)
+        missing = [i for i in range(len(texts)) if i not in cached]
+        metrics.incr('embedding_cache_hits', len(cached))
+        metrics.incr('embedding_cache_misses', len(missing))
+        logger.debug("Embedding cache: %d hits, %d to encode", len(cached), len(missing))
+        
+        if not missing:
+            return np.stack([cached[i] for i in range(len(texts))])
+        
+        with metrics.timer('embedding'):
+            new_embeddings = np.asarray(self.model.encode([texts[i] for i in missing], batch_size=self.encode_batch_size),
+                                        dtype=np.float32)
+        self.embedding_cache.put_many([keys[i] for i in missing], new_embeddings)
+        
+        embeddings = np.empty((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+        for i, vector in cached.items():
+            embeddings[i] = vector
+        embeddings[missing] = new_embeddings
+        return embeddings
+    
+    def encode_queries(self, queries: List[str], batch_size: int = 64) -> np.ndarray:
+        """Unit-length query embeddings; queries seen recently (after normalize_query) skip the model"""
+        if self.query_cache is None:
+            return normalize(self.model.encode(queries, batch_size=batch_size))
+        
+        keys = [normalize_query(query) for query in queries]
+        cached = self.query_cache.get_many(keys)
+        missing: Dict[str, int] = {}  # key -> first position needing it, so repeats in one batch encode once
+        for i, key in enumerate(keys):
+            if i not in cached:
+                missing.setdefault(key, i)
+        if not missing:
+            return np.stack([cached[i] for i in range(len(queries))])
+        
+        new_vectors = normalize(self.model.encode([queries[i] for i in missing.values()], batch_size=batch_size))
+        self.query_cache.put_many(list(missing), new_vectors)
+        by_key = dict(zip(missing, new_vectors))
+        return np.stack([cached[i] if i in cached else by_key[keys[i]] for i in range(len(queries))])
+    
+    def embed_queries(self, queries: List[str], mode: Optional[str] = None, batch_size: int = 64) -> Optional[np.ndarray]:
+        """The queries' embeddings if a search in mode would compute them, else None.
+        
+        Pass the result to retrieve_batch so the search does not encode again.
+        Lexical searches (and corpora indexed lexically only) never load the model.
+        """
+        if (mode or self.retrieval_mode) == 'lexical' or self.index is None:
+            return None
+        return self.encode_queries(queries, batch_size)
+    
+    def embed_query(self, query: str, mode: Optional[str] = None) -> Optional[np.ndarray]:
+        """embed_queries for one query"""
+        embeddings = self.embed_queries([query], mode)
+        return embeddings[0] if embeddings is not None else None
+    
+    def cached_query_embedding(self, query: str) -> Optional[np.ndarray]:
+        """The query's embedding if it is in the query cache; never calls the model"""
+        if self.query_cache is None:
+            return None
+        return self.query_cache.peek(normalize_query(query))
+    
+    @property
+    def generation(self) -> int:
+        """Changes whenever row numbers are reassigned, invalidating remembered rows"""
+        return self._generation
+    
+    @property
+    def removed_count(self) -> int:
+        return self.chunks.removed_count
+    
+    @synchronized
+    def build_index(self, chunks: Union[ChunkStore, Iterable[Mapping]]):
+        """Build FAISS index from text chunks"""
+        self.reset()
+        self.add_documents(chunks)
+    
+    @synchronized
+    def reset(self):
+        """Drop all indexed chunks"""
         self.index = None
-        self.chunks = []
+        self.chunks = ChunkStore()
         self.embeddings = None
+        self._embedding_buffer = None
+        self.read_only = False
+        self.lexical_index = None
+        if self.deduplicator is not None:
+            self.deduplicator.reset()
+        self._generation += 1
+        self.corpus_version += 1
     
-    def build_index(self, chunks: List[Dict]):
-        """Build FAISS index from text chunks"""
+    def add_documents(self, chunks: Union[ChunkStore, Iterable[Mapping]], replace: bool = True):
+        """Add chunks (a ChunkStore, or chunk dicts) to the index, replacing any sources that are already indexed"""
+        if not isinstance(chunks, ChunkStore):
+            chunks = ChunkStore.from_chunks(chunks)
+        if not chunks.live_count:
+            return
+        
+        plan = self._plan_dedup(chunks, replace) if self.deduplicator is not None else None
+        rows = plan.keep if plan is not None else chunks.live_ids().tolist()
+        new_embeddings = None
+        if self.uses_dense() and rows:
+            # Generate embeddings (only chunks missing from the cache are encoded); done
+            # before taking the lock so searches are not held up by encoding
+            new_embeddings = normalize(self.encode_texts(chunks.texts(rows)))
+        self._insert(chunks, new_embeddings, replace, plan)
+    
+    @synchronized
+    def _plan_dedup(self, chunks: ChunkStore, replace: bool) -> DedupPlan:
+        """Find the batch's near-duplicates of indexed chunks and of each other, before anything is encoded"""
+        self._sync_dedup()
+        # Rows the replacement will delete must not absorb the batch; rows handed to another source may
+        replaced = self.chunks.orphaned_rows(chunks.live_sources()) if replace else None
+        with metrics.timer('dedup'):
+            return self.deduplicator.plan(chunks, self.chunks, self._generation, exclude_rows=replaced)
+    
+    def _sync_dedup(self):
+        """Hash the corpus if the LSH keys are missing, e.g. after loading an index saved without them"""
+        if len(self.deduplicator) != len(self.chunks):
+            self.deduplicator.rebuild(self.chunks)
+    
+    @synchronized
+    def _insert(self, chunks: ChunkStore, new_embeddings: Optional[np.ndarray], replace: bool,
+                plan: Optional[DedupPlan] = None):
+        self._ensure_writable()
+        if replace:
+            for source in chunks.live_sources():
+                self.remove_document(source)
+        rows = chunks.live_ids().tolist()
+        if plan is not None:
+            plan, new_embeddings = self._revalidate_plan(chunks, plan, new_embeddings)
+            rows = plan.keep
+        if new_embeddings is not None:
+            if self.embeddings is None and self.chunks.live_count:
+                # The mode became dense while this batch was encoding; embed the rest of the corpus first
+                self.set_retrieval_mode(self.retrieval_mode)
+            self._append_embeddings(new_embeddings)
+        
+        if plan is not None:
+            self._sync_dedup()
+        ids = self.chunks.extend(chunks, np.asarray(rows, dtype=np.int64))
+        self.corpus_version += 1
+        if self.lexical_index is not None:
+            # Only the new chunks are tokenized, so lexical searches see them as soon as they are added
+            self.lexical_index.add(chunks.texts(rows), ids)
+        if plan is not None:
+            self.deduplicator.append(plan.keys[rows])
+            self._record_duplicates(chunks, plan, dict(zip(rows, ids.tolist())))
+        
+        if new_embeddings is None:
+            return
+        if self.index is None or self._index_is_stale():
+            self._rebuild_index()
+        else:
+            with metrics.timer('index_build'):
+                self.index.add(new_embeddings, ids)
+    
+    def _revalidate_plan(self, chunks: ChunkStore, plan: DedupPlan,
+                         new_embeddings: Optional[np.ndarray]) -> Tuple[DedupPlan, Optional[np.ndarray]]:
+        """Re-match the batch if the corpus changed between planning and insertion.
+        
+        Rows already encoded stay indexed; rows whose merge target disappeared are encoded now.
+        """
+        if plan.generation == self._generation and all(self.chunks.is_alive(row) for row in plan.corpus_merges.values()):
+            return plan, new_embeddings
+        self._sync_dedup()
+        fresh = self.deduplicator.plan(chunks, self.chunks, self._generation)
+        encoded = set(plan.keep)
+        missing = [row for row in fresh.keep if row not in encoded]
+        keep = sorted(encoded.union(missing))
+        if missing and self.uses_dense():
+            vectors = dict(zip(plan.keep, new_embeddings)) if new_embeddings is not None else {}
+            vectors.update(zip(missing, normalize(self.encode_texts(chunks.texts(missing)))))
+            new_embeddings = np.stack([vectors[row] for row in keep])
+        corpus_merges = {row: target for row, target in fresh.corpus_merges.items() if row not in encoded}
+        batch_merges = {row: target for row, target in fresh.batch_merges.items() if row not in encoded}
+        return DedupPlan(fresh.keys, keep, corpus_merges, batch_merges, self._generation), new_embeddings
+    
+    def _record_duplicates(self, chunks: ChunkStore, plan: DedupPlan, ids: Dict[int, int]):
+        """Keep the provenance of merged batch rows on the chunks they duplicate"""
+        for row, target in plan.corpus_merges.items():
+            self.chunks.add_duplicate(target, chunks.view(row))
+        for row, target in plan.batch_merges.items():
+            self.chunks.add_duplicate(ids[target], chunks.view(row))
+        if plan.merged_count:
+            metrics.incr('duplicates_merged', plan.merged_count)
+            logger.info("Merged %d near-duplicate chunks into existing ones", plan.merged_count)
+    
+    @synchronized
+    def remove_document(self, source: str) -> int:
+        """Remove every chunk of a source document; returns the number of its chunks removed.
+        
+        The count includes copies merged into other documents' chunks. Chunks
+        that other documents' near-duplicates were merged into stay indexed
+        under one of those documents.
+        """
+        self.chunks.metadata.pop(source, None)
+        if not self.chunks.has_source(source):
+            return 0
+        self._ensure_writable()
+        self.corpus_version += 1
+        ids, detached = self.chunks.release_source(source)
+        if not len(ids):
+            return detached
+        
+        if self.index is not None:
+            self.index.remove(ids)
+        self.chunks.remove(ids)
+        
+        # Reclaim the dead slots once they outnumber the live chunks
+        if self.removed_count > len(self.chunks) - self.removed_count:
+            self._compact()
+        return detached
+    
+    def _append_embeddings(self, new_embeddings: np.ndarray):
+        """Write embeddings into the growable buffer, doubling its capacity when full"""
+        used = len(self.chunks)
+        needed = used + len(new_embeddings)
+        if self._embedding_buffer is None or needed > len(self._embedding_buffer):
+            capacity = max(needed, 2 * (len(self._embedding_buffer) if self._embedding_buffer is not None else 0))
+            buffer = np.empty((capacity, new_embeddings.shape[1]), dtype=np.float32)
+            if used:
+                buffer[:used] = self._embedding_buffer[:used]
+            self._embedding_buffer = buffer
+        self._embedding_buffer[used:needed] = new_embeddings
+        self.embeddings = self._embedding_buffer[:needed]
+    
+    def _compact(self):
+        """Renumber live chunks contiguously and rebuild the index without dead slots"""
+        live = self._live_ids()
+        embeddings = self.embeddings[live] if self.embeddings is not None else None
+        dedup_keys = None
+        if self.deduplicator is not None and len(self.deduplicator) == len(self.chunks):
+            dedup_keys = self.deduplicator.keys[live]
+        # A new store, so views already handed out keep reading the old rows
+        chunks = self.chunks.select(live)
+        
+        self.reset()
+        if not len(chunks):
+            return
+        if embeddings is not None:
+            self._append_embeddings(embeddings)
+        if dedup_keys is not None:
+            self.deduplicator.append(dedup_keys)
         self.chunks = chunks
+        self._rebuild_index()
+    
+    def _live_ids(self) -> np.ndarray:
+        return self.chunks.live_ids()
+    
+    def _resolve_backend(self, n_vectors: int) -> str:
+        if self.index_backend == 'auto':
+            return select_backend(n_vectors)
+        return self.index_backend
+    
+    def _index_is_stale(self) -> bool:
+        """Whether the corpus has outgrown the current backend (auto switch or IVF retrain)"""
+        n_live = self.chunks.live_count
+        if self.index.name != self._resolve_backend(n_live):
+            return True
+        return self.index.needs_rebuild(n_live)
+    
+    def _rebuild_index(self):
+        """Build the vector index from scratch over all live chunks"""
+        ids = self._live_ids()
+        if len(ids) == 0 or self.embeddings is None:
+            self.index = None
+            return
+        vectors = np.ascontiguousarray(self.embeddings[ids])
+        name = self._resolve_backend(len(ids))
+        logger.info("Building %s index over %d chunks", name, len(ids))
+        with metrics.timer('index_build'):
+            self.index = build_backend(name, vectors, ids, **dict(self.backend_params, storage=self.vector_storage))
+    
+    def uses_dense(self) -> bool:
+        return self.retrieval_mode != 'lexical'
+    
+    @synchronized
+    def set_retrieval_mode(self, mode: str):
+        """Switch between 'dense', 'lexical' and 'hybrid' retrieval.
+        
+        Moving to a dense mode after indexing lexically encodes the corpus once.
+        """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}'. Choose from: {', '.join(RETRIEVAL_MODES)}")
+        self.retrieval_mode = mode
+        if self.uses_dense() and self.embeddings is None and len(self._live_ids()):
+            self._ensure_writable()
+            ids = self._live_ids()
+            vectors = normalize(self.encode_texts(self.chunks.texts(ids)))
+            self._embedding_buffer = np.zeros((len(self.chunks), vectors.shape[1]), dtype=np.float32)
+            self._embedding_buffer[ids] = vectors
+            self.embeddings = self._embedding_buffer
+            self._rebuild_index()
+    
+    def _ensure_lexical_index(self):
+        """Build the BM25 index if there is none, without holding the engine lock while it builds.
+        
+        Added chunks are indexed as they are inserted; removed ones are masked
+        at search time, and once they make up LEXICAL_REBUILD_FRACTION of the
+        index a background thread rebuilds it without them.
+        """
+        with self.lock:
+            missing = self.lexical_index is None
+            rebuild = not missing and self._lexical_index_is_bloated()
+        if missing:
+            self._build_lexical_index()
+        elif rebuild and not self._lexical_build_lock.locked():
+            threading.Thread(target=self._build_lexical_index, name='lexical-index', daemon=True).start()
+    
+    def _lexical_index_is_bloated(self) -> bool:
+        removed = len(self.lexical_index) - self.chunks.live_count
+        return removed > LEXICAL_REBUILD_FRACTION * len(self.lexical_index)
+    
+    def _build_lexical_index(self):
+        """Index a snapshot of the live chunks, then add the chunks inserted meanwhile and swap it in"""
+        with self._lexical_build_lock:
+            with self.lock:
+                if self.lexical_index is not None and not self._lexical_index_is_bloated():
+                    return
+                generation, indexed_rows = self._generation, len(self.chunks)
+                ids = self._live_ids()
+                texts = self.chunks.texts(ids)
+            lexical_index = BM25Index()
+            with metrics.timer('lexical_build'):
+                lexical_index.build(texts, ids)
+            with self.lock:
+                if self._generation != generation:
+                    return  # rows were renumbered; the next search builds again
+                ids = self._live_ids()
+                added = ids[ids >= indexed_rows]
+                lexical_index.add(self.chunks.texts(added), added)
+                self.lexical_index = lexical_index
+    
+    def _lexical_index_for(self, allowed: Optional[np.ndarray]) -> Tuple[BM25Index, Optional[np.ndarray]]:
+        """(BM25 index, allowed mask) for a search under the lock; chunks removed since the index was built are masked"""
+        if self.lexical_index is None:
+            # Rows were renumbered after _ensure_lexical_index, or a dense search fell back to lexical
+            ids = self._live_ids()
+            lexical_index = BM25Index()
+            with metrics.timer('lexical_build'):
+                lexical_index.build(self.chunks.texts(ids), ids)
+            self.lexical_index = lexical_index
+        if len(self.lexical_index) != self.chunks.live_count:
+            live = self.chunks.live_mask()
+            allowed = live if allowed is None else allowed & live
+        return self.lexical_index, allowed
+    
+    def set_search_params(self, **params):
+        """Tune the active backend, e.g. set_search_params(nprobe=32) or (ef_search=128)"""
+        self.backend_params.update(params)
+        if self.index is not None:
+            self.index.set_params(**params)
+    
+    def backend_recall_report(self, queries: List[str], k: int = 10,
+                              configs: Optional[List[Tuple[str, Dict]]] = None) -> List[Dict]:
+        """Recall@k and latency of each ANN backend against exact search on this corpus"""
+        ids = self._live_ids()
+        query_embeddings = normalize(self.model.encode(queries))
+        return recall_report(np.ascontiguousarray(self.embeddings[ids]), query_embeddings, k, configs)
+    
+    def _ensure_writable(self):
+        """Copy memory-mapped data into private memory before the first modification"""
+        if not self.read_only:
+            return
+        self._embedding_buffer = np.array(self.embeddings, dtype=np.float32)
+        self.embeddings = self._embedding_buffer
+        self.chunks.make_writable()
+        self.read_only = False
+        self._rebuild_index()
+    
+    @synchronized
+    def save(self, path: str):
+        """Write the index, embeddings and chunk metadata to a directory.
+        
+        Files are never rewritten in place, since other engines (in this or
+        another process) may have them memory-mapped: each save writes a new
+        snapshot-* subdirectory and then atomically replaces manifest.json,
+        which names the snapshot. Loaders see either the old or the new index.
+        The previous snapshot is kept for loaders that read the old manifest a
+        moment ago; older ones are deleted (mapped files stay readable after
+        deletion on POSIX). One writer per directory is supported.
+        
+        Layout (format version 5):
+            manifest.json     format version, snapshot name, model and precision, backend metadata, counts
+          in the snapshot directory:
+            embeddings.npy    float32 [n, dim], including removed slots
+            texts.bin         UTF-8 chunk texts back to back
+            text_offsets.npy  int64 [n + 1] byte offsets into texts.bin
+            chunk_rows.npy    per-slot source code, chunk id, pages, char span, alive flag
+            sources.json      source names indexed by source code
+            duplicates.json   provenance of near-duplicates merged into each slot
+            metadata.json     per-document metadata (course, digest, ...) used by filters
+            minhash_bands.npy uint64 [n, bands] LSH keys used for near-duplicate detection
+            index.faiss       the FAISS index
+        A lexical-only engine has no embeddings.npy or index.faiss, and an engine with
+        deduplication off has no minhash_bands.npy.
+        """
+        if not self.chunks.live_count:
+            raise ValueError("Nothing to save: the index is empty")
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        previous = self._snapshot_name(manifest_path)
+        snapshot = f"snapshot-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        data_dir = os.path.join(path, snapshot)
+        os.makedirs(data_dir)
+        
+        try:
+            manifest = self._write_snapshot(data_dir)
+            manifest['snapshot'] = snapshot
+            staged = os.path.join(path, f".{snapshot}.manifest.json")
+            with open(staged, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(staged, manifest_path)
+        except BaseException:
+            shutil.rmtree(data_dir, ignore_errors=True)
+            raise
+        
+        # Unlinking (never truncating) keeps existing mappings of these files valid
+        keep = {snapshot, previous}
+        for name in os.listdir(path):
+            if name.startswith('snapshot-') and name not in keep:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+            elif name in LEGACY_INDEX_FILES:
+                os.remove(os.path.join(path, name))
+    
+    @staticmethod
+    def _snapshot_name(manifest_path: str) -> Optional[str]:
+        """Snapshot a manifest points at; None if there is none (or it predates snapshots)"""
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('snapshot')
+        except (OSError, ValueError):
+            return None
+    
+    def _write_snapshot(self, data_dir: str) -> Dict:
+        """Write every data file into a fresh directory; returns the manifest describing them"""
+        if self.index is not None:
+            np.save(os.path.join(data_dir, 'embeddings.npy'), np.ascontiguousarray(self.embeddings))
+        self.chunks.save(data_dir)
+        dedup_meta = None
+        if self.deduplicator is not None:
+            self._sync_dedup()
+            np.save(os.path.join(data_dir, 'minhash_bands.npy'), self.deduplicator.keys)
+            dedup_meta = self.deduplicator.params()
         
-        # Extract text for embedding
-        texts = [chunk['text'] for chunk in chunks]
+        backend_meta = None
+        if self.index is not None:
+            backend_meta = save_backend(self.index, os.path.join(data_dir, 'index.faiss'))
+        return {
+            'format_version': INDEX_FORMAT_VERSION,
+            'model_name': self.model_name,
+            'precision': self.precision,
+            'index_backend': self.index_backend,
+            'backend': backend_meta,
+            'dimension': int(self.embeddings.shape[1]) if self.index is not None else None,
+            'n_slots': len(self.chunks),
+            'removed_count': self.removed_count,
+            'dedup': dedup_meta,
+        }
+    
+    @synchronized
+    def load(self, path: str, mmap: bool = True):
+        """Replace this engine's contents with an index written by save().
+        
+        With mmap=True the embeddings, chunk columns and FAISS index are mapped read-only, so
+        loading is near-instant and several processes share one copy in the
+        page cache. The first add/remove copies them into private memory.
+        """
+        with open(os.path.join(path, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') not in READABLE_FORMAT_VERSIONS:
+            raise ValueError(f"Unsupported index format version {manifest.get('format_version')} "
+                             f"(expected one of {READABLE_FORMAT_VERSIONS})")
+        precision = manifest.get('precision', 'fp32')
+        if manifest['model_name'] != self.model_name or precision != self.precision:
+            logger.warning("Saved index was built with %s (%s); switching model to match",
+                           manifest['model_name'], precision)
+            self.model_name = manifest['model_name']
+            self.precision = precision
+            if self.query_cache is not None:
+                self.query_cache.clear()
+            if self.embedding_cache is not None:
+                self.embedding_cache = EmbeddingCache(os.path.dirname(self.embedding_cache.cache_dir),
+                                                      self._encoder_id())
+        
+        # Version 5 keeps the data files in the snapshot the manifest names
+        data_dir = os.path.join(path, manifest['snapshot']) if manifest.get('snapshot') else path
+        self.reset()
+        self.index_backend = manifest['index_backend']
+        if manifest['backend'] is not None:
+            self.backend_params = dict(manifest['backend']['params'])
+            self.vector_storage = self.backend_params.get('storage', 'float32')
         
-        # Generate embeddings
-        self.embeddings = self.model.encode(texts)
+        mmap_mode = 'r' if mmap else None
+        if manifest['format_version'] == 1:
+            self.chunks = self._load_chunks_v1(path)
+        else:
+            self.chunks = ChunkStore.load(data_dir, mmap=mmap)
+        if self.deduplicator is not None and manifest.get('dedup') == self.deduplicator.params():
+            # Otherwise the keys are recomputed with this engine's parameters on the next add
+            self.deduplicator.append(np.load(os.path.join(data_dir, 'minhash_bands.npy')))
         
-        # Build FAISS index
-        dimension = self.embeddings.shape[1]
-        self.index = faiss.IndexFlatL2(dimension)
-        self.index.add(self.embeddings.astype('float32'))
+        if manifest['backend'] is None:
+            # Saved lexical-only; encodes the corpus here if this engine retrieves densely
+            self.set_retrieval_mode(self.retrieval_mode)
+            return
+        
+        embeddings = np.load(os.path.join(data_dir, 'embeddings.npy'), mmap_mode=mmap_mode)
+        if mmap:
+            self.embeddings = embeddings
+            self.read_only = True
+        else:
+            self._embedding_buffer = embeddings
+            self.embeddings = embeddings
+        self.index = load_backend(manifest['backend'], os.path.join(data_dir, 'index.faiss'), mmap=mmap)
+    
+    @staticmethod
+    def _load_chunks_v1(path: str) -> ChunkStore:
+        """Read the version 1 layout, which kept chunk fields in chunks.jsonl"""
+        offsets = np.load(os.path.join(path, 'text_offsets.npy'))
+        texts = np.fromfile(os.path.join(path, 'texts.bin'), dtype=np.uint8)
+        chunks = ChunkStore()
+        removed = []
+        with open(os.path.join(path, 'chunks.jsonl'), 'r', encoding='utf-8') as meta_file:
+            for i, line in enumerate(meta_file):
+                meta = json.loads(line)
+                if meta is None:
+                    removed.append(chunks.append({'text': '', 'source': ''}))  # keeps ids aligned
+                    continue
+                meta['text'] = texts[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+                chunks.append(meta)
+        chunks.remove(np.asarray(removed, dtype=np.int64))
+        return chunks
+    
+    @synchronized
+    def set_document_metadata(self, source: str, metadata: Dict):
+        """Attach metadata (e.g. {'course': 'CS101'}) to a document, for ChunkFilter and chunk['metadata']"""
+        self.chunks.metadata[source] = dict(metadata)
+        self.corpus_version += 1
     
-    def retrieve_relevant_chunks(self, query: str, k: int = 3) -> List[Dict]:
-        """Retrieve top-k most relevant chunks for a query"""
-        if self.index is None:
-            return []
+    @synchronized
+    def document_metadata(self) -> Dict[str, Dict]:
+        """Metadata of every document that has any"""
+        return {source: dict(metadata) for source, metadata in self.chunks.metadata.items()}
+    
+    @synchronized
+    def memory_report(self) -> Dict:
+        """Bytes held by each part of the index, in total and per live chunk.
         
-        # Encode query
-        query_embedding = self.model.encode([query])
+        'mapped' names the parts read from a memory-mapped saved index; those
+        pages live in the shared page cache rather than this process's heap.
+        """
+        live = self.chunks.live_count
+        vectors = self._embedding_buffer if self._embedding_buffer is not None else self.embeddings
+        parts = {
+            'chunks': self.chunks.nbytes,
+            'vectors': vectors.nbytes if vectors is not None else 0,
+            'index': self.index.memory_bytes() if self.index is not None else 0,
+            'lexical': self.lexical_index.nbytes if self.lexical_index is not None else 0,
+            'dedup': self.deduplicator.keys.nbytes if self.deduplicator is not None else 0,
+        }
+        parts['total'] = sum(parts.values())
+        return {
+            'chunks': live,
+            'vector_storage': self.vector_storage,
+            'index_backend': self.index.name if self.index is not None else None,
+            'bytes': parts,
+            'bytes_per_chunk': {name: value / live if live else 0.0 for name, value in parts.items()},
+            'mapped': ['chunks', 'vectors', 'index'] if self.read_only else [],
+        }
+    
+    @synchronized
+    def indexed_sources(self) -> List[str]:
+        """Sources currently present in the index"""
+        return self.chunks.live_sources()
+    
+    @synchronized
+    def has_document(self, source: str) -> bool:
+        """Whether any live chunk belongs to source"""
+        return self.chunks.has_source(source)
+    
+    def retrieve_relevant_chunks(self, query: str, k: int = 3, mode: Optional[str] = None,
+                                 chunk_filter: Optional[ChunkFilter] = None,
+                                 query_embedding: Optional[np.ndarray] = None) -> List[ChunkView]:
+        """Retrieve top-k most relevant chunks for a query, optionally only from some documents / pages"""
+        query_embeddings = query_embedding[None, :] if query_embedding is not None else None
+        return self.retrieve_batch([query], k, mode=mode, chunk_filter=chunk_filter, query_embeddings=query_embeddings)[0]
+    
+    def retrieve_batch(self, queries: List[str], k: int = 3, batch_size: int = 64,
+                       mode: Optional[str] = None, chunk_filter: Optional[ChunkFilter] = None,
+                       query_embeddings: Optional[np.ndarray] = None) -> List[List[ChunkView]]:
+        """Retrieve top-k chunks for many queries with one encode pass and one index search.
         
-        # Search in index
-        scores, indices = self.index.search(query_embedding.astype('float32'), k)
+        mode overrides the engine's retrieval_mode for this call. similarity_score
+        is cosine similarity (dense), BM25 score (lexical) or fused RRF score
+        (hybrid). Results are returned in the same order as ``queries``.
+        chunk_filter is applied inside the search (a FAISS ID selector and a BM25
+        mask), so k results come back whenever k chunks pass it.
+        query_embeddings (unit-length rows, e.g. from embed_queries) are used
+        instead of encoding the queries again.
+        """
+        mode = mode or self.retrieval_mode
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode '{mode}'. Choose from: {', '.join(RETRIEVAL_MODES)}")
+        if mode != 'dense' and queries:
+            self._ensure_lexical_index()
+        if query_embeddings is None and queries and self.chunks.live_count:
+            # Encoding (and loading the model on first use) happens before taking the lock,
+            # so ingestion and other readers are not held up by it
+            query_embeddings = self.embed_queries(queries, mode, batch_size)
+        with self.lock:
+            if not queries or not self.chunks.live_count:
+                return [[] for _ in queries]
+            if mode != 'lexical' and self.index is None:
+                # Indexed lexically only; dense search needs set_retrieval_mode first
+                mode = 'lexical'
+            allowed = chunk_filter.mask(self.chunks) if chunk_filter is not None else None
+            if allowed is not None and not allowed.any():
+                return [[] for _ in queries]
+            
+            metrics.incr('queries', len(queries))
+            with metrics.timer('search'):
+                return self._search_batch(queries, k, batch_size, mode, allowed, query_embeddings)
+    
+    def _search_batch(self, queries: List[str], k: int, batch_size: int, mode: str,
+                      allowed: Optional[np.ndarray] = None,
+                      query_embeddings: Optional[np.ndarray] = None) -> List[List[ChunkView]]:
+        if mode == 'lexical':
+            lexical_index, lexical_allowed = self._lexical_index_for(allowed)
+            results = []
+            for query in queries:
+                scores, indices = lexical_index.search(query, k, lexical_allowed)
+                results.append(self._collect_chunks(scores, indices))
+            return results
+        
+        # Hybrid fuses deeper candidate lists than the k finally returned
+        depth = k if mode == 'dense' else max(4 * k, 20)
+        
+        if query_embeddings is None:
+            # The corpus was embedded after retrieve_batch checked; rare, so encoding under the lock is acceptable
+            query_embeddings = self.encode_queries(queries, batch_size)
+        
+        scores, indices = self._dense_search(query_embeddings, depth, allowed)
+        
+        if mode == 'dense':
+            return [self._collect_chunks(scores[row], indices[row]) for row in range(len(queries))]
         
-        # Return relevant chunks with scores
+        lexical_index, lexical_allowed = self._lexical_index_for(allowed)
+        results = []
+        for row, query in enumerate(queries):
+            dense_ranking = [idx for idx in indices[row] if idx >= 0]
+            _, lexical_ranking = lexical_index.search(query, depth, lexical_allowed)
+            fused = reciprocal_rank_fusion([dense_ranking, lexical_ranking], self.rrf_k)[:k]
+            results.append(self._collect_chunks([score for _, score in fused], [idx for idx, _ in fused]))
+        return results
+    
+    def _dense_search(self, queries: np.ndarray, k: int, allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k (scores, ids) by cosine similarity among the allowed rows (all live rows if None)"""
+        selector, bits = None, None
+        if allowed is not None:
+            allowed_ids = np.flatnonzero(allowed)
+            if len(allowed_ids) <= EXACT_FILTER_LIMIT:
+                # A small subset is cheaper (and, for ANN backends, more accurate) to scan exactly
+                return self._exact_search(queries, allowed_ids, k)
+            selector, bits = bitmap_selector(allowed)  # bits backs the selector until we return
+        
+        # Search in index; scores are cosine similarities. Compressed codes only shortlist
+        # candidates, which the float32 working copy then re-ranks exactly
+        if self.index.compressed:
+            _, candidates = self.index.search(queries, k * self.rerank_factor, selector=selector)
+            return self._rerank(queries, candidates, k)
+        return self.index.search(queries, k, selector=selector)
+    
+    def _exact_search(self, queries: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = queries @ np.asarray(self.embeddings[ids], dtype=np.float32).T
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        top_ids = ids[top]
+        if top.shape[1] < k:  # fewer allowed chunks than k; pad like FAISS does
+            pad = k - top.shape[1]
+            top_scores = np.pad(top_scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+            top_ids = np.pad(top_ids, ((0, 0), (0, pad)), constant_values=-1)
+        return top_scores, top_ids
+    
+    def _rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact cosine scores of each query's candidates from the working copy; keeps the best k"""
+        valid = candidates >= 0
+        vectors = self.embeddings[np.where(valid, candidates, 0)]
+        exact = np.einsum('qcd,qd->qc', vectors, queries)
+        exact[~valid] = -np.inf
+        order = np.argsort(-exact, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(exact, order, axis=1), np.take_along_axis(candidates, order, axis=1)  # missing hits keep id -1
+    
+    def _collect_chunks(self, scores: np.ndarray, indices: np.ndarray) -> List[ChunkView]:
+        """Turn one row of search results into chunk views with scores (no text is copied)"""
         relevant_chunks = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.chunks):
-                chunk = self.chunks[idx].copy()
-                chunk['similarity_score'] = float(scores[0][i])
-                relevant_chunks.append(chunk)
+        for i, idx in enumerate(indices):
+            if self.chunks.is_alive(int(idx)):
+                relevant_chunks.append(self.chunks.view(int(idx), float(scores[i])))
         
         return relevant_chunks
\ No newline at end of file
@@ -0,0 +1,401 @@
+"""Headless StudyMate service.
+
+Serves the retrieval and QA stack over HTTP with JSON bodies, without the
+Streamlit UI. One RetrievalEngine, FastHuggingFaceHandler and
+IngestionWorker are shared by every request. Concurrent searches and
+questions are collected into micro-batches, so N waiting questions cost one
+encode call and one batched QA call instead of N queued ones.
+    
+    python service.py --port 8765 --max-batch-size 16 --max-wait-ms 5
+
+Endpoints:
+    GET    /health                      {"status": "ok", "chunks": ..., "documents": ...}
+    GET    /metrics                     stage latencies, counters and cache hit rates
+    GET    /documents                   indexed source names
+    DELETE /documents?name=notes.pdf    remove a document
+    POST   /ingest?name=notes.pdf       raw PDF body (&course=CS101 to tag it); indexed in the background -> {"job": id}
+    GET    /jobs/<id>                   ingestion progress
+    POST   /search                      {"query": "...", "k": 3, "mode": "hybrid"} -> {"chunks": [...]}
+    POST   /answer                      {"question": "...", "k": 3} -> {"answer": "...", "chunks": [...]}
+
+/search and /answer also take optional "sources" (document names), "course"
+and "pages" ([first, last]) to search only part of the corpus.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+from chunk_store import ChunkFilter
+from ingestion import IngestionWorker, UploadedPDF
+from instrumentation import configure_logging, get_logger, metrics
+from llm_handler import FastHuggingFaceHandler
+from pdf_processor import PDFProcessor
+from query_cache import AnswerCache
+from retrieval_engine import RETRIEVAL_MODES, RetrievalEngine
+
+logger = get_logger(__name__)
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+def default_max_batch_size() -> int:
+    return int(os.getenv("STUDYMATE_MAX_BATCH_SIZE", "16"))
+
+def default_max_wait_ms() -> float:
+    return float(os.getenv("STUDYMATE_MAX_WAIT_MS", "5"))
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class MicroBatcher:
+    """Collects concurrent submissions into batches for one blocking batch function.
+    
+    A batch is dispatched once max_batch_size items are waiting, or max_wait_ms
+    after its first item arrived. batch_fn takes a list of items and returns
+    one result per item; it runs on a single executor thread, so model calls
+    never overlap while the event loop keeps accepting requests.
+    """
+    
+    def __init__(self, batch_fn: Callable[[List], List], max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0, name: str = 'batch'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"studymate-{name}")
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def submit(self, item):
+        """Queue one item and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future, time.perf_counter()))
+        return await future
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+    
+    async def _collect(self) -> List[Tuple]:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                # Still take whatever is already queued
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            batch = [entry for entry in batch if not entry[1].cancelled()]  # client went away
+            if not batch:
+                continue
+            dispatched = time.perf_counter()
+            for _, _, queued in batch:
+                metrics.record('queue_wait', dispatched - queued)
+            metrics.incr(f'{self.name}_batches')
+            metrics.incr(f'{self.name}_batched_items', len(batch))
+            try:
+                results = await loop.run_in_executor(self._executor, self.batch_fn, [item for item, _, _ in batch])
+            except Exception as e:
+                logger.exception("%s batch of %d failed", self.name, len(batch))
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+class StudyMateService:
+    """The shared engine, QA handler and ingestion worker behind the HTTP endpoints"""
+    
+    def __init__(self, engine: RetrievalEngine, handler: FastHuggingFaceHandler, worker: IngestionWorker,
+                 max_batch_size: Optional[int] = None, max_wait_ms: Optional[float] = None,
+                 answer_cache: Optional[AnswerCache] = None):
+        self.engine = engine
+        self.handler = handler
+        self.worker = worker
+        # Repeated questions (and close rephrasings) skip the search and/or the QA batch
+        self.answer_cache = answer_cache or AnswerCache(handler.model_version)
+        max_batch_size = max_batch_size or default_max_batch_size()
+        max_wait_ms = default_max_wait_ms() if max_wait_ms is None else max_wait_ms
+        # Searches (including the retrieval step of answers) share one encode call per batch;
+        # answers then share one QA call per batch
+        self.search_batcher = MicroBatcher(self._search_batch, max_batch_size, max_wait_ms, name='search')
+        self.answer_batcher = MicroBatcher(self._answer_batch, max_batch_size, max_wait_ms, name='answer')
+    
+    def start(self):
+        self.search_batcher.start()
+        self.answer_batcher.start()
+    
+    async def close(self):
+        await self.search_batcher.close()
+        await self.answer_batcher.close()
+    
+    def _search_batch(self, items: List[Tuple[str, int, Optional[str], Optional[ChunkFilter]]]) -> List[Tuple[List, Optional[np.ndarray]]]:
+        """items are (query, k, mode, filter); one encode and retrieve_batch call per mode and filter at the largest k.
+        
+        Returns (chunks, query embedding or None) per item, so answers can match cached questions on the embedding.
+        """
+        results = [None] * len(items)
+        groups: Dict[Hashable, List[int]] = {}
+        for i, (_, _, mode, chunk_filter) in enumerate(items):
+            groups.setdefault((mode, chunk_filter.key() if chunk_filter else None), []).append(i)
+        for positions in groups.values():
+            depth = max(items[i][1] for i in positions)
+            _, _, mode, chunk_filter = items[positions[0]]
+            queries = [items[i][0] for i in positions]
+            embeddings = self.engine.embed_queries(queries, mode)
+            retrieved = self.engine.retrieve_batch(queries, depth, mode=mode, chunk_filter=chunk_filter,
+                                                   query_embeddings=embeddings)
+            for row, (i, chunks) in enumerate(zip(positions, retrieved)):
+                results[i] = chunks[:items[i][1]], embeddings[row] if embeddings is not None else None
+        return results
+    
+    def _answer_batch(self, items: List[Tuple[str, List]]) -> List[str]:
+        """items are (question, retrieved chunks)"""
+        with metrics.timer('qa_batch'):
+            return self.handler.generate_answers([question for question, _ in items], [chunks for _, chunks in items])
+    
+    async def search(self, query: str, k: int = 3, mode: Optional[str] = None,
+                     chunk_filter: Optional[ChunkFilter] = None) -> List:
+        chunks, _ = await self.search_batcher.submit((query, k, mode, chunk_filter))
+        return chunks
+    
+    async def answer(self, question: str, k: int = 3, chunk_filter: Optional[ChunkFilter] = None) -> Tuple[str, List]:
+        with metrics.timer('answer_total'):
+            scope = (None, k, chunk_filter.key() if chunk_filter else None)
+            # Before searching only questions whose embedding is already in the query cache can hit;
+            # other rephrasings are matched on the embedding the batched search computes
+            cached = self.answer_cache.lookup(self.engine, question, scope)
+            if cached is not None:
+                return cached
+            version = self.engine.corpus_version
+            chunks, vector = await self.search_batcher.submit((question, k, None, chunk_filter))
+            if not chunks:
+                return "No relevant context found in documents. Please check if PDFs were processed correctly.", chunks
+            cached = self.answer_cache.lookup(self.engine, question, scope, chunks, vector=vector)
+            if cached is not None:
+                return cached
+            answer = await self.answer_batcher.submit((question, chunks))
+            self.answer_cache.store(self.engine, question, scope, chunks, answer, version, vector=vector)
+            return answer, chunks
+    
+    async def handle(self, method: str, path: str, query: Dict[str, List[str]], body: bytes) -> Dict:
+        """Route one request; returns the JSON response body or raises HTTPError"""
+        # indexed_sources waits for the engine lock, which ingestion holds while it adds a batch
+        if path == '/health' and method == 'GET':
+            documents = await asyncio.get_running_loop().run_in_executor(None, self.engine.indexed_sources)
+            return {'status': 'ok', 'chunks': self.engine.chunks.live_count,
+                    'documents': len(documents), 'ingesting': len(self.worker.active_jobs())}
+        if path == '/metrics' and method == 'GET':
+            return metrics.summary()
+        if path == '/documents':
+            if method == 'GET':
+                return {'documents': await asyncio.get_running_loop().run_in_executor(None, self.engine.indexed_sources)}
+            if method == 'DELETE':
+                name = _required_param(query, 'name')
+                return {'removed': await asyncio.get_running_loop().run_in_executor(None, self.engine.remove_document, name)}
+        if path == '/ingest' and method == 'POST':
+            name = _required_param(query, 'name')
+            if not body:
+                raise HTTPError(400, "Expected the PDF as the request body")
+            metadata = {name: {'course': query['course'][0]}} if query.get('course') else None
+            job = self.worker.submit([UploadedPDF(name, body)], metadata=metadata)
+            return {'job': job.id}
+        if path.startswith('/jobs/') and method == 'GET':
+            job = next((job for job in self.worker.jobs if str(job.id) == path[len('/jobs/'):]), None)
+            if job is None:
+                raise HTTPError(404, "No such job")
+            return job.snapshot()
+        if path == '/search' and method == 'POST':
+            request = _json_body(body)
+            mode = request.get('mode')
+            if mode is not None and mode not in RETRIEVAL_MODES:
+                raise HTTPError(400, f"Unknown retrieval mode '{mode}'. Choose from: {', '.join(RETRIEVAL_MODES)}")
+            chunks = await self.search(_required_field(request, 'query'), _k(request), mode, _chunk_filter(request))
+            return {'chunks': [chunk.to_dict() for chunk in chunks]}
+        if path == '/answer' and method == 'POST':
+            request = _json_body(body)
+            answer, chunks = await self.answer(_required_field(request, 'question'), _k(request), _chunk_filter(request))
+            return {'answer': answer, 'chunks': [chunk.to_dict() for chunk in chunks]}
+        if path in ('/health', '/metrics', '/documents', '/ingest', '/search', '/answer') or path.startswith('/jobs/'):
+            raise HTTPError(405, f"{method} is not supported on {path}")
+        raise HTTPError(404, f"No endpoint {path}")
+
+def _required_param(query: Dict[str, List[str]], name: str) -> str:
+    if not query.get(name):
+        raise HTTPError(400, f"Missing query parameter '{name}'")
+    return query[name][0]
+
+def _json_body(body: bytes) -> Dict:
+    try:
+        request = json.loads(body or b'{}')
+    except ValueError:
+        raise HTTPError(400, "Request body is not valid JSON")
+    if not isinstance(request, dict):
+        raise HTTPError(400, "Request body must be a JSON object")
+    return request
+
+def _required_field(request: Dict, name: str) -> str:
+    value = request.get(name)
+    if not isinstance(value, str) or not value.strip():
+        raise HTTPError(400, f"Missing '{name}'")
+    return value
+
+def _k(request: Dict) -> int:
+    k = request.get('k', 3)
+    if not isinstance(k, int) or not 1 <= k <= 50:
+        raise HTTPError(400, "'k' must be an integer between 1 and 50")
+    return k
+
+def _chunk_filter(request: Dict) -> Optional[ChunkFilter]:
+    sources, course, pages = request.get('sources'), request.get('course'), request.get('pages')
+    if sources is None and course is None and pages is None:
+        return None
+    if sources is not None and (not isinstance(sources, list) or not all(isinstance(s, str) for s in sources)):
+        raise HTTPError(400, "'sources' must be a list of document names")
+    if course is not None and not isinstance(course, str):
+        raise HTTPError(400, "'course' must be a string")
+    if pages is not None and (not isinstance(pages, list) or len(pages) != 2 or not all(isinstance(p, int) for p in pages)):
+        raise HTTPError(400, "'pages' must be [first, last]")
+    return ChunkFilter(sources=sources, course=course, pages=pages)
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    """Parse one HTTP/1.1 request; None when the client closed the connection"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HTTPError(400, "Malformed Content-Length")
+    if length < 0:
+        raise HTTPError(400, "Malformed Content-Length")
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"Body exceeds {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target, headers, body
+
+def _write_response(writer: asyncio.StreamWriter, status: int, payload: Dict, keep_alive: bool):
+    body = json.dumps(payload).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+
+async def serve_connection(service: StudyMateService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer requests on one connection until the client closes it or asks to"""
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except HTTPError as e:
+                _write_response(writer, e.status, {'error': str(e)}, keep_alive=False)
+                break
+            if request is None:
+                break
+            method, target, headers, body = request
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            url = urlsplit(target)
+            try:
+                status, payload = 200, await service.handle(method, url.path, parse_qs(url.query), body)
+            except HTTPError as e:
+                status, payload = e.status, {'error': str(e)}
+            except Exception as e:
+                logger.exception("Error handling %s %s", method, url.path)
+                status, payload = 500, {'error': str(e)}
+            _write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def run_server(service: StudyMateService, host: str, port: int):
+    service.start()
+    server = await asyncio.start_server(lambda r, w: serve_connection(service, r, w), host, port)
+    logger.warning("StudyMate service listening on http://%s:%d", host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+def build_service(index_dir: Optional[str] = None, max_batch_size: Optional[int] = None,
+                  max_wait_ms: Optional[float] = None) -> StudyMateService:
+    """Load the models and the saved index (if any) the same way the app does"""
+    processor = PDFProcessor(chunk_size=200, overlap=30,
+                             workers=int(os.getenv("STUDYMATE_PDF_WORKERS", os.cpu_count() or 1)))
+    engine = RetrievalEngine(retrieval_mode=os.getenv("STUDYMATE_RETRIEVAL_MODE", "hybrid"))
+    if index_dir and os.path.exists(os.path.join(index_dir, 'manifest.json')):
+        engine.load(index_dir)
+        logger.info("Loaded saved index from %s (%d files)", index_dir, len(engine.indexed_sources()))
+    handler = FastHuggingFaceHandler(lazy=False)
+    worker = IngestionWorker(engine, processor, save_path=index_dir)
+    return StudyMateService(engine, handler, worker, max_batch_size, max_wait_ms)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Headless StudyMate ingest/search/answer service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--index-dir', default=os.getenv("STUDYMATE_INDEX_DIR"),
+                        help="load the saved index from here and save after each ingestion job")
+    parser.add_argument('--max-batch-size', type=int, default=None,
+                        help="most requests per micro-batch (default: STUDYMATE_MAX_BATCH_SIZE or 16)")
+    parser.add_argument('--max-wait-ms', type=float, default=None,
+                        help="how long a batch waits to fill (default: STUDYMATE_MAX_WAIT_MS or 5)")
+    args = parser.parse_args(argv)
+    
+    configure_logging()
+    service = build_service(args.index_dir, args.max_batch_size, args.max_wait_ms)
+    try:
+        asyncio.run(run_server(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""One corpus shared by many sessions.
+
+Uploads are identified by the SHA-1 of their bytes, so when a whole class
+uploads the same course PDFs they are extracted and embedded once. Each
+session holds references to the documents it uploaded and searches only
+those (through a ChunkFilter, applied inside the index search). Documents
+no session has held for a while are evicted from the engine, by a
+background thread (start_eviction) rather than on a request path.
+"""
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from chunk_store import ChunkFilter
+from ingestion import IngestionJob, IngestionWorker, UploadedPDF
+from instrumentation import get_logger, metrics
+
+logger = get_logger(__name__)
+
+class SharedCorpus:
+    """Reference-counted documents in one RetrievalEngine, ingested by one IngestionWorker"""
+    
+    def __init__(self, engine, processor, save_path: Optional[str] = None):
+        self.engine = engine
+        self.worker = IngestionWorker(engine, processor, save_path)
+        self.save_path = save_path
+        self.lock = threading.RLock()
+        self._holders: Dict[str, Set[str]] = {}  # source -> sessions holding it
+        self._sessions: Dict[str, Set[str]] = {}  # session -> sources it holds
+        self._last_seen: Dict[str, float] = {}  # session -> last activity
+        self._digests: Dict[str, str] = {}  # SHA-1 of the upload -> source name
+        self._released_at: Dict[str, float] = {}  # unheld source -> when its last holder let go
+        self._eviction_thread: Optional[threading.Thread] = None
+        self._stop_eviction = threading.Event()
+        
+        # Documents of a loaded index start unheld and are evicted unless a session claims them
+        now = time.time()
+        for source, metadata in engine.document_metadata().items():
+            if 'sha1' in metadata:
+                self._digests[metadata['sha1']] = source
+                self._released_at[source] = now
+    
+    def add(self, session_id: str, files, course: Optional[str] = None) -> Tuple[List[str], Optional[IngestionJob]]:
+        """Give a session the documents in files, ingesting only content the corpus does not have yet.
+        
+        Returns the source names the files are indexed under (a name already used
+        by different content gets a '#digest' suffix) and the ingestion job, if
+        anything new had to be indexed. course is recorded for new documents only.
+        """
+        new_files, metadata, sources = [], {}, []
+        with self.lock:
+            self.touch(session_id)
+            taken = set(self.engine.indexed_sources()) | set(self._digests.values())
+            pending = set(self.worker.pending_files())
+            for f in files:
+                f.seek(0)
+                data = f.read()
+                digest = hashlib.sha1(data).hexdigest()
+                source = self._digests.get(digest)
+                if source is not None and source not in pending and not self.engine.has_document(source):
+                    source = None  # an earlier ingestion failed or was cancelled; try again
+                if source is None:
+                    source = f.name if f.name not in taken else f"{f.name}#{digest[:8]}"
+                    taken.add(source)
+                    self._digests[digest] = source
+                    new_files.append(UploadedPDF(source, data))
+                    metadata[source] = {'sha1': digest} if course is None else {'sha1': digest, 'course': course}
+                else:
+                    metrics.incr('shared_documents_reused')
+                self._acquire(session_id, source)
+                sources.append(source)
+        
+        job = self.worker.submit(new_files, metadata=metadata) if new_files else None
+        return sources, job
+    
+    def _acquire(self, session_id: str, source: str):
+        self._holders.setdefault(source, set()).add(session_id)
+        self._sessions.setdefault(session_id, set()).add(source)
+        self._released_at.pop(source, None)
+    
+    def release(self, session_id: str, source: str):
+        """Drop a session's reference to a document; it stays indexed until evicted"""
+        with self.lock:
+            self._sessions.get(session_id, set()).discard(source)
+            holders = self._holders.get(source)
+            if holders is None or session_id not in holders:
+                return
+            holders.discard(session_id)
+            if not holders:
+                del self._holders[source]
+                self._released_at[source] = time.time()
+    
+    def release_session(self, session_id: str):
+        """Drop every reference a session holds"""
+        with self.lock:
+            for source in list(self._sessions.get(session_id, ())):
+                self.release(session_id, source)
+            self._sessions.pop(session_id, None)
+            self._last_seen.pop(session_id, None)
+    
+    def touch(self, session_id: str):
+        """Mark a session as active, postponing its release by evict_unused"""
+        with self.lock:
+            self._last_seen[session_id] = time.time()
+    
+    def sources_for(self, session_id: str) -> List[str]:
+        """Documents the session holds, whether or not they have finished indexing"""
+        with self.lock:
+            return sorted(self._sessions.get(session_id, ()))
+    
+    def refcount(self, source: str) -> int:
+        with self.lock:
+            return len(self._holders.get(source, ()))
+    
+    def session_filter(self, session_id: str, sources: Optional[List[str]] = None, course: Optional[str] = None,
+                       pages: Optional[Tuple[int, int]] = None) -> ChunkFilter:
+        """Filter limiting a search to the session's documents (optionally a subset of them)"""
+        held = set(self.sources_for(session_id))
+        if sources is not None:
+            held &= set(sources)
+        return ChunkFilter(sources=held, course=course, pages=pages)
+    
+    def evict_unused(self, idle_seconds: float) -> List[str]:
+        """Release sessions idle for idle_seconds, then remove documents unheld for as long.
+        
+        Returns the evicted source names. Documents still being ingested are kept.
+        The victims are forgotten under the lock, but removed from the engine
+        (which may compact it) after releasing it, so sessions are not held up.
+        An upload of an evicted document's content in between is indexed again
+        under a '#digest' name, as the old name is still taken.
+        """
+        now = time.time()
+        with self.lock:
+            for session_id, last_seen in list(self._last_seen.items()):
+                if now - last_seen >= idle_seconds:
+                    logger.info("Releasing idle session %s", session_id)
+                    self.release_session(session_id)
+            
+            pending = set(self.worker.pending_files())
+            evicted = [source for source, released_at in self._released_at.items()
+                       if now - released_at >= idle_seconds and source not in pending]
+            for source in evicted:
+                del self._released_at[source]
+                for digest in [d for d, s in self._digests.items() if s == source]:
+                    del self._digests[digest]
+        
+        for source in evicted:
+            removed = self.engine.remove_document(source)
+            logger.info("Evicted unused document %s (%d chunks)", source, removed)
+        if evicted:
+            metrics.incr('documents_evicted', len(evicted))
+            if self.save_path and self.engine.chunks.live_count:
+                self.engine.save(self.save_path)
+        return evicted
+    
+    def start_eviction(self, idle_seconds: float, interval: Optional[float] = None):
+        """Run evict_unused(idle_seconds) every interval seconds (default idle_seconds / 4) on a daemon thread"""
+        interval = interval if interval is not None else max(1.0, idle_seconds / 4)
+        with self.lock:
+            if self._eviction_thread is not None and self._eviction_thread.is_alive():
+                return
+            self._stop_eviction.clear()
+            self._eviction_thread = threading.Thread(target=self._evict_periodically, args=(idle_seconds, interval),
+                                                     name="studymate-eviction", daemon=True)
+            self._eviction_thread.start()
+    
+    def stop_eviction(self):
+        self._stop_eviction.set()
+    
+    def _evict_periodically(self, idle_seconds: float, interval: float):
+        while not self._stop_eviction.wait(interval):
+            try:
+                self.evict_unused(idle_seconds)
+            except Exception:
+                logger.exception("Evicting unused documents failed")
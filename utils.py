@@ -1,48 +1,61 @@
+import io
+import uuid
 import streamlit as st
-from datetime import datetime
 from typing import List, Dict
+from history_store import HistoryStore
+
+# Q&A history entries shown per page
+HISTORY_PAGE_SIZE = 10
 
 def initialize_session_state():
     """Initialize Streamlit session state variables"""
-    if 'qa_history' not in st.session_state:
-        st.session_state.qa_history = []
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
     if 'chunks_ready' not in st.session_state:
         st.session_state.chunks_ready = False
     if 'processed_files' not in st.session_state:
         st.session_state.processed_files = []
 
+@st.cache_resource
+def get_history_store() -> HistoryStore:
+    """The process-wide history database (STUDYMATE_HISTORY_PATH)"""
+    return HistoryStore()
+
 def add_to_history(question: str, answer: str, context_chunks: List[Dict]):
-    """Add Q&A pair to session history"""
-    entry = {
-        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'question': question,
-        'answer': answer,
-        'context': context_chunks
-    }
-    st.session_state.qa_history.append(entry)
+    """Append a Q&A pair to the session's history; context chunks are stored as references"""
+    get_history_store().append(st.session_state.session_id, question, answer, context_chunks)
 
-def format_history_for_download() -> str:
-    """Format Q&A history for download"""
-    if not st.session_state.qa_history:
-        return "No Q&A history available."
-    
-    formatted_text = "StudyMate Q&A Session History\n"
-    formatted_text += "=" * 50 + "\n\n"
-    
-    for i, entry in enumerate(st.session_state.qa_history, 1):
-        formatted_text += f"Q{i}: {entry['question']}\n"
-        formatted_text += f"Time: {entry['timestamp']}\n"
-        formatted_text += f"Answer: {entry['answer']}\n"
-        formatted_text += "-" * 30 + "\n\n"
+def history_count() -> int:
+    return get_history_store().count(st.session_state.session_id)
+
+def format_history_for_download(version: int) -> bytes:
+    """The session's history as UTF-8 text, built once per history version (its entry count).
     
-    return formatted_text
+    st.download_button keeps its data in memory, so this is as large as the
+    whole history; caching it in the session only spares reruns the rebuild.
+    """
+    cached = st.session_state.get('history_export')
+    if cached is None or cached[0] != version:
+        export = io.StringIO()
+        get_history_store().export_text(st.session_state.session_id, export)
+        cached = st.session_state.history_export = (version, export.getvalue().encode('utf-8'))
+    return cached[1]
 
 def display_qa_history():
-    """Display Q&A history in the interface"""
-    if st.session_state.qa_history:
-        st.subheader("📝 Q&A History")
-        for i, entry in enumerate(reversed(st.session_state.qa_history), 1):
-            with st.expander(f"Q{len(st.session_state.qa_history) - i + 1}: {entry['question'][:50]}..."):
-                st.write(f"**Question:** {entry['question']}")
-                st.write(f"**Answer:** {entry['answer']}")
-                st.write(f"**Time:** {entry['timestamp']}")
\ No newline at end of file
+    """Display one page of the session's Q&A history, newest first"""
+    total = history_count()
+    if not total:
+        return
+    
+    st.subheader("📝 Q&A History")
+    pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, step=1,
+                           key="history_page") if pages > 1 else 1
+    for entry in get_history_store().page(st.session_state.session_id, page - 1, HISTORY_PAGE_SIZE):
+        with st.expander(f"Q{entry['number']}: {entry['question'][:50]}..."):
+            st.write(f"**Question:** {entry['question']}")
+            st.write(f"**Answer:** {entry['answer']}")
+            st.write(f"**Time:** {entry['timestamp']}")
+            if entry['chunks']:
+                sources = [chunk['source'] + (f" (p. {chunk['page']})" if 'page' in chunk else "") for chunk in entry['chunks']]
+                st.caption(f"Sources: {', '.join(sources)}")